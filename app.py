@@ -2,8 +2,8 @@ import click
 import gradio as gr
 from ditk import logging
 
-from webui_wrap.base import auto_init_webui, get_webui_client
-from webui_wrap.ui import create_t2i_ui, create_base_model_ui, create_i2i_ui, create_history_ui
+from webui_wrap.base import auto_init_webui
+from webui_wrap.ui import create_t2i_ui, create_base_model_ui, create_i2i_ui, create_history_ui, INTERACTIVE_THREADS
 
 logging.try_init_root(logging.INFO)
 CONTEXT_SETTINGS = dict(
@@ -18,20 +18,9 @@ CONTEXT_SETTINGS = dict(
               help='Create gradio share links.', show_default=True)
 @click.option('--port', 'port', type=int, default=10187,
               help='Server port.', show_default=True)
-def app(bind_all: bool, share: bool, port: int):
-    client = get_webui_client()
-
-    def base_model_refresh():
-        return gr.Dropdown(
-            value=client.util_get_current_model(),
-            choices=client.util_get_model_names(),
-            label='Base Model',
-        )
-
-    def _base_model_select(model_name):
-        client.util_set_model(model_name)
-        return base_model_refresh()
-
+@click.option('--concurrency', 'interactive_concurrency', type=int, default=8,
+              help='Concurrency of each event except the generations (e.g. queries of history).', show_default=True)
+def app(bind_all: bool, share: bool, port: int, interactive_concurrency: int):
     with gr.Blocks() as demo:
         with gr.Row():
             gr_base_model, gr_clip_skip = create_base_model_ui()
@@ -47,11 +36,14 @@ def app(bind_all: bool, share: bool, port: int):
                 with gr.Tab('History'):
                     create_history_ui()
 
+    # the generations are scheduled by the job scheduler, the other events are cheap and run concurrently
+    demo.queue(default_concurrency_limit=interactive_concurrency)
     demo.launch(
         share=bool(share),
         server_name='0.0.0.0'
         if bind_all else None,
-        server_port=port
+        server_port=port,
+        max_threads=INTERACTIVE_THREADS,
     )
 
 
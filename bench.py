@@ -0,0 +1,111 @@
+import glob
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import click
+from ditk import logging
+from hbutils.string import plural_word
+from PIL import Image
+
+from webui_wrap.storage import ImageCodec, benchmark_codecs
+
+logging.try_init_root(logging.INFO)
+CONTEXT_SETTINGS = dict(
+    help_option_names=['-h', '--help']
+)
+
+
+@click.group(context_settings=CONTEXT_SETTINGS, help='Benchmarks of webui wrap.')
+def cli():
+    pass  # pragma: no cover
+
+
+@cli.command('codec', context_settings=CONTEXT_SETTINGS, help='Benchmark the codecs of image storage.')
+@click.option('-i', '--input_dir', 'input_dir', type=click.Path(file_okay=False, exists=True), required=True,
+              help='Directory of the sample images.', show_default=True)
+@click.option('-n', '--max_count', 'max_count', type=int, default=16,
+              help='Max number of sample images.', show_default=True)
+def codec(input_dir: str, max_count: int):
+    images, meta_texts = [], []
+    for file in sorted(glob.glob(os.path.join(input_dir, '**', '*'), recursive=True)):
+        if os.path.splitext(file)[1].lower() in {'.png', '.webp', '.jpg', '.jpeg'}:
+            image = Image.open(file)
+            image.load()
+            images.append(image)
+            meta_texts.append(image.info.get('parameters'))
+            if len(images) >= max_count:
+                break
+    logging.info(f'{plural_word(len(images), "image")} loaded from {input_dir!r}.')
+
+    codecs = [
+        ImageCodec('png', compress_level=1),
+        ImageCodec('png', compress_level=6),
+        ImageCodec('png', compress_level=9),
+        ImageCodec('png', compress_level=9, optimize=True),
+        ImageCodec('webp', webp_method=0),
+        ImageCodec('webp', webp_method=4),
+    ]
+    meta_text = next(filter(bool, meta_texts), None)
+    for item in benchmark_codecs(images, codecs, meta_text):
+        click.echo(f'{item["codec"]}: {item["bytes_per_image"] / 1024:.1f} KiB, '
+                   f'{item["ms_per_image"]:.1f} ms per image')
+
+
+_IMPORTTIME_MODULES = ['webui_wrap.base', 'webui_wrap.storage', 'webui_wrap.storage.codec', 'webui_wrap.ui']
+
+
+def _run_importtime(code: str) -> List[Tuple[str, int]]:
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise click.ClickException(f'Unable to run {code!r}:\n{result.stderr.strip()}')
+    items = []
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:'):
+            self_us, _, name = line[len('import time:'):].split('|')
+            if self_us.strip().isdigit():
+                items.append((name.strip(), int(self_us)))
+    return items
+
+
+def _measure_import(module: str, startup_modules: set) -> Dict[str, int]:
+    # the modules imported by the interpreter startup are not counted
+    return {name: self_us for name, self_us in _run_importtime(f'import {module}') if name not in startup_modules}
+
+
+@cli.command('importtime', context_settings=CONTEXT_SETTINGS,
+             help='Benchmark the import time of webui wrap modules, with python -X importtime.')
+@click.option('-m', '--module', 'modules', type=str, multiple=True, default=_IMPORTTIME_MODULES,
+              help='Modules to import.', show_default=True)
+@click.option('-n', '--repeats', 'repeats', type=int, default=5,
+              help='Times to import each module in new interpreters, the fastest one is reported.', show_default=True)
+@click.option('-k', '--top', 'top', type=int, default=8,
+              help='Number of the slowest top-level packages to show.', show_default=True)
+@click.option('--max_ms', 'max_ms', type=float, default=None,
+              help='Fail when any module takes longer than this to import.', show_default=True)
+def importtime(modules: List[str], repeats: int, top: int, max_ms: float):
+    startup_modules = {name for name, _ in _run_importtime('pass')}
+    slow_modules = []
+    for module in modules:
+        imported = min((_measure_import(module, startup_modules) for _ in range(repeats)),
+                       key=lambda x: sum(x.values()))
+        total_ms = sum(imported.values()) / 1000
+        click.echo(f'{module}: {total_ms:.1f} ms, {plural_word(len(imported), "module")} imported')
+
+        packages = defaultdict(int)
+        for name, self_us in imported.items():
+            packages[name.split('.')[0]] += self_us
+        for package, self_us in sorted(packages.items(), key=lambda x: -x[1])[:top]:
+            click.echo(f'    {package}: {self_us / 1000:.1f} ms')
+        if max_ms is not None and total_ms > max_ms:
+            slow_modules.append(module)
+
+    if slow_modules:
+        raise click.ClickException(f'Import time of {", ".join(slow_modules)} exceeded {max_ms:.1f} ms.')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,28 @@
+import os
+
+import click
+from ditk import logging
+from hbutils.string import plural_word
+
+from webui_wrap.storage import migrate_parquet_to_sqlite
+
+logging.try_init_root(logging.INFO)
+CONTEXT_SETTINGS = dict(
+    help_option_names=['-h', '--help']
+)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='Migrate the parquet records into a SQLite database.')
+@click.option('-d', '--root_dir', 'root_dir', type=click.Path(file_okay=False, exists=True),
+              default=lambda: os.environ.get('LOCAL_IMG_STORAGE_DIR') or os.path.abspath('images'),
+              help='Directory of the records, LOCAL_IMG_STORAGE_DIR by default.')
+@click.option('-o', '--db_file', 'db_file', type=click.Path(dir_okay=False), default=None,
+              help='Output database file, records.sqlite3 in the records directory by default.')
+def migrate(root_dir: str, db_file: str):
+    db_file = db_file or os.path.join(root_dir, 'records.sqlite3')
+    count = migrate_parquet_to_sqlite(root_dir, db_file)
+    logging.info(f'{plural_word(count, "record")} migrated into {db_file!r}.')
+
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,112 @@
+import threading
+
+import pytest
+import requests
+
+
+class FakeResponse:
+    def __init__(self, data: dict):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    def __init__(self, client: 'FakeClient'):
+        self.client = client
+
+    def get(self, url, params=None, timeout=None):
+        if self.client.down:
+            raise requests.ConnectionError(f'{self.client.baseurl} is down')
+        return FakeResponse({'state': {'job_count': 0}})
+
+
+class FakeClient:
+    """
+    Stand-in of the webui client, with the apis used by the pool and the scheduler only.
+    """
+
+    def __init__(self, index: int, scripts=(), model: str = 'm0'):
+        self.baseurl = f'http://webui-{index}:7860/sdapi/v1'
+        self.session = FakeSession(self)
+        self.down = False
+        self.scripts = list(scripts)
+        self.model = model
+        self.switches = []
+        self.lock = threading.Lock()
+
+    def get_scripts(self):
+        return {'txt2img': self.scripts}
+
+    def controlnet_module_list(self):
+        return []
+
+    def controlnet_model_list(self):
+        return ['control_canny'] if 'ControlNet' in self.scripts else []
+
+    def custom_get(self, path):
+        raise OSError(f'{path} not found')
+
+    def get_upscalers(self):
+        return [{'name': 'R-ESRGAN 4x+'}]
+
+    def util_get_model_names(self):
+        return ['m0', 'm1']
+
+    def util_get_current_model(self):
+        return self.model
+
+    def util_set_model(self, model: str):
+        with self.lock:
+            self.model = model
+            self.switches.append(model)
+
+
+@pytest.fixture()
+def new_client():
+    return FakeClient
+
+
+@pytest.fixture()
+def new_pool(tmp_path, monkeypatch):
+    from webui_wrap.base.pool import WebUIPool
+
+    monkeypatch.setenv('WEBUI_CAPABILITY_CACHE_DIR', str(tmp_path / 'capabilities'))
+    pools = []
+
+    def _new_pool(clients, **kwargs):
+        # the health checks are only done by the tests
+        pool = WebUIPool(clients, check_interval=3600.0, **kwargs)
+        pools.append(pool)
+        return pool
+
+    yield _new_pool
+    for pool in pools:
+        pool.stop()
+
+
+@pytest.fixture()
+def new_scheduler(new_pool):
+    # the scheduler tells the connection errors of httpx
+    pytest.importorskip('httpx')
+    from webui_wrap.base.scheduler import JobScheduler
+
+    schedulers = []
+
+    def _new_scheduler(clients, **kwargs):
+        scheduler = JobScheduler(
+            new_pool(clients),
+            switch_model=lambda client, model: client.util_set_model(model),
+            current_model=lambda client: client.util_get_current_model(),
+            **kwargs,
+        )
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield _new_scheduler
+    for scheduler in schedulers:
+        scheduler._executor.shutdown(wait=True)
@@ -0,0 +1,98 @@
+import pytest
+import requests
+
+from webui_wrap.base.pool import NoBackendError
+
+
+def _job(client):
+    if client.down:
+        raise requests.ConnectionError(f'{client.baseurl} dropped')
+    return client.baseurl
+
+
+def _failing_job(client):
+    raise ValueError('bad parameters')
+
+
+class TestWebUIPool:
+    def test_capabilities(self, new_pool, new_client):
+        pool = new_pool([new_client(0, scripts=['ControlNet']), new_client(1, scripts=['ADetailer'])])
+        assert pool.get_capability('scripts') == ['controlnet', 'adetailer']
+        assert pool.get_capability('cn_models') == ['control_canny']
+        assert pool.eligible_backends({'scripts': ['controlnet']}) == [pool.backends[0]]
+        assert pool.eligible_backends({'scripts': ['controlnet', 'adetailer']}) == []
+        assert pool.eligible_backends() == pool.backends
+
+    def test_health_checks(self, new_pool, new_client):
+        clients = [new_client(0), new_client(1)]
+        pool = new_pool(clients, max_failures=2)
+        changed = []
+        pool.add_listener(lambda backend: changed.append((backend.name, backend.healthy)))
+        assert pool.healthy_backends == pool.backends
+
+        # unhealthy after failing twice in a row, and healthy again once it responds
+        clients[1].down = True
+        pool.check_all()
+        assert pool.backends[1].healthy
+        pool.check_all()
+        assert not pool.backends[1].healthy
+        assert pool.healthy_backends == [pool.backends[0]]
+        clients[1].down = False
+        pool.check_all()
+        assert pool.backends[1].healthy
+        assert changed == [(clients[1].baseurl, False), (clients[1].baseurl, True)]
+
+    def test_unreachable_at_beginning(self, new_pool, new_client):
+        clients = [new_client(0), new_client(1)]
+        clients[0].down = True
+        pool = new_pool(clients)
+        assert pool.healthy_backends == [pool.backends[1]]
+        assert pool.stats[0]['healthy'] is False
+
+
+class TestFailover:
+    def test_failover(self, new_scheduler, new_client):
+        clients = [new_client(0), new_client(1)]
+        scheduler = new_scheduler(clients)
+        pool = scheduler.pool
+        # the less loaded one is picked first
+        pool.backends[0].latency, pool.backends[1].latency = 0.0, 1.0
+
+        clients[0].down = True
+        assert scheduler.submit('u', _job).result(timeout=10) == clients[1].baseurl
+        assert not pool.backends[0].healthy
+        assert scheduler.stats['failovers'] == 1
+        assert scheduler.stats['backends'] == 1
+
+        clients[0].down = False
+        pool.check_all()
+        assert pool.backends[0].healthy
+        assert scheduler.submit('u', _job).result(timeout=10) == clients[0].baseurl
+
+    def test_all_backends_fail(self, new_scheduler, new_client):
+        clients = [new_client(0), new_client(1)]
+        scheduler = new_scheduler(clients)
+        for client in clients:
+            client.down = True
+
+        # tried on each backend once, and fails with the error of the last one
+        with pytest.raises(requests.ConnectionError, match='dropped'):
+            scheduler.submit('u', _job).result(timeout=10)
+        assert scheduler.stats['failovers'] == 1
+        assert scheduler.pool.healthy_backends == []
+        with pytest.raises(NoBackendError):
+            scheduler.submit('u', _job)
+
+    def test_no_failover_on_job_errors(self, new_scheduler, new_client):
+        scheduler = new_scheduler([new_client(0), new_client(1)])
+        with pytest.raises(ValueError):
+            scheduler.submit('u', _failing_job).result(timeout=10)
+        assert scheduler.stats['failovers'] == 0
+        assert len(scheduler.pool.healthy_backends) == 2
+
+    def test_no_backend_with_requirements(self, new_scheduler, new_client):
+        scheduler = new_scheduler([new_client(0, scripts=['ControlNet']), new_client(1)])
+        with pytest.raises(NoBackendError):
+            scheduler.submit('u', _job, requirements={'cn_models': ['control_depth']})
+        assert scheduler.submit('u', _job, requirements={'scripts': ['controlnet']}).result(timeout=10) \
+               == scheduler.pool.backends[0].name
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+
+def _job(client, name, order, gate=None):
+    if gate is not None:
+        assert gate.wait(10)
+    order.append(name)
+    return client.baseurl
+
+
+class TestJobScheduler:
+    def test_users_take_turns(self, new_scheduler, new_client):
+        scheduler = new_scheduler([new_client(0)])
+        gate, order = threading.Event(), []
+        jobs = [scheduler.submit('a', _job, 'a1', order, gate)]
+        jobs.extend(scheduler.submit('a', _job, f'a{i}', order) for i in range(2, 5))
+        jobs.extend(scheduler.submit('b', _job, f'b{i}', order) for i in range(1, 3))
+
+        # a2 and b1 are the next ones of the users, b2 waits for a3 of the user before it
+        assert [job.position for job in jobs] == [0, 1, 3, 5, 2, 4]
+        assert scheduler.stats['pending'] == 5
+        gate.set()
+        for job in jobs:
+            job.result(timeout=10)
+        assert order == ['a1', 'a2', 'b1', 'a3', 'b2', 'a4']
+        assert scheduler.stats['pending'] == 0
+        assert scheduler.stats['running'] == 0
+
+    def test_user_queue_limit(self, new_scheduler, new_client):
+        from webui_wrap.base import JobQueueFullError
+
+        scheduler = new_scheduler([new_client(0)], max_pending_per_user=2)
+        gate, order = threading.Event(), []
+        jobs = [scheduler.submit('a', _job, 'a1', order, gate), scheduler.submit('a', _job, 'a2', order),
+                scheduler.submit('a', _job, 'a3', order)]
+        with pytest.raises(JobQueueFullError):
+            scheduler.submit('a', _job, 'a4', order)
+        # the others are not limited by that user
+        jobs.append(scheduler.submit('b', _job, 'b1', order))
+
+        assert jobs[2].cancel()
+        assert not jobs[0].cancel()
+        gate.set()
+        for job in [jobs[0], jobs[1], jobs[3]]:
+            job.result(timeout=10)
+        assert order == ['a1', 'a2', 'b1']
+
+    def test_model_affinity(self, new_scheduler, new_client):
+        client = new_client(0, model='m0')
+        scheduler = new_scheduler([client])
+        gate, order = threading.Event(), []
+        jobs = [scheduler.submit('u0', _job, 'u0', order, gate, model='m0')]
+        jobs.extend(scheduler.submit(f'u{i}', _job, f'u{i}', order, model=['m0', 'm1'][i % 2]) for i in range(1, 5))
+        gate.set()
+        for job in jobs:
+            job.result(timeout=10)
+
+        # the jobs of the loaded model take their turns first, so it is only switched once
+        assert order == ['u0', 'u2', 'u4', 'u1', 'u3']
+        assert client.switches == ['m1']
+        assert scheduler.loaded_models == {client.baseurl: 'm1'}
+        stats = scheduler.stats
+        assert stats['switches'] == 1
+        assert stats['affinity_picks'] == 2
+
+    def test_model_affinity_wait(self, new_scheduler, new_client):
+        client = new_client(0, model='m0')
+        scheduler = new_scheduler([client], max_affinity_wait=0.0)
+        gate, order = threading.Event(), []
+        jobs = [scheduler.submit('u0', _job, 'u0', order, gate, model='m0')]
+        jobs.extend(scheduler.submit(f'u{i}', _job, f'u{i}', order, model=['m0', 'm1'][i % 2]) for i in range(1, 5))
+        gate.set()
+        for job in jobs:
+            job.result(timeout=10)
+
+        # waited too long for the others, the turns are kept
+        assert order == ['u0', 'u1', 'u2', 'u3', 'u4']
+        assert client.switches == ['m1', 'm0', 'm1', 'm0']
+
+    def test_model_routed_to_loaded_backend(self, new_scheduler, new_client):
+        clients = [new_client(0, model='m0'), new_client(1, model='m1')]
+        scheduler = new_scheduler(clients, max_running_per_user=4)
+        # the loaded models are known after the first jobs, which run at the same time on both backends
+        gate = threading.Event()
+        jobs = [scheduler.submit('u', _job, 'warmup', [], gate, model='m0'),
+                scheduler.submit('u', _job, 'warmup', [], model='m1')]
+        jobs[1].result(timeout=10)
+        gate.set()
+        jobs[0].result(timeout=10)
+        loaded_models = scheduler.loaded_models
+        assert sorted(loaded_models.values()) == ['m0', 'm1']
+        n_switches = len(clients[0].switches) + len(clients[1].switches)
+
+        backends = {model: name for name, model in loaded_models.items()}
+        for i in range(6):
+            model = ['m0', 'm1'][i % 2]
+            assert scheduler.submit('u', _job, f'j{i}', [], model=model).result(timeout=10) == backends[model]
+        assert len(clients[0].switches) + len(clients[1].switches) == n_switches
+        assert scheduler.loaded_models == loaded_models
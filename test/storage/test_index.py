@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from webui_wrap.storage.index import TagIndex
+
+
+@pytest.fixture()
+def index():
+    index = TagIndex()
+    index.add_tags_column([
+        '1girl solo smile',
+        '1girl 1boy',
+        None,
+        'solo smile',
+        '1boy solo',
+    ])
+    return index
+
+
+class TestTagIndex:
+    def test_postings(self, index):
+        assert len(index) == 5
+        assert index.get('solo').tolist() == [0, 3, 4]
+        assert index.get('missing').tolist() == []
+        assert index.count('1girl') == 2
+        assert index.counts() == {'1girl': 2, 'solo': 3, 'smile': 2, '1boy': 2}
+
+    @pytest.mark.parametrize(['groups', 'neg_groups', 'rows'], [
+        ([], [], [0, 1, 2, 3, 4]),
+        (['solo'], [], [0, 3, 4]),
+        (['solo', 'smile'], [], [0, 3]),
+        (['solo', 'missing'], [], []),
+        ([['1girl', '1boy']], [], [0, 1, 4]),
+        ([['1girl', '1boy'], 'solo'], [], [0, 4]),
+        ([], ['solo'], [1, 2]),
+        (['solo'], [['1girl', '1boy']], [3]),
+        (['smile'], ['missing'], [0, 3]),
+    ])
+    def test_query(self, index, groups, neg_groups, rows):
+        result = index.query(groups, neg_groups)
+        assert result.dtype == np.int64
+        assert result.tolist() == rows
+
+    def test_table_round_trip(self, index):
+        table = index.to_table(metadata={b'key': b'value'})
+        assert table.schema.metadata[b'key'] == b'value'
+
+        loaded = TagIndex.from_table(table)
+        assert len(loaded) == 5
+        assert loaded.counts() == index.counts()
+        assert loaded.query(['solo'], ['smile']).tolist() == [4]
+
+        # the loaded postings are extended with the new rows
+        loaded.add(5, ['smile'])
+        assert loaded.get('smile').tolist() == [0, 3, 5]
+        assert len(loaded) == 6
+
+    def test_empty_table(self):
+        loaded = TagIndex.from_table(TagIndex().to_table())
+        assert len(loaded) == 0
+        assert loaded.query([], []).tolist() == []
@@ -0,0 +1,94 @@
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from webui_wrap.storage import record
+from webui_wrap.storage.local import LocalImageStorage
+from webui_wrap.storage.record import BaseImageRecorder, ImageRecorder
+from webui_wrap.storage.sqlite import SQLiteImageRecorder
+
+
+def _fake_tags_batch(images, model_name=None):
+    # the images with an even red channel are tagged with 1girl, the others with 1boy
+    return [({'general': 0.9, 'sensitive': 0.1}, {'1girl' if image.getpixel((0, 0))[0] % 2 == 0 else '1boy': 0.8}, {},
+             np.ones(8, dtype=np.float32)) for image in images]
+
+
+def _image(index):
+    image = Image.new('RGB', (32, 32), (index, 0, 0))
+    image.info['parameters'] = '1girl\nNegative prompt: lowres\nSteps: 20, Sampler: Euler a, Seed: 1, Size: 32x32'
+    return image
+
+
+@pytest.fixture(params=['parquet', 'sqlite'])
+def recorder(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(record, 'get_wd14_tags_batch', _fake_tags_batch)
+    # the tags of the queries are used as they are, without the vocabulary
+    monkeypatch.setattr(BaseImageRecorder, '_resolve_query', lambda self, tags, neg_tags: (tags, neg_tags))
+    storage = LocalImageStorage(str(tmp_path / 'images'))
+    if request.param == 'parquet':
+        recorder = ImageRecorder(storage, str(tmp_path / 'records'))
+    else:
+        recorder = SQLiteImageRecorder(storage, db_file=str(tmp_path / 'records.sqlite3'))
+
+    with monkeypatch.context() as m:
+        # 4 batches of 3 images, the images of one batch share the same created_at
+        for batch in range(4):
+            m.setattr(time, 'time', lambda: 1000.0 + batch)
+            recorder.put_images([_image(batch * 3 + i) for i in range(3)])
+    recorder.save()
+    yield recorder
+    recorder.close()
+
+
+def _pages(recorder, tags, limit, backward=False, cursor=None):
+    pages = []
+    while True:
+        page = recorder.query_page(tags, [], cursor=cursor, limit=limit, backward=backward)
+        if not page:
+            return pages
+        pages.append(page)
+        cursor = recorder.page_cursor(page[0] if backward else page[-1])
+
+
+def _filenames(page):
+    return [item['filename'] for item in page]
+
+
+class TestQueryPage:
+    def test_forward(self, recorder):
+        latest = recorder.query_page([], [], limit=100)
+        assert len(latest) == 12
+        assert len({item['created_at'] for item in latest}) == 4
+        assert [item['created_at'] for item in latest] == sorted((item['created_at'] for item in latest), reverse=True)
+
+        # the pages are split in the middle of the batches with the same created_at
+        pages = _pages(recorder, [], limit=5)
+        assert [len(page) for page in pages] == [5, 5, 2]
+        assert sum(map(_filenames, pages), []) == _filenames(latest)
+
+    def test_backward(self, recorder):
+        latest = recorder.query_page([], [], limit=100)
+        cursor = recorder.page_cursor(latest[-1])
+        pages = _pages(recorder, [], limit=5, backward=True, cursor=cursor)
+        assert [len(page) for page in pages] == [5, 5, 1]
+        # each page is still latest first, the pages are ordered from the oldest one
+        assert sum(map(_filenames, pages[::-1]), []) == _filenames(latest[:-1])
+
+        forward = recorder.query_page([], [], cursor=recorder.page_cursor(latest[4]), limit=4)
+        assert _filenames(forward) == _filenames(latest[5:9])
+        backward = recorder.query_page([], [], cursor=recorder.page_cursor(forward[0]), limit=4, backward=True)
+        assert _filenames(backward) == _filenames(latest[1:5])
+
+    def test_tags(self, recorder):
+        girls = recorder.query_page(['1girl'], [], limit=100)
+        assert len(girls) == 6
+        assert all('1girl' in item['tags'].split() for item in girls)
+
+        pages = _pages(recorder, ['1girl'], limit=4)
+        assert [len(page) for page in pages] == [4, 2]
+        assert sum(map(_filenames, pages), []) == _filenames(girls)
+        assert recorder.query_page(['1girl', '1boy'], [], limit=100) == []
+        assert len(recorder.query_page([['1girl', '1boy']], [], limit=100)) == 12
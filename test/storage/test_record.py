@@ -0,0 +1,121 @@
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from webui_wrap.storage import record
+from webui_wrap.storage.local import LocalImageStorage
+from webui_wrap.storage.record import ImageRecorder
+
+
+def _fake_tags_batch(images, model_name=None):
+    return [({'general': 0.9, 'sensitive': 0.1}, {'1girl': 0.8}, {}, np.ones(8, dtype=np.float32))
+            for _ in images]
+
+
+def _image(index):
+    image = Image.new('RGB', (32, 32), (index % 256, index // 256, 0))
+    image.info['parameters'] = '1girl\nNegative prompt: lowres\nSteps: 20, Sampler: Euler a, Seed: 1, Size: 32x32'
+    return image
+
+
+def _filenames(recorder):
+    with recorder._lock:
+        return recorder._records.column('filename', range(len(recorder._records)))
+
+
+def _missing_embeddings(recorder):
+    with recorder._lock:
+        return [row for row in range(len(recorder._records)) if recorder._embeddings.get(row) is None]
+
+
+@pytest.fixture()
+def new_recorder(tmp_path, monkeypatch):
+    monkeypatch.setattr(record, 'get_wd14_tags_batch', _fake_tags_batch)
+    # the tags of the queries are used as they are, without the vocabulary
+    monkeypatch.setattr(ImageRecorder, '_resolve_query', lambda self, tags, neg_tags: (tags, neg_tags))
+    storage = LocalImageStorage(str(tmp_path / 'images'))
+    recorders = []
+
+    def _new_recorder(**kwargs):
+        recorder = ImageRecorder(storage, str(tmp_path / 'records'), **kwargs)
+        recorders.append(recorder)
+        return recorder
+
+    yield _new_recorder
+    for recorder in recorders:
+        recorder.close()
+
+
+class TestImageRecorder:
+    def test_concurrent_saves(self, new_recorder):
+        # two recorders sharing one directory, like two processes of the app
+        first, second = new_recorder(compact_threshold=2), new_recorder(compact_threshold=2)
+        writers_done = threading.Event()
+        saved, errors = [], []
+
+        def _write(recorder, start):
+            try:
+                for i in range(start, start + 20):
+                    saved.extend(recorder.put_images([_image(i)]))
+                    recorder.save()
+            except Exception as err:
+                errors.append(err)
+
+        def _until_done(fn):
+            try:
+                while not writers_done.is_set():
+                    fn()
+            except Exception as err:
+                errors.append(err)
+
+        writers = [threading.Thread(target=_write, args=(first, 0)),
+                   threading.Thread(target=_write, args=(second, 20))]
+        others = [threading.Thread(target=_until_done, args=(first.compact,)),
+                  threading.Thread(target=_until_done, args=(second.refresh,))]
+        for t in writers + others:
+            t.start()
+        for t in writers:
+            t.join()
+        writers_done.set()
+        for t in others:
+            t.join()
+        assert not errors
+
+        assert len(set(saved)) == 40
+        for recorder in [first, second, new_recorder()]:
+            recorder.refresh()
+            # no records are lost or duplicated
+            assert sorted(_filenames(recorder)) == sorted(saved)
+            assert not _missing_embeddings(recorder)
+            assert recorder._get_tag_count('1girl') == 40
+
+    def test_page_across_compaction(self, new_recorder):
+        first, second = new_recorder(), new_recorder()
+        for i in range(13):
+            # the records of the other recorder are loaded after the own ones, but are in the middle of the files
+            recorder = second if 5 <= i < 8 else first
+            recorder.put_images([_image(i)])
+            recorder.save()
+        first.refresh()
+        expected = first.query_page([], [], limit=13)
+        assert len(expected) == 13
+
+        page = first.query_page([], [], limit=4)
+        assert page == expected[:4]
+
+        # the rows are renumbered when the records are reloaded after the compaction
+        second.compact()
+        reloaded = new_recorder()
+        assert [item['row'] for item in reloaded.query_page([], [], limit=13)] != [item['row'] for item in expected]
+
+        filenames = [item['filename'] for item in page]
+        while page:
+            page = reloaded.query_page([], [], cursor=first.page_cursor(page[-1]), limit=4)
+            filenames.extend(item['filename'] for item in page)
+        assert filenames == [item['filename'] for item in expected]
+
+        cursor = first.page_cursor(expected[7])
+        page = reloaded.query_page([], [], cursor=cursor, limit=4, backward=True)
+        assert [item['filename'] for item in page] == [item['filename'] for item in expected[3:7]]
@@ -0,0 +1,149 @@
+import io
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from PIL import Image
+
+from webui_wrap.storage.s3 import S3ImageStorage, _DiskCache
+
+
+def _client_error(code: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code}}, operation)
+
+
+class _FakeS3Client:
+    """
+    In-memory stand-in of the boto3 client, only with the calls used by the storage.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.ranges = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        self.objects[(Bucket, Key)] = Fileobj.read()
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise _client_error('404', 'HeadObject')
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def get_object(self, Bucket, Key, Range):
+        if (Bucket, Key) not in self.objects:
+            raise _client_error('NoSuchKey', 'GetObject')
+        data = self.objects[(Bucket, Key)]
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        if start >= len(data):
+            raise _client_error('InvalidRange', 'GetObject')
+        self.ranges.append((Key, start, end))
+        body = data[start:end + 1]
+        return {
+            'Body': StreamingBody(io.BytesIO(body), len(body)),
+            'ContentRange': f'bytes {start}-{start + len(body) - 1}/{len(data)}',
+        }
+
+
+@pytest.fixture()
+def client():
+    return _FakeS3Client()
+
+
+@pytest.fixture()
+def new_storage(client):
+    def _new_storage(**kwargs):
+        storage = S3ImageStorage('bucket', prefix='images', endpoint_url='http://localhost:9000', **kwargs)
+        storage._client = client
+        return storage
+
+    return _new_storage
+
+
+class TestS3ImageStorage:
+    def test_ranged_download(self, new_storage, client):
+        storage = new_storage(range_size=10, range_workers=2)
+        data = bytes(range(35))
+        client.put_object(Bucket='bucket', Key='images/large.bin', Body=data)
+
+        assert storage._download('large.bin') == data
+        assert sorted(client.ranges) == [('images/large.bin', 0, 9), ('images/large.bin', 10, 19),
+                                         ('images/large.bin', 20, 29), ('images/large.bin', 30, 34)]
+
+        client.ranges.clear()
+        client.put_object(Bucket='bucket', Key='images/small.bin', Body=data[:7])
+        assert storage._download('small.bin') == data[:7]
+        assert client.ranges == [('images/small.bin', 0, 9)]
+
+    def test_download_missing_and_empty(self, new_storage, client):
+        storage = new_storage()
+        with pytest.raises(FileNotFoundError):
+            storage._download('missing.bin')
+
+        client.put_object(Bucket='bucket', Key='images/empty.bin', Body=b'')
+        assert storage._download('empty.bin') == b''
+
+    def test_cached_images(self, tmp_path, new_storage, client):
+        storage = new_storage(cache_dir=str(tmp_path / 'cache'), range_size=64)
+        filename = storage.put_image(Image.new('RGB', (32, 32), (255, 0, 0)))
+        assert storage._exists(storage._image_path(filename))
+
+        client.ranges.clear()
+        assert storage.get_image(filename).getpixel((0, 0)) == (255, 0, 0)
+        n_requests = len(client.ranges)
+        assert n_requests > 1
+        # read from the disk cache at the second time
+        assert storage.get_image(filename).size == (32, 32)
+        assert len(client.ranges) == n_requests
+
+        # the cached file is dropped when the object is written again
+        storage._save_bytes(b'data', storage._image_path(filename))
+        assert storage._cache.get(storage._image_path(filename)) is None
+        storage.release_image(filename)
+        assert not storage._exists(storage._image_path(filename))
+        with pytest.raises(FileNotFoundError):
+            storage.get_image(filename)
+
+
+class TestDiskCache:
+    def test_evict_least_recently_used(self, tmp_path):
+        cache = _DiskCache(str(tmp_path), max_bytes=10)
+        cache.put('a/1.bin', b'1234')
+        cache.put('a/2.bin', b'1234')
+        assert cache.get('a/1.bin') == os.path.join(str(tmp_path), 'a/1.bin')
+
+        # 2.bin is evicted, which is used earlier than 1.bin
+        cache.put('b/3.bin', b'1234')
+        assert cache.get('a/2.bin') is None
+        assert not os.path.exists(tmp_path / 'a' / '2.bin')
+        with open(cache.get('a/1.bin'), 'rb') as f:
+            assert f.read() == b'1234'
+        assert cache.get('b/3.bin') is not None
+
+        # larger than the whole cache, not cached at all
+        cache.put('c/4.bin', b'x' * 11)
+        assert cache.get('c/4.bin') is None
+
+    def test_reload(self, tmp_path):
+        cache = _DiskCache(str(tmp_path), max_bytes=10)
+        cache.put('a/1.bin', b'1234')
+        with open(tmp_path / 'a' / '2.bin.0000.tmp', 'wb') as f:
+            f.write(b'partial')
+
+        # the entries are loaded from the directory, and the unfinished files are removed
+        reloaded = _DiskCache(str(tmp_path), max_bytes=10)
+        assert reloaded.get('a/1.bin') is not None
+        assert not os.path.exists(tmp_path / 'a' / '2.bin.0000.tmp')
+        reloaded.discard('a/1.bin')
+        assert reloaded.get('a/1.bin') is None
+        assert not os.path.exists(tmp_path / 'a' / '1.bin')
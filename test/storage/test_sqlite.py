@@ -0,0 +1,74 @@
+import sqlite3
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from webui_wrap.storage import record
+from webui_wrap.storage.local import LocalImageStorage
+from webui_wrap.storage.sqlite import SQLiteImageRecorder
+
+
+def _fake_tags_batch(images, model_name=None):
+    return [({'general': 0.9, 'sensitive': 0.1}, {'1girl': 0.8}, {}, np.ones(8, dtype=np.float32))
+            for _ in images]
+
+
+def _image(color):
+    image = Image.new('RGB', (32, 32), color)
+    image.info['parameters'] = '1girl\nNegative prompt: lowres\nSteps: 20, Sampler: Euler a, Seed: 1, Size: 32x32'
+    return image
+
+
+@pytest.fixture()
+def recorder(tmp_path, monkeypatch):
+    monkeypatch.setattr(record, 'get_wd14_tags_batch', _fake_tags_batch)
+    storage = LocalImageStorage(str(tmp_path / 'images'), content_addressed=True)
+    recorder = SQLiteImageRecorder(storage, db_file=str(tmp_path / 'records.sqlite3'))
+    yield recorder
+    recorder.close()
+
+
+class TestSQLiteImageRecorder:
+    def test_dedup_same_image(self, recorder):
+        same_image = _image((255, 0, 0))
+        other = _image((0, 255, 0))
+
+        first, = recorder.put_images([same_image])
+        other_file, second = recorder.put_images([other, same_image])
+        assert second == first
+        assert other_file != first
+
+        filenames = [row['filename'] for row in recorder._conn().execute('SELECT filename FROM records')]
+        assert sorted(filenames) == sorted([first, other_file, first])
+        assert recorder._get_tag_count('1girl') == 3
+        assert recorder.count_refs(first) == 2
+        assert not recorder.release_image(first)
+        assert recorder.image_storage.get_image(first).size == (32, 32)
+
+    def test_unique_filename_dropped(self, tmp_path, monkeypatch):
+        # the databases created with the unique filenames are rebuilt without that
+        db_file = str(tmp_path / 'old.sqlite3')
+        conn = sqlite3.connect(db_file)
+        conn.executescript("""
+        CREATE TABLE records (
+            id INTEGER PRIMARY KEY, filename TEXT NOT NULL UNIQUE, rating TEXT, tags TEXT,
+            width INTEGER, height INTEGER, prompt TEXT, neg_prompt TEXT, created_at REAL NOT NULL,
+            model TEXT, sampler TEXT, seed INTEGER, extra TEXT
+        );
+        INSERT INTO records (filename, created_at) VALUES ('a.png', 1.0);
+        """)
+        conn.close()
+
+        monkeypatch.setattr(record, 'get_wd14_tags_batch', _fake_tags_batch)
+        storage = LocalImageStorage(str(tmp_path / 'images'), content_addressed=True)
+        recorder = SQLiteImageRecorder(storage, db_file=db_file)
+        try:
+            image = _image((0, 0, 255))
+            recorder.put_images([image])
+            recorder.put_images([image])
+            assert [row['filename'] for row in recorder._conn().execute(
+                'SELECT filename FROM records ORDER BY id')][0] == 'a.png'
+            assert recorder._conn().execute('SELECT COUNT(*) FROM records').fetchone()[0] == 3
+        finally:
+            recorder.close()
@@ -0,0 +1,96 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from webui_wrap.storage import vocab
+from webui_wrap.storage.vocab import TagVocabulary, compile_vocabulary, get_tag_vocabulary
+
+_TAGS_INFO = pd.DataFrame([
+    {'name': 'solo', 'category': 0, 'aliases': json.dumps(['solo', 'alone'])},
+    {'name': '1girl', 'category': 0, 'aliases': json.dumps(['1girl', 'girl'])},
+    {'name': 'saber', 'category': 4, 'aliases': json.dumps(['saber', 'artoria'])},
+    {'name': 'artoria_pendragon', 'category': 4, 'aliases': json.dumps(['artoria'])},
+    {'name': 'english_commentary', 'category': 5, 'aliases': json.dumps(['english_commentary'])},
+])
+_GENERAL_TAGS = pd.DataFrame([
+    {'name': 'solo', 'wiki': 'only one character'},
+    {'name': 'saber', 'wiki': None},
+    {'name': '1girl', 'wiki': 'one girl'},
+])
+_CHARACTER_TAGS = pd.DataFrame([
+    {'name': 'saber', 'wiki': 'the character'},
+])
+
+
+def _fake_read_csv(repo_id, repo_type, filename, local_files_only):
+    if filename.endswith('tags_info.csv'):
+        return _TAGS_INFO.copy()
+    return {'general_tags.csv': _GENERAL_TAGS, 'character_tags.csv': _CHARACTER_TAGS}[filename].copy()
+
+
+@pytest.fixture()
+def vocab_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(vocab, '_read_csv', _fake_read_csv)
+    return compile_vocabulary(str(tmp_path / 'vocab'))
+
+
+class TestTagVocabulary:
+    def test_resolve(self, vocab_dir):
+        vocabulary = TagVocabulary(vocab_dir)
+        assert vocabulary.resolve('solo') == {'name': 'solo', 'category': 0}
+        assert vocabulary.resolve('alone') == {'name': 'solo', 'category': 0}
+        assert vocabulary.resolve('girl') == {'name': '1girl', 'category': 0}
+        # the later one wins for the duplicated aliases
+        assert vocabulary.resolve('artoria') == {'name': 'artoria_pendragon', 'category': 4}
+        # only the general and character tags are compiled
+        assert vocabulary.resolve('english_commentary') is None
+        assert vocabulary.resolve('missing') is None
+        assert vocabulary.resolve('') is None
+        assert 'saber' in vocabulary
+        assert 'zzz' not in vocabulary
+
+    def test_get_info(self, vocab_dir):
+        vocabulary = TagVocabulary(vocab_dir)
+        assert vocabulary.get_info('solo', 0)['wiki'] == 'only one character'
+        # the same names of different categories are told apart
+        assert vocabulary.get_info('saber', 0)['wiki'] is None
+        assert vocabulary.get_info('saber', 4)['wiki'] == 'the character'
+        assert vocabulary.get_info('1girl', 4) is None
+        assert vocabulary.get_info('missing', 0) is None
+
+    def test_sorted_files(self, vocab_dir):
+        vocabulary = TagVocabulary(vocab_dir)
+        aliases = vocabulary.aliases.column('alias').to_pylist()
+        assert aliases == sorted(aliases)
+        assert vocabulary.aliases.column('alias').num_chunks == 1
+        names = vocabulary.tags_info.column('name').to_pylist()
+        assert names == sorted(names)
+        assert not [name for name in os.listdir(vocab_dir) if name.endswith('.tmp')]
+
+    def test_compiled_once(self, vocab_dir, monkeypatch):
+        monkeypatch.setenv('TAGS_VOCAB_DIR', vocab_dir)
+        monkeypatch.setattr(vocab, 'compile_vocabulary', lambda *args, **kwargs: pytest.fail('compiled again'))
+        get_tag_vocabulary.cache_clear()
+        try:
+            assert get_tag_vocabulary().resolve('alone')['name'] == 'solo'
+        finally:
+            get_tag_vocabulary.cache_clear()
+
+    def test_compile_offline(self, tmp_path, monkeypatch):
+        calls = []
+
+        def _read_csv(repo_id, repo_type, filename, local_files_only):
+            calls.append(local_files_only)
+            return _fake_read_csv(repo_id, repo_type, filename, local_files_only)
+
+        monkeypatch.setattr(vocab, '_read_csv', _read_csv)
+        monkeypatch.setenv('TAGS_VOCAB_DIR', str(tmp_path / 'offline'))
+        monkeypatch.setenv('WEBUI_WRAP_OFFLINE', '1')
+        get_tag_vocabulary.cache_clear()
+        try:
+            assert get_tag_vocabulary().resolve('girl')['name'] == '1girl'
+        finally:
+            get_tag_vocabulary.cache_clear()
+        assert calls == [True, True, True]
@@ -0,0 +1,11 @@
+import os
+
+_TRUTHY = {'1', 'true', 'yes', 'on'}
+
+
+def env_flag(name: str) -> bool:
+    """
+    Whether the flag in environment variable ``name`` is on, e.g. ``1`` or ``true``, while ``0`` and ``false``
+    are off.
+    """
+    return (os.environ.get(name) or '').strip().lower() in _TRUTHY
@@ -0,0 +1,22 @@
+from importlib import import_module
+from typing import Any, Callable, Dict, List, Tuple
+
+
+def lazy_attrs(module_name: str, module_globals: Dict[str, Any], lazy_imports: Dict[str, str]) \
+        -> Tuple[Callable[[str], Any], Callable[[], List[str]]]:
+    """
+    ``__getattr__`` and ``__dir__`` of package ``module_name`` (see PEP 562), the names in ``lazy_imports``
+    are imported from their submodules at the first access, and then kept in ``module_globals``.
+    """
+
+    def __getattr__(name: str):
+        if name in lazy_imports:
+            value = getattr(import_module(lazy_imports[name], module_name), name)
+            module_globals[name] = value
+            return value
+        raise AttributeError(f'module {module_name!r} has no attribute {name!r}')
+
+    def __dir__():
+        return sorted({*module_globals, *lazy_imports})
+
+    return __getattr__, __dir__
@@ -1,5 +1,48 @@
-from .adetailer import has_adetailer, get_adetailer_models, get_adetailer_version
-from .cn import select_control_type, has_controlnet
-from .dynamic_prompt import has_dynamic_prompts, dynamic_prompt_params
-from .sampler import WEBUI_SAMPLERS
-from .webui import set_webui_server, auto_init_webui, get_webui_client
+from typing import TYPE_CHECKING
+
+from .._lazy import lazy_attrs
+
+# the subsystems (and their heavy dependencies) are only imported at the first access, see PEP 562
+_LAZY_IMPORTS = {
+    'has_adetailer': '.adetailer',
+    'get_adetailer_models': '.adetailer',
+    'get_adetailer_version': '.adetailer',
+    'get_capability': '.capability',
+    'get_capability_catalog': '.capability',
+    'refresh_capabilities': '.capability',
+    'CapabilityCatalog': '.capability',
+    'AsyncWebUIApi': '.client',
+    'select_control_type': '.cn',
+    'has_controlnet': '.cn',
+    'has_dynamic_prompts': '.dynamic_prompt',
+    'dynamic_prompt_params': '.dynamic_prompt',
+    'NoBackendError': '.pool',
+    'WebUIBackend': '.pool',
+    'WebUIPool': '.pool',
+    'get_webui_pool': '.pool',
+    'WEBUI_SAMPLERS': '.sampler',
+    'Job': '.scheduler',
+    'JobQueueFullError': '.scheduler',
+    'JobScheduler': '.scheduler',
+    'get_job_scheduler': '.scheduler',
+    'set_webui_server': '.webui',
+    'set_webui_servers': '.webui',
+    'auto_init_webui': '.webui',
+    'get_webui_client': '.webui',
+    'get_webui_clients': '.webui',
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+if TYPE_CHECKING:
+    from .adetailer import has_adetailer, get_adetailer_models, get_adetailer_version
+    from .capability import get_capability, get_capability_catalog, refresh_capabilities, CapabilityCatalog
+    from .client import AsyncWebUIApi
+    from .cn import select_control_type, has_controlnet
+    from .dynamic_prompt import has_dynamic_prompts, dynamic_prompt_params
+    from .pool import NoBackendError, WebUIBackend, WebUIPool, get_webui_pool
+    from .sampler import WEBUI_SAMPLERS
+    from .scheduler import Job, JobQueueFullError, JobScheduler, get_job_scheduler
+    from .webui import set_webui_server, set_webui_servers, auto_init_webui, get_webui_client, get_webui_clients
+
+__getattr__, __dir__ = lazy_attrs(__name__, globals(), _LAZY_IMPORTS)
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Set
+
+from hbutils.string import plural_word
+
+
+_CAPABILITY_FETCHERS: Dict[str, Callable[[Any], Any]] = {
+    'scripts': lambda client: sorted(set(map(str.lower, client.get_scripts()['txt2img']))),
+    'cn_modules': lambda client: client.controlnet_module_list(),
+    'cn_models': lambda client: client.controlnet_model_list(),
+    'adetailer_version': lambda client: client.custom_get('/adetailer/v1/version')['version'],
+    'adetailer_models': lambda client: client.custom_get('/adetailer/v1/ad_model')['ad_model'],
+    'upscalers': lambda client: [item['name'] for item in client.get_upscalers()],
+    'sd_models': lambda client: client.util_get_model_names(),
+}
+_CAPABILITY_DEFAULTS: Dict[str, Any] = {
+    'scripts': [],
+    'cn_modules': [],
+    'cn_models': [],
+    'adetailer_version': None,
+    'adetailer_models': [],
+    'upscalers': [],
+    'sd_models': [],
+}
+
+
+class CapabilityCatalog:
+    """
+    Capabilities of one webui server (scripts, controlnet, adetailer, upscalers and models), which are all fetched
+    concurrently. The last snapshot on disk is used for a warm start, and the ones older than ``ttl`` seconds
+    are refreshed in the background.
+    """
+
+    def __init__(self, client, snapshot_file: Optional[str] = None, ttl: float = 600.0):
+        self.client = client
+        self.snapshot_file = snapshot_file
+        self.ttl = ttl
+        self._values: Dict[str, Any] = {}
+        self._fetched_at: float = 0.0
+        self._refresh_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file, 'r') as f:
+                snapshot = json.load(f)
+            self._values, self._fetched_at = snapshot['values'], snapshot['fetched_at']
+        except (OSError, ValueError, KeyError) as err:
+            logging.warning(f'Unable to load capability snapshot {self.snapshot_file!r}, skipped - {err!r}')
+        else:
+            logging.info(f'Capability snapshot {self.snapshot_file!r} loaded, '
+                         f'fetched {time.time() - self._fetched_at:.1f}s ago.')
+
+    def _save_snapshot(self):
+        if not self.snapshot_file:
+            return
+        os.makedirs(os.path.dirname(self.snapshot_file), exist_ok=True)
+        tmp_file = f'{self.snapshot_file}.{os.urandom(4).hex()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'values': self._values, 'fetched_at': self._fetched_at}, f)
+        os.replace(tmp_file, self.snapshot_file)
+
+    def _fetch(self, name: str):
+        try:
+            return name, _CAPABILITY_FETCHERS[name](self.client)
+        except Exception as err:
+            logging.info(f'Capability {name!r} not available - {err!r}')
+            # transient failures should not wipe what is already known
+            return name, self._values.get(name, _CAPABILITY_DEFAULTS[name])
+
+    def _refresh(self):
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=len(_CAPABILITY_FETCHERS), thread_name_prefix='webui_capability') as pool:
+            values = dict(pool.map(self._fetch, _CAPABILITY_FETCHERS))
+        self._values, self._fetched_at = values, time.time()
+        logging.info(f'{plural_word(len(values), "capability")} fetched from webui server '
+                     f'in {self._fetched_at - start_time:.3f}s.')
+        try:
+            self._save_snapshot()
+        except OSError as err:
+            logging.warning(f'Unable to save capability snapshot {self.snapshot_file!r} - {err!r}')
+
+    def refresh(self):
+        """
+        Fetch all the capabilities again, and save the snapshot.
+        """
+        with self._refresh_lock:
+            self._refresh()
+
+    def refresh_in_background(self):
+        with self._thread_lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self.refresh, name='webui_capability_refresh',
+                                                    daemon=True)
+            self._refresh_thread.start()
+
+    def get(self, name: str):
+        if name not in self._values:
+            with self._refresh_lock:
+                if name not in self._values:
+                    self._refresh()
+        elif time.time() - self._fetched_at > self.ttl:
+            self.refresh_in_background()
+        return self._values[name]
+
+    def has(self, name: str) -> bool:
+        """
+        Whether the capability is known (fetched or loaded from the snapshot), without fetching it.
+        """
+        return name in self._values
+
+
+def _snapshot_file(baseurl: str) -> str:
+    cache_dir = os.environ.get('WEBUI_CAPABILITY_CACHE_DIR') or \
+                os.path.join(os.path.expanduser('~'), '.cache', 'webui_wrap', 'capabilities')
+    return os.path.join(cache_dir, f'{hashlib.sha1(baseurl.encode()).hexdigest()[:16]}.json')
+
+
+def create_capability_catalog(client) -> CapabilityCatalog:
+    return CapabilityCatalog(
+        client=client,
+        snapshot_file=_snapshot_file(client.baseurl),
+        ttl=float(os.environ.get('WEBUI_CAPABILITY_TTL') or 600.0),
+    )
+
+
+def get_capability_catalog() -> CapabilityCatalog:
+    """
+    The capability catalogue of the primary webui server, which is replaced when the servers are changed.
+    """
+    from .pool import get_webui_pool
+    return get_webui_pool().primary.catalog
+
+
+def get_capability(name: str):
+    """
+    Capability of all the webui servers, e.g. the scripts installed on any of them, the jobs are only
+    routed to the servers able to serve them.
+    """
+    from .pool import get_webui_pool
+    return get_webui_pool().get_capability(name)
+
+
+def refresh_capabilities():
+    from .pool import get_webui_pool
+    get_webui_pool().refresh_capabilities()
+
+
+def _get_client_scripts() -> Set[str]:
+    return set(get_capability('scripts'))
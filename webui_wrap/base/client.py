@@ -0,0 +1,70 @@
+import asyncio
+import threading
+import weakref
+from typing import Optional
+
+import httpx
+from webuiapi import WebUIApi, WebUIApiResult
+
+
+class AsyncWebUIApi(WebUIApi):
+    """
+    :class:`webuiapi.WebUIApi` sending its requests with the keep-alive connections of a shared
+    :class:`httpx.Client`, with the asyncio versions of the generations and the small apis on a pooled
+    :class:`httpx.AsyncClient` (one for each event loop). ``timeout`` is the limit of each request
+    (``None`` for no limit, as the generations can be long), and ``connect_timeout`` of the connecting.
+    """
+
+    def __init__(self, *args, timeout: Optional[float] = None, connect_timeout: float = 10.0,
+                 max_connections: int = 32, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        # the auth is set to the session of webuiapi, before checking the extensions
+        auth = self.session.auth
+        self.session.close()
+        self.session = httpx.Client(auth=auth, timeout=self.timeout, limits=self.limits)
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._async_clients_lock = threading.Lock()
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        # the connections of httpx are bound to the event loop they are created in
+        loop = asyncio.get_running_loop()
+        with self._async_clients_lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = httpx.AsyncClient(auth=self.session.auth, timeout=self.timeout, limits=self.limits)
+                self._async_clients[loop] = client
+            return client
+
+    async def async_post(self, url, json) -> WebUIApiResult:
+        # used by the generations of webuiapi with `use_async=True`, the images are decoded in a worker thread
+        response = await self.async_client.post(url, json=json)
+        return await asyncio.to_thread(self._to_api_result, response)
+
+    async def async_txt2img(self, **kwargs) -> WebUIApiResult:
+        return await self.txt2img(**kwargs, use_async=True)
+
+    async def async_img2img(self, **kwargs) -> WebUIApiResult:
+        return await self.img2img(**kwargs, use_async=True)
+
+    async def async_get_options(self) -> dict:
+        response = await self.async_client.get(f'{self.baseurl}/options')
+        response.raise_for_status()
+        return response.json()
+
+    async def async_set_options(self, options: dict):
+        response = await self.async_client.post(f'{self.baseurl}/options', json=options)
+        response.raise_for_status()
+        return response.json()
+
+    async def async_get_progress(self, skip_current_image: bool = False) -> dict:
+        response = await self.async_client.get(f'{self.baseurl}/progress',
+                                               params={'skip_current_image': str(skip_current_image).lower()})
+        response.raise_for_status()
+        return response.json()
+
+    async def async_interrupt(self):
+        response = await self.async_client.post(f'{self.baseurl}/interrupt')
+        response.raise_for_status()
@@ -1,27 +1,19 @@
 from enum import Enum
-from functools import lru_cache
 from typing import Dict, List, Tuple
 
-from .webui import auto_init_webui, get_webui_client, _get_client_scripts
+from .capability import _get_client_scripts, get_capability
 
 
-@lru_cache()
 def has_controlnet():
-    return any(map(lambda x: x.lower() == 'controlnet', _get_client_scripts()))
+    return 'controlnet' in _get_client_scripts()
 
 
-@lru_cache()
-def get_cn_modules():
-    auto_init_webui()
-    client = get_webui_client()
-    return client.controlnet_module_list()
+def get_cn_modules() -> List[str]:
+    return get_capability('cn_modules')
 
 
-@lru_cache()
-def get_cn_models():
-    auto_init_webui()
-    client = get_webui_client()
-    return client.controlnet_model_list()
+def get_cn_models() -> List[str]:
+    return get_capability('cn_models')
 
 
 preprocessor_filters = {
@@ -83,10 +75,13 @@ preprocessor_aliases = {
     "te_hed": "softedge_teed",
 }
 
-ui_preprocessor_keys = ['none', preprocessor_aliases['invert']]
-ui_preprocessor_keys += sorted([preprocessor_aliases.get(k, k)
-                                for k in get_cn_modules()
-                                if preprocessor_aliases.get(k, k) not in ui_preprocessor_keys])
+
+def get_ui_preprocessor_keys() -> List[str]:
+    ui_preprocessor_keys = ['none', preprocessor_aliases['invert']]
+    ui_preprocessor_keys += sorted([preprocessor_aliases.get(k, k)
+                                    for k in get_cn_modules()
+                                    if preprocessor_aliases.get(k, k) not in ui_preprocessor_keys])
+    return ui_preprocessor_keys
 
 
 class StableDiffusionVersion(Enum):
@@ -137,7 +132,7 @@ def select_control_type(
 ) -> Tuple[List[str], List[str], str, str]:
     default_preprocessor = preprocessor_filters[control_type]
     pattern = control_type.lower()
-    preprocessor_list = ui_preprocessor_keys
+    preprocessor_list = get_ui_preprocessor_keys()
     if cn_models is None:
         all_models = get_cn_models()
     else:
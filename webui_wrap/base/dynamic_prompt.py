@@ -1,18 +1,22 @@
 import logging
-from functools import lru_cache
 from typing import Optional
 
-from .webui import _get_client_scripts
+from .capability import _get_client_scripts
+
+# the name logged last time, so it is only logged again when changed by the refreshing of the capabilities
+_LOGGED_NAME: Optional[str] = ''
 
 
-@lru_cache()
 def _get_dynamic_prompts_name() -> Optional[str]:
-    for name in _get_client_scripts():
-        if 'dynamic' in name and 'prompts' in name:
-            logging.info(f'Dynamic prompts found, name: {name!r}')
-            return name
-    logging.error('Dynamic prompts not found.')
-    return None
+    global _LOGGED_NAME
+    retval = next((name for name in sorted(_get_client_scripts()) if 'dynamic' in name and 'prompts' in name), None)
+    if retval != _LOGGED_NAME:
+        _LOGGED_NAME = retval
+        if retval:
+            logging.info(f'Dynamic prompts found, name: {retval!r}')
+        else:
+            logging.error('Dynamic prompts not found.')
+    return retval
 
 
 def has_dynamic_prompts() -> bool:
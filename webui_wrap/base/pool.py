@@ -0,0 +1,228 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from hbutils.string import plural_word
+
+from .capability import CapabilityCatalog, create_capability_catalog
+from .webui import auto_init_webui, get_webui_clients
+
+
+class NoBackendError(RuntimeError):
+    pass
+
+
+class WebUIBackend:
+    """
+    One webui server in :class:`WebUIPool`, with its capabilities and the state got from its progress api.
+    The ``loaded_model``, ``switching`` and ``n_running`` are kept by the job scheduler.
+    """
+
+    def __init__(self, client, catalog: CapabilityCatalog):
+        self.client = client
+        self.catalog = catalog
+        self.healthy = True
+        self.latency: Optional[float] = None
+        # jobs of the current task of webui, including the ones not sent by this process
+        self.queue_depth = 0
+        self.failures = 0
+        self.checked_at = 0.0
+
+        # `None` when not known yet, or after a failed switch
+        self.loaded_model: Optional[str] = None
+        self.switching = False
+        self.n_running = 0
+
+    @property
+    def name(self) -> str:
+        return self.client.baseurl
+
+    @property
+    def load(self) -> Tuple[int, float]:
+        """
+        Key to route the jobs to the less loaded backends, the running jobs (one when busy with the jobs
+        from other places), and then the latency.
+        """
+        return max(self.n_running, 1 if self.queue_depth else 0), self.latency or 0.0
+
+    def check(self, timeout: float):
+        """
+        Poll ``/sdapi/v1/progress`` of the backend, an error is raised when it is not reachable.
+        """
+        start_time = time.time()
+        resp = self.client.session.get(f'{self.client.baseurl}/progress', params={'skip_current_image': 'true'},
+                                       timeout=timeout)
+        resp.raise_for_status()
+        state = resp.json().get('state') or {}
+        latency = time.time() - start_time
+        self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+        self.queue_depth = max(int(state.get('job_count') or 0), 0)
+        self.checked_at = time.time()
+
+    def supports(self, requirements: Dict[str, Iterable[str]]) -> bool:
+        """
+        Whether all the ``requirements`` (e.g. ``{'scripts': ['controlnet'], 'cn_models': [...]}``, named as
+        the capabilities) are available on this backend.
+        """
+        for name, values in requirements.items():
+            values = list(values)
+            if not values:
+                continue
+            if not self.healthy and not self.catalog.has(name):
+                # not fetched from the unreachable ones
+                return False
+            if not set(values) <= set(self.catalog.get(name)):
+                return False
+        return True
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.name!r}, healthy: {self.healthy!r}, load: {self.load!r}>'
+
+
+class WebUIPool:
+    """
+    Pool of the webui servers, they are checked every ``check_interval`` seconds, and the ones failed for
+    ``max_failures`` times in a row are unhealthy until they respond again. The listeners are called with
+    the backend when it becomes healthy or unhealthy.
+    """
+
+    def __init__(self, clients: List[Any], check_interval: float = 5.0, check_timeout: float = 3.0,
+                 max_failures: int = 2):
+        self.clients = list(clients)
+        self.backends = [WebUIBackend(client, create_capability_catalog(client)) for client in self.clients]
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.max_failures = max_failures
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[WebUIBackend], Any]] = []
+        self._check_pool = ThreadPoolExecutor(max_workers=len(self.backends), thread_name_prefix='webui_health')
+        self._stopped = threading.Event()
+        self.check_all()
+        self._thread = threading.Thread(target=self._loop, name='webui_health', daemon=True)
+        self._thread.start()
+
+    @property
+    def primary(self) -> WebUIBackend:
+        return self.backends[0]
+
+    def add_listener(self, listener: Callable[[WebUIBackend], Any]):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def _set_healthy(self, backend: WebUIBackend, healthy: bool, reason: Optional[str] = None):
+        with self._lock:
+            if backend.healthy == healthy:
+                return
+            backend.healthy = healthy
+            listeners = list(self._listeners)
+        if healthy:
+            logging.info(f'Webui backend {backend.name!r} is back, latency: {backend.latency:.3f}s.')
+            # the extensions and models may be changed while it is down
+            backend.catalog.refresh_in_background()
+        else:
+            logging.warning(f'Webui backend {backend.name!r} is unhealthy - {reason}')
+        for listener in listeners:
+            listener(backend)
+
+    def mark_failed(self, backend: WebUIBackend, err: BaseException):
+        """
+        Mark the backend unhealthy at once, e.g. when a job failed to connect to it.
+        """
+        backend.failures = max(backend.failures, self.max_failures)
+        self._set_healthy(backend, False, repr(err))
+
+    def _check(self, backend: WebUIBackend):
+        try:
+            backend.check(self.check_timeout)
+        except Exception as err:
+            backend.failures += 1
+            # the ones never reached are unhealthy from the beginning
+            if backend.failures >= self.max_failures or not backend.checked_at:
+                self._set_healthy(backend, False, repr(err))
+        else:
+            backend.failures = 0
+            self._set_healthy(backend, True)
+
+    def check_all(self):
+        list(self._check_pool.map(self._check, self.backends))
+
+    def _loop(self):
+        while not self._stopped.wait(self.check_interval):
+            self.check_all()
+
+    def stop(self):
+        self._stopped.set()
+        self._check_pool.shutdown(wait=False)
+
+    @property
+    def healthy_backends(self) -> List[WebUIBackend]:
+        return [backend for backend in self.backends if backend.healthy]
+
+    def eligible_backends(self, requirements: Optional[Dict[str, Iterable[str]]] = None) -> List[WebUIBackend]:
+        """
+        The backends able to serve the jobs with the ``requirements``, including the unhealthy ones
+        which may come back.
+        """
+        if not requirements:
+            return list(self.backends)
+        return [backend for backend in self.backends if backend.supports(requirements)]
+
+    def get_capability(self, name: str):
+        """
+        Capability of all the backends, the lists are merged, the other values are taken from the first one.
+        """
+        values = [backend.catalog.get(name) for backend in self.backends
+                  if backend.healthy or backend.catalog.has(name)]
+        values = values or [self.primary.catalog.get(name)]
+        if isinstance(values[0], list):
+            merged = {}
+            for items in values:
+                merged.update((item, None) for item in items)
+            return list(merged)
+        else:
+            return next((value for value in values if value is not None), values[0])
+
+    def refresh_capabilities(self):
+        list(self._check_pool.map(lambda backend: backend.catalog.refresh(), self.healthy_backends))
+
+    @property
+    def stats(self) -> List[Dict[str, Any]]:
+        return [{
+            'name': backend.name,
+            'healthy': backend.healthy,
+            'latency': backend.latency,
+            'queue_depth': backend.queue_depth,
+            'running': backend.n_running,
+            'loaded_model': backend.loaded_model,
+        } for backend in self.backends]
+
+
+_POOL: Optional[WebUIPool] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_webui_pool() -> WebUIPool:
+    """
+    Pool of the current webui servers, which is replaced when the servers are changed. The health checks
+    are configured with ``WEBUI_HEALTH_INTERVAL`` (``5`` seconds by default) and ``WEBUI_HEALTH_TIMEOUT``
+    (``3`` seconds by default).
+    """
+    global _POOL
+    auto_init_webui()
+    clients = get_webui_clients()
+    with _POOL_LOCK:
+        if _POOL is None or len(_POOL.clients) != len(clients) or \
+                any(a is not b for a, b in zip(_POOL.clients, clients)):
+            if _POOL is not None:
+                _POOL.stop()
+            _POOL = WebUIPool(
+                clients=clients,
+                check_interval=float(os.environ.get('WEBUI_HEALTH_INTERVAL') or 5.0),
+                check_timeout=float(os.environ.get('WEBUI_HEALTH_TIMEOUT') or 3.0),
+            )
+            logging.info(f'Webui pool of {plural_word(len(clients), "backend")} created, '
+                         f'{len(_POOL.healthy_backends)} healthy.')
+        return _POOL
@@ -0,0 +1,452 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+from hbutils.string import plural_word
+from requests import ConnectionError as RequestsConnectionError
+
+from .pool import NoBackendError, WebUIBackend, WebUIPool, get_webui_pool
+
+
+class JobQueueFullError(RuntimeError):
+    pass
+
+
+def _is_connection_error(err: BaseException) -> bool:
+    return isinstance(err, (ConnectionError, RequestsConnectionError,
+                            httpx.NetworkError, httpx.ConnectTimeout, httpx.RemoteProtocolError))
+
+
+class Job:
+    """
+    Job of one user in :class:`JobScheduler`, which is a future of the result of ``fn``.
+    """
+
+    def __init__(self, scheduler: 'JobScheduler', user: str, fn: Callable, args: tuple, kwargs: dict,
+                 model: Optional[str] = None, backends: Optional[List[WebUIBackend]] = None,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.scheduler = scheduler
+        self.user = user
+        self.model = model
+        # the event loop to run the coroutine function in, `None` for the functions run in the worker threads
+        self.loop = loop
+        # the backends able to serve the job, the ones failed while running it are removed
+        self.backends: List[WebUIBackend] = list(backends or [])
+        self.backend: Optional[WebUIBackend] = None
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+
+    @property
+    def position(self) -> int:
+        """
+        Position in the queue, see :meth:`JobScheduler.get_position`.
+        """
+        return self.scheduler.get_position(self)
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def cancel(self) -> bool:
+        """
+        Withdraw the job, only the ones not started yet can be cancelled.
+        """
+        return self.scheduler.cancel(self)
+
+    def result(self, timeout: Optional[float] = None):
+        return self.future.result(timeout=timeout)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} user: {self.user!r}, fn: {getattr(self.fn, "__name__", self.fn)!r}, ' \
+               f'model: {self.model!r}>'
+
+
+class JobScheduler:
+    """
+    Scheduler of the jobs sent to the webui servers of the ``pool``. At most ``max_running`` jobs are running
+    on each backend, with at most ``max_running_per_user`` of each user, and the users take turns (round-robin),
+    so one user with many jobs can not starve the others. Each user can have at most ``max_pending_per_user``
+    jobs waiting. The jobs are only routed to the healthy backends able to serve their ``requirements``,
+    the less loaded ones first, and ``fn`` is called with the client of the backend. When a backend drops
+    while running a job, the job is sent back to the queue for the other backends.
+
+    When ``fn`` is a coroutine function, it is run in the event loop it is submitted from, so the jobs waiting
+    for webui do not hold any threads (see :meth:`run_async`).
+
+    The jobs can require a ``model`` (checkpoint), which is loaded with ``switch_model`` before they run.
+    The loaded model of each backend is tracked (``current_model`` tells it at the beginning), so it is only
+    switched when needed, and the jobs needing the loaded models take their turns first. A job waits for
+    at most ``max_affinity_wait`` seconds for that, after which it takes its turn anyway.
+    """
+
+    def __init__(self, pool: WebUIPool, max_running: int = 1, max_running_per_user: int = 1,
+                 max_pending_per_user: int = 8,
+                 switch_model: Optional[Callable[[Any, str], Any]] = None,
+                 current_model: Optional[Callable[[Any], Optional[str]]] = None,
+                 max_affinity_wait: float = 30.0):
+        self.pool = pool
+        self.max_running = max_running
+        self.max_running_per_user = max_running_per_user
+        self.max_pending_per_user = max_pending_per_user
+        self.max_affinity_wait = max_affinity_wait
+        self._switch_model = switch_model
+        self._current_model = current_model
+        self._n_switches = 0
+        self._n_switches_skipped = 0
+        self._n_affinity_picks = 0
+        self._n_failovers = 0
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Deque[Job]] = {}
+        # users with pending jobs, the one at the head takes the next turn
+        self._turns: Deque[str] = deque()
+        self._running: Dict[str, int] = {}
+        self._n_running = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_running * len(pool.backends),
+                                            thread_name_prefix='webui_job')
+        pool.add_listener(self._on_backend_change)
+
+    def _eligible_backends(self, requirements: Optional[Dict[str, Iterable[str]]]) -> List[WebUIBackend]:
+        # may fetch the capabilities, so not in the lock
+        backends = self.pool.eligible_backends(requirements)
+        if not backends:
+            raise NoBackendError(f'No webui backend is able to serve the job, requirements: {requirements!r}.')
+        elif not any(backend.healthy for backend in backends):
+            raise NoBackendError(f'All the {plural_word(len(backends), "webui backend")} able to serve the job '
+                                 f'are unreachable, please try again later.')
+        return backends
+
+    def submit(self, user: str, fn: Callable, *args, model: Optional[str] = None,
+               requirements: Optional[Dict[str, Iterable[str]]] = None, **kwargs) -> Job:
+        backends = self._eligible_backends(requirements)
+        loop = asyncio.get_running_loop() if asyncio.iscoroutinefunction(fn) else None
+        return self._enqueue(Job(self, user, fn, args, kwargs, model=model, backends=backends, loop=loop))
+
+    async def submit_async(self, user: str, fn: Callable, *args, model: Optional[str] = None,
+                           requirements: Optional[Dict[str, Iterable[str]]] = None, **kwargs) -> Job:
+        """
+        Asyncio version of :meth:`submit`, the capabilities are looked up in a worker thread.
+        """
+        backends = await asyncio.to_thread(self._eligible_backends, requirements)
+        loop = asyncio.get_running_loop() if asyncio.iscoroutinefunction(fn) else None
+        return self._enqueue(Job(self, user, fn, args, kwargs, model=model, backends=backends, loop=loop))
+
+    def _enqueue(self, job: Job) -> Job:
+        user = job.user
+        with self._lock:
+            queue = self._pending.setdefault(user, deque())
+            if len(queue) >= self.max_pending_per_user:
+                raise JobQueueFullError(f'Too many jobs of user {user!r} waiting, '
+                                        f'at most {plural_word(self.max_pending_per_user, "job")} allowed.')
+            queue.append(job)
+            if user not in self._turns:
+                self._turns.append(user)
+            self._dispatch()
+        return job
+
+    def _needs_switch(self, job: Job, backend: WebUIBackend) -> bool:
+        return self._switch_model is not None and job.model is not None and job.model != backend.loaded_model
+
+    def _options(self, job: Job, backends: List[WebUIBackend]) -> Tuple[Optional[WebUIBackend], bool]:
+        # the less loaded one of the backends with the model loaded, or an idle one to switch the model
+        backends = [backend for backend in backends if backend in job.backends]
+        ready = [backend for backend in backends if not self._needs_switch(job, backend)]
+        if ready:
+            return min(ready, key=lambda backend: backend.load), False
+        idle = [backend for backend in backends if not backend.n_running]
+        if idle:
+            return min(idle, key=lambda backend: backend.load), True
+        return None, False
+
+    def _next_job(self) -> Optional[Tuple[str, WebUIBackend, bool]]:
+        users = [user for user in self._turns if self._running.get(user, 0) < self.max_running_per_user]
+        free = [backend for backend in self.pool.backends
+                if backend.healthy and not backend.switching and backend.n_running < self.max_running]
+        if not users or not free:
+            return None
+
+        now = time.time()
+        for user in users:
+            job = self._pending[user][0]
+            if now - job.submitted_at > self.max_affinity_wait:
+                backend, switch = self._options(job, free)
+                if backend is not None:
+                    return user, backend, switch
+                # its backends are kept for it, the model is switched after their running jobs
+                free = [backend for backend in free if backend not in job.backends]
+
+        for user in users:
+            job = self._pending[user][0]
+            backend, switch = self._options(job, free)
+            if backend is not None and not switch:
+                if user != users[0] and self._options(self._pending[users[0]][0], free)[1]:
+                    # taking this turn first, the model is not switched back and forth
+                    self._n_affinity_picks += 1
+                return user, backend, False
+        for user in users:
+            backend, switch = self._options(self._pending[user][0], free)
+            if backend is not None:
+                return user, backend, switch
+        return None
+
+    def _dispatch(self):
+        while True:
+            picked = self._next_job()
+            if picked is None:
+                break
+            user, backend, switch = picked
+
+            # the user takes the turn, and waits for the others for the next one
+            queue = self._pending[user]
+            job = queue.popleft()
+            self._turns.remove(user)
+            if queue:
+                self._turns.append(user)
+            else:
+                del self._pending[user]
+            self._n_running += 1
+            self._running[job.user] = self._running.get(job.user, 0) + 1
+            backend.n_running += 1
+            job.backend = backend
+            job.started_at = time.time()
+            if switch:
+                # nothing else starts on the backend until the model is loaded
+                backend.switching = True
+            elif self._switch_model is not None and job.model is not None:
+                self._n_switches_skipped += 1
+            if job.loop is not None:
+                asyncio.run_coroutine_threadsafe(self._run_async(job, backend, switch), job.loop)
+            else:
+                self._executor.submit(self._run, job, backend, switch)
+
+    def _load_model(self, backend: WebUIBackend, model: str):
+        try:
+            loaded_model = backend.loaded_model
+            if loaded_model is None and self._current_model is not None:
+                loaded_model = self._current_model(backend.client)
+            if loaded_model != model:
+                logging.info(f'Switching model of {backend.name!r} from {loaded_model!r} to {model!r}, '
+                             f'{plural_word(self._n_switches, "switch")} done, '
+                             f'{self._n_switches_skipped} skipped and {self._n_affinity_picks} avoided so far ...')
+                self._switch_model(backend.client, model)
+            with self._lock:
+                if loaded_model != model:
+                    self._n_switches += 1
+                else:
+                    self._n_switches_skipped += 1
+                backend.loaded_model = model
+        except BaseException:
+            with self._lock:
+                backend.loaded_model = None
+            raise
+        finally:
+            with self._lock:
+                backend.switching = False
+                self._dispatch()
+
+    def _requeue(self, job: Job, backend: WebUIBackend) -> bool:
+        with self._lock:
+            job.backends = [item for item in job.backends if item is not backend]
+            if not job.backends:
+                return False
+            # back to the head of the queue, it has waited for its turn already
+            self._pending.setdefault(job.user, deque()).appendleft(job)
+            if job.user not in self._turns:
+                self._turns.appendleft(job.user)
+            job.backend, job.started_at = None, None
+            self._n_failovers += 1
+        logging.warning(f'Job {job!r} failed on webui backend {backend.name!r}, '
+                        f'sent back to the queue for the other {plural_word(len(job.backends), "backend")}.')
+        return True
+
+    def _fail(self, job: Job, backend: WebUIBackend, err: BaseException):
+        try:
+            if _is_connection_error(err):
+                self.pool.mark_failed(backend, err)
+                if self._requeue(job, backend):
+                    return
+        except BaseException as fail_err:
+            # the job fails with its own error, or it is never resolved
+            logging.exception(f'Failover of job {job!r} failed: {fail_err!r}')
+        if not job.future.done():
+            job.future.set_exception(err)
+
+    def _release(self, job: Job, backend: WebUIBackend):
+        with self._lock:
+            self._n_running -= 1
+            self._running[job.user] -= 1
+            if not self._running[job.user]:
+                del self._running[job.user]
+            backend.n_running -= 1
+            self._dispatch()
+
+    def _run(self, job: Job, backend: WebUIBackend, switch: bool = False):
+        try:
+            # the ones sent back to the queue are already running
+            if job.future.running() or job.future.set_running_or_notify_cancel():
+                try:
+                    if switch:
+                        self._load_model(backend, job.model)
+                    logging.info(f'Job {job!r} started on {backend.name!r} '
+                                 f'after waiting for {job.started_at - job.submitted_at:.3f}s.')
+                    job.future.set_result(job.fn(backend.client, *job.args, **job.kwargs))
+                except BaseException as err:
+                    self._fail(job, backend, err)
+        finally:
+            self._release(job, backend)
+
+    async def _run_async(self, job: Job, backend: WebUIBackend, switch: bool = False):
+        try:
+            if job.future.running() or job.future.set_running_or_notify_cancel():
+                try:
+                    if switch:
+                        # the switches are rare, and done by the blocking `switch_model`
+                        await asyncio.get_running_loop().run_in_executor(
+                            self._executor, self._load_model, backend, job.model)
+                    logging.info(f'Job {job!r} started on {backend.name!r} '
+                                 f'after waiting for {job.started_at - job.submitted_at:.3f}s.')
+                    job.future.set_result(await job.fn(backend.client, *job.args, **job.kwargs))
+                except BaseException as err:
+                    self._fail(job, backend, err)
+        finally:
+            self._release(job, backend)
+
+    def _on_backend_change(self, backend: WebUIBackend):
+        with self._lock:
+            if not backend.healthy:
+                # may be restarted with another model
+                backend.loaded_model = None
+            self._dispatch()
+
+    def cancel(self, job: Job) -> bool:
+        with self._lock:
+            queue = self._pending.get(job.user)
+            if queue is None or job not in queue:
+                return False
+            queue.remove(job)
+            if not queue:
+                del self._pending[job.user]
+                self._turns.remove(job.user)
+        if job.future.running():
+            # sent back to the queue after a failover
+            job.future.set_exception(CancelledError())
+            return True
+        return job.future.cancel()
+
+    def get_position(self, job: Job) -> int:
+        """
+        Position of the pending ``job`` by the turns of the users, ``1`` for the next one to start,
+        and ``0`` when already started. The limits of running jobs are not taken into account.
+        """
+        with self._lock:
+            queue = self._pending.get(job.user)
+            if queue is None or job not in queue:
+                return 0
+            index = queue.index(job)
+            position, before = index + 1, True
+            for user in self._turns:
+                if user == job.user:
+                    before = False
+                else:
+                    # the users before this one take one more turn before the job
+                    position += min(len(self._pending[user]), index + 1 if before else index)
+            return position
+
+    def run(self, user: str, fn: Callable, *args, model: Optional[str] = None,
+            requirements: Optional[Dict[str, Iterable[str]]] = None,
+            on_wait: Optional[Callable[[int], Any]] = None, poll_interval: float = 0.5, **kwargs):
+        """
+        Submit the job and wait for its result. ``on_wait`` is called with the position of the job
+        every ``poll_interval`` seconds until it starts.
+        """
+        job = self.submit(user, fn, *args, model=model, requirements=requirements, **kwargs)
+        try:
+            while True:
+                position = job.position
+                if position and on_wait:
+                    on_wait(position)
+                try:
+                    return job.result(timeout=poll_interval if position else None)
+                except FutureTimeoutError:
+                    continue
+        finally:
+            # e.g. the waiting is interrupted
+            job.cancel()
+
+    async def run_async(self, user: str, fn: Callable, *args, model: Optional[str] = None,
+                        requirements: Optional[Dict[str, Iterable[str]]] = None,
+                        on_wait: Optional[Callable[[int], Any]] = None, poll_interval: float = 0.5, **kwargs):
+        """
+        Asyncio version of :meth:`run`, ``fn`` is a coroutine function run in the current event loop.
+        """
+        job = await self.submit_async(user, fn, *args, model=model, requirements=requirements, **kwargs)
+        future = asyncio.wrap_future(job.future)
+        try:
+            while True:
+                position = job.position
+                if position and on_wait:
+                    on_wait(position)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), poll_interval if position else None)
+                except asyncio.TimeoutError:
+                    continue
+        finally:
+            job.cancel()
+
+    @property
+    def loaded_models(self) -> Dict[str, Optional[str]]:
+        return {backend.name: backend.loaded_model for backend in self.pool.backends}
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Counts of the jobs and users, with the model ``switches``, the ones skipped as the model is already
+        loaded (``switches_skipped``), the jobs started earlier to avoid a switch (``affinity_picks``),
+        the healthy ``backends`` and the jobs sent to other backends after a failure (``failovers``).
+        """
+        with self._lock:
+            return {
+                'running': self._n_running,
+                'pending': sum(len(queue) for queue in self._pending.values()),
+                'users': len(set(self._pending) | set(self._running)),
+                'switches': self._n_switches,
+                'switches_skipped': self._n_switches_skipped,
+                'affinity_picks': self._n_affinity_picks,
+                'backends': len(self.pool.healthy_backends),
+                'failovers': self._n_failovers,
+            }
+
+
+_SCHEDULER: Optional[JobScheduler] = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_job_scheduler() -> JobScheduler:
+    """
+    Scheduler of the webui jobs, configured with ``WEBUI_JOB_SLOTS`` (running jobs on each backend, ``1`` by
+    default), ``WEBUI_JOB_USER_SLOTS`` (running jobs of each user, ``1`` by default), ``WEBUI_JOB_USER_QUEUE``
+    (waiting jobs of each user, ``8`` by default) and ``WEBUI_JOB_MODEL_WAIT`` (seconds a job can wait
+    for the others using the loaded model, ``30`` by default).
+    """
+    global _SCHEDULER
+    pool = get_webui_pool()
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None or _SCHEDULER.pool is not pool:
+            _SCHEDULER = JobScheduler(
+                pool=pool,
+                max_running=int(os.environ.get('WEBUI_JOB_SLOTS') or 1),
+                max_running_per_user=int(os.environ.get('WEBUI_JOB_USER_SLOTS') or 1),
+                max_pending_per_user=int(os.environ.get('WEBUI_JOB_USER_QUEUE') or 8),
+                switch_model=lambda client, model: client.util_set_model(model),
+                current_model=lambda client: client.util_get_current_model(),
+                max_affinity_wait=float(os.environ.get('WEBUI_JOB_MODEL_WAIT') or 30.0),
+            )
+        return _SCHEDULER
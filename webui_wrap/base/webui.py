@@ -1,60 +1,87 @@
 import logging
 import os
-from functools import lru_cache
-from typing import Optional, Set
+from typing import List, TYPE_CHECKING
 
 from hbutils.system import urlsplit
-from webuiapi import WebUIApi
 
-_WEBUI_CLIENT: Optional[WebUIApi] = None
+if TYPE_CHECKING:
+    from .client import AsyncWebUIApi
 
+# all the webui servers, the first one is the primary
+_WEBUI_CLIENTS: List['AsyncWebUIApi'] = []
+
+
+def _create_client(host="127.0.0.1", port=7860, baseurl=None, use_https=False, **kwargs) -> 'AsyncWebUIApi':
+    """
+    Client of the webui server, the timeouts are set with ``WEBUI_TIMEOUT`` (seconds of each request, no limit
+    by default), ``WEBUI_CONNECT_TIMEOUT`` (``10`` seconds by default) and the keep-alive connections with
+    ``WEBUI_MAX_CONNECTIONS`` (``32`` by default), unless given in ``kwargs``.
+    """
+    from .client import AsyncWebUIApi
 
-def set_webui_server(host="127.0.0.1", port=7860, baseurl=None, use_https=False, **kwargs):
-    global _WEBUI_CLIENT
     logging.info(f'Set webui server {"https" if use_https else "http"}://{host}:{port}/{baseurl or ""}')
-    _WEBUI_CLIENT = WebUIApi(
+    timeout = os.environ.get('WEBUI_TIMEOUT')
+    kwargs.setdefault('timeout', float(timeout) if timeout else None)
+    kwargs.setdefault('connect_timeout', float(os.environ.get('WEBUI_CONNECT_TIMEOUT') or 10.0))
+    kwargs.setdefault('max_connections', int(os.environ.get('WEBUI_MAX_CONNECTIONS') or 32))
+    return AsyncWebUIApi(
         host=host,
         port=port,
         baseurl=baseurl,
         use_https=use_https,
         **kwargs
     )
-    _get_client_scripts.cache_clear()
 
 
-def get_webui_client() -> WebUIApi:
-    if _WEBUI_CLIENT:
-        return _WEBUI_CLIENT
+def set_webui_server(host="127.0.0.1", port=7860, baseurl=None, use_https=False, **kwargs):
+    global _WEBUI_CLIENTS
+    _WEBUI_CLIENTS = [_create_client(host=host, port=port, baseurl=baseurl, use_https=use_https, **kwargs)]
+
+
+def _parse_server(webui_server: str) -> dict:
+    url = urlsplit(webui_server)
+    if ':' in url.host:
+        host, port = url.host.split(':', maxsplit=1)
+        port = int(port)
+    else:
+        host, port = url.host, 80
+    return dict(host=host, port=port, use_https=url.scheme == 'https')
+
+
+def set_webui_servers(webui_servers: List[str], **kwargs):
+    """
+    Use all the given webui servers (e.g. ``http://10.140.1.178:33088``), the jobs are routed to them
+    by the job scheduler.
+    """
+    global _WEBUI_CLIENTS
+    if not webui_servers:
+        raise ValueError('No webui server given.')
+    _WEBUI_CLIENTS = [_create_client(**_parse_server(webui_server), **kwargs) for webui_server in webui_servers]
+
+
+def get_webui_client() -> 'AsyncWebUIApi':
+    if _WEBUI_CLIENTS:
+        return _WEBUI_CLIENTS[0]
     else:
         raise OSError('Webui server not set, please set that with `set_webui_server` function.')
 
 
-@lru_cache()
-def _get_client_scripts() -> Set[str]:
-    client = get_webui_client()
-    scripts = client.get_scripts()['txt2img']
-    return set(map(str.lower, scripts))
+def get_webui_clients() -> List['AsyncWebUIApi']:
+    if _WEBUI_CLIENTS:
+        return list(_WEBUI_CLIENTS)
+    else:
+        raise OSError('Webui server not set, please set that with `set_webui_server` function.')
 
 
 def _set_webui_server_from_env():
-    webui_server = os.environ.get('CH_WEBUI_SERVER')
-    if webui_server:
-        url = urlsplit(webui_server)
-        if ':' in url.host:
-            host, port = url.host.split(':', maxsplit=1)
-            port = int(port)
-        else:
-            host, port = url.host, 80
-
-        set_webui_server(
-            host=host,
-            port=port,
-            use_https=url.scheme == 'https',
-        )
+    # comma-separated, when there are multiple webui servers
+    webui_servers = [item.strip() for item in (os.environ.get('CH_WEBUI_SERVER') or '').split(',') if item.strip()]
+    if webui_servers:
+        set_webui_servers(webui_servers)
     else:
         logging.info('No webui server settings found.')
 
 
 def auto_init_webui():
-    if not _WEBUI_CLIENT:
+    if not _WEBUI_CLIENTS:
         _set_webui_server_from_env()
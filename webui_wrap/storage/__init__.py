@@ -1,4 +1,39 @@
-from .base import BaseImageStorage
-from .env import load_storage_from_env, load_recorder_from_env
-from .local import LocalImageStorage
-from .record import ImageRecorder
+from typing import TYPE_CHECKING
+
+from .._lazy import lazy_attrs
+
+# the subsystems (and their heavy dependencies) are only imported at the first access, see PEP 562
+_LAZY_IMPORTS = {
+    'BaseImageStorage': '.base',
+    'ImageCodec': '.codec',
+    'benchmark_codecs': '.codec',
+    'TagCompleter': '.complete',
+    'RecordFilters': '.facet',
+    'load_storage_from_env': '.env',
+    'load_recorder_from_env': '.env',
+    'LocalImageStorage': '.local',
+    'BaseImageRecorder': '.record',
+    'ImageRecorder': '.record',
+    'S3ImageStorage': '.s3',
+    'SQLiteImageRecorder': '.sqlite',
+    'migrate_parquet_to_sqlite': '.sqlite',
+    'TagVocabulary': '.vocab',
+    'compile_vocabulary': '.vocab',
+    'get_tag_vocabulary': '.vocab',
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+if TYPE_CHECKING:
+    from .base import BaseImageStorage
+    from .codec import ImageCodec, benchmark_codecs
+    from .complete import TagCompleter
+    from .facet import RecordFilters
+    from .env import load_storage_from_env, load_recorder_from_env
+    from .local import LocalImageStorage
+    from .record import BaseImageRecorder, ImageRecorder
+    from .s3 import S3ImageStorage
+    from .sqlite import SQLiteImageRecorder, migrate_parquet_to_sqlite
+    from .vocab import TagVocabulary, compile_vocabulary, get_tag_vocabulary
+
+__getattr__, __dir__ = lazy_attrs(__name__, globals(), _LAZY_IMPORTS)
@@ -1,42 +1,138 @@
+import hashlib
+import io
 import os.path
 from contextlib import contextmanager
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, BinaryIO, List
 
 from PIL import Image
-from PIL.PngImagePlugin import PngInfo
 from hbutils.random import random_md5_with_timestamp
 from hbutils.system import TemporaryDirectory
 
+from .codec import ImageCodec, load_meta_text
+
+
+def _is_content_addressed(image_file: str) -> bool:
+    # content-addressed filenames are sha256 hex digests, while the others are `<timestamp>_<md5>`
+    stem = os.path.splitext(image_file)[0]
+    return len(stem) == 64 and '_' not in stem
+
 
 class BaseImageStorage:
+    thumbnail_size: int = 384
+    thumbnail_format: str = 'webp'
+    thumbnail_quality: int = 80
+
+    def __init__(self, content_addressed: bool = False, codec: Optional[ImageCodec] = None, encode_workers: int = 4):
+        self.content_addressed = content_addressed
+        self.codec = codec or ImageCodec()
+        self._encode_pool = ThreadPoolExecutor(max_workers=encode_workers, thread_name_prefix='image_encode')
+
     def _save_file(self, src_filepath: str, path_in_storage: str):
         raise NotImplementedError
 
-    def put_image(self, image: Image.Image, meta_text: Optional[str] = None):
-        image_filename = f'{random_md5_with_timestamp()}.png'
-        prefix = image_filename[:8]
-        image_dst_path = os.path.join(prefix, image_filename)
+    def _save_bytes(self, data: bytes, path_in_storage: str):
+        # fallback for the storages only support file saving
         with TemporaryDirectory() as td:
-            img_file = os.path.join(td, image_filename)
-            if meta_text:
-                info = PngInfo()
-                info.add_text('parameters', meta_text)
-                image.save(img_file, pnginfo=info)
-            else:
-                image.save(img_file)
+            src_filepath = os.path.join(td, os.path.basename(path_in_storage))
+            with open(src_filepath, 'wb') as f:
+                f.write(data)
+            self._save_file(src_filepath, path_in_storage)
+
+    def _save_stream(self, stream: BinaryIO, path_in_storage: str):
+        self._save_bytes(stream.read(), path_in_storage)
+
+    def _exists(self, path_in_storage: str) -> bool:
+        raise NotImplementedError
+
+    def _remove_file(self, path_in_storage: str):
+        raise NotImplementedError
 
-            self._save_file(img_file, image_dst_path)
+    def _image_path(self, image_file: str) -> str:
+        if _is_content_addressed(image_file):
+            return os.path.join('objects', image_file[:2], image_file[2:4], image_file)
+        else:
+            prefix = os.path.splitext(image_file)[0][:8]
+            return os.path.join(prefix, image_file)
+
+    def _thumbnail_path(self, image_file: str) -> str:
+        image_path = self._image_path(image_file)
+        return os.path.join('thumbnails', f'{os.path.splitext(image_path)[0]}.{self.thumbnail_format}')
+
+    def make_thumbnail(self, image: Image.Image) -> Image.Image:
+        thumbnail = image.copy()
+        if thumbnail.mode not in {'RGB', 'RGBA'}:
+            thumbnail = thumbnail.convert('RGBA' if 'A' in thumbnail.getbands() else 'RGB')
+        thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size), Image.LANCZOS)
+        return thumbnail
+
+    def _save_thumbnail(self, image: Image.Image, image_file: str) -> Image.Image:
+        thumbnail = self.make_thumbnail(image)
+        with io.BytesIO() as bf:
+            thumbnail.save(bf, format=self.thumbnail_format, quality=self.thumbnail_quality)
+            self._save_bytes(bf.getvalue(), self._thumbnail_path(image_file))
+        return thumbnail
+
+    def put_image(self, image: Image.Image, meta_text: Optional[str] = None):
+        # encoded in memory, and written to the storage only once
+        data = self.codec.encode(image, meta_text)
+        if self.content_addressed:
+            image_filename = f'{hashlib.sha256(data).hexdigest()}{self.codec.extension}'
+            # identical images are stored only once, and shared by all their records,
+            # writing the same content again (e.g. by another process) is harmless
+            if not self._exists(self._image_path(image_filename)):
+                self._save_bytes(data, self._image_path(image_filename))
+                self._save_thumbnail(image, image_filename)
+        else:
+            image_filename = f'{random_md5_with_timestamp()}{self.codec.extension}'
+            self._save_bytes(data, self._image_path(image_filename))
+            self._save_thumbnail(image, image_filename)
 
         return image_filename
 
+    def put_images(self, images: List[Image.Image], meta_texts: Optional[List[Optional[str]]] = None) -> List[str]:
+        """
+        Store a batch of images, which are encoded in parallel.
+        """
+        meta_texts = meta_texts or [None] * len(images)
+        return list(self._encode_pool.map(self.put_image, images, meta_texts))
+
+    def release_image(self, image_file: str):
+        """
+        Remove the image and its thumbnail. Content-addressed images are shared by the records,
+        so use :meth:`BaseImageRecorder.release_image` to remove them only when no records reference them.
+        """
+        self._remove_file(self._image_path(image_file))
+        if self._exists(self._thumbnail_path(image_file)):
+            self._remove_file(self._thumbnail_path(image_file))
+
     @contextmanager
     def _load_file(self, path_in_storage: str):
         raise NotImplementedError
 
+    @contextmanager
+    def _open_stream(self, path_in_storage: str) -> BinaryIO:
+        # fallback for the storages only support file loading
+        with self._load_file(path_in_storage) as src_filepath:
+            with open(src_filepath, 'rb') as f:
+                yield f
+
     def get_image(self, image_file: str) -> Image.Image:
-        prefix = os.path.splitext(image_file)[0][:8]
-        image_dst_path = os.path.join(prefix, image_file)
-        with self._load_file(image_dst_path) as imgfile:
-            image = Image.open(imgfile)
+        with self._open_stream(self._image_path(image_file)) as f:
+            image = Image.open(f)
             image.load()
+            if 'parameters' not in image.info:
+                meta_text = load_meta_text(image)
+                if meta_text:
+                    image.info['parameters'] = meta_text
             return image
+
+    def get_thumbnail(self, image_file: str) -> Image.Image:
+        try:
+            with self._open_stream(self._thumbnail_path(image_file)) as f:
+                thumbnail = Image.open(f)
+                thumbnail.load()
+                return thumbnail
+        except FileNotFoundError:
+            # images stored before the thumbnail tier existed get their thumbnails on first read
+            return self._save_thumbnail(self.get_image(image_file), image_file)
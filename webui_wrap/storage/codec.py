@@ -0,0 +1,94 @@
+import io
+import time
+from typing import Optional, List
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+_EXIF_IFD = 0x8769
+_EXIF_USER_COMMENT = 0x9286
+_USER_COMMENT_UNICODE = b'UNICODE\0'
+
+
+class ImageCodec:
+    """
+    Encoding policy of the stored images. PNG keeps the ``parameters`` text in a text chunk, while lossless WebP
+    keeps it in the EXIF user comment, the same way as A1111 WebUI does.
+    """
+
+    def __init__(self, format: str = 'png', compress_level: int = 6, optimize: bool = False,
+                 webp_method: int = 4, webp_quality: int = 80):
+        self.format = format.lower()
+        if self.format not in {'png', 'webp'}:
+            raise ValueError(f'Unsupported image format for storage - {format!r}.')
+        self.compress_level = compress_level
+        self.optimize = optimize
+        self.webp_method = webp_method
+        self.webp_quality = webp_quality
+
+    def __repr__(self):
+        if self.format == 'png':
+            return f'<{self.__class__.__name__} png, compress_level: {self.compress_level}, ' \
+                   f'optimize: {self.optimize}>'
+        else:
+            return f'<{self.__class__.__name__} webp (lossless), method: {self.webp_method}, ' \
+                   f'quality: {self.webp_quality}>'
+
+    @property
+    def extension(self) -> str:
+        return f'.{self.format}'
+
+    def encode(self, image: Image.Image, meta_text: Optional[str] = None) -> bytes:
+        with io.BytesIO() as bf:
+            if self.format == 'png':
+                info = None
+                if meta_text:
+                    info = PngInfo()
+                    info.add_text('parameters', meta_text)
+                image.save(bf, format='png', pnginfo=info, compress_level=self.compress_level,
+                           optimize=self.optimize)
+            else:
+                exif = Image.Exif()
+                if meta_text:
+                    exif.get_ifd(_EXIF_IFD)[_EXIF_USER_COMMENT] = _USER_COMMENT_UNICODE + meta_text.encode('utf-16-be')
+                image.save(bf, format='webp', lossless=True, method=self.webp_method, quality=self.webp_quality,
+                           exif=exif.tobytes())
+            return bf.getvalue()
+
+
+def load_meta_text(image: Image.Image) -> Optional[str]:
+    """
+    Get the ``parameters`` text of image, from the PNG text chunk or the EXIF user comment.
+    """
+    if image.info.get('parameters'):
+        return image.info['parameters']
+
+    user_comment = image.getexif().get_ifd(_EXIF_IFD).get(_EXIF_USER_COMMENT)
+    if isinstance(user_comment, bytes):
+        if user_comment.startswith(_USER_COMMENT_UNICODE):
+            return user_comment[len(_USER_COMMENT_UNICODE):].decode('utf-16-be', errors='ignore')
+        else:
+            return user_comment[8:].decode('utf-8', errors='ignore')
+    elif isinstance(user_comment, str):
+        return user_comment
+    else:
+        return None
+
+
+def benchmark_codecs(images: List[Image.Image], codecs: List[ImageCodec], meta_text: Optional[str] = None) \
+        -> List[dict]:
+    """
+    Encode the images with each codec, and report the average bytes and milliseconds per image.
+    """
+    retval = []
+    for codec in codecs:
+        total_bytes, start_time = 0, time.perf_counter()
+        for image in images:
+            total_bytes += len(codec.encode(image, meta_text))
+        duration = time.perf_counter() - start_time
+        retval.append({
+            'codec': repr(codec),
+            'bytes_per_image': total_bytes / max(len(images), 1),
+            'ms_per_image': duration * 1000.0 / max(len(images), 1),
+        })
+    return retval
@@ -0,0 +1,77 @@
+import bisect
+from typing import Dict, List
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .vocab import TagVocabulary, _SortedStrings
+
+# larger than any character, so that ``prefix + _MAX_CHAR`` is after all the strings starting with ``prefix``
+_MAX_CHAR = '\U0010ffff'
+
+
+class TagCompleter:
+    """
+    Prefix index for completing the tags in queries. The names and aliases of the tags in the local records
+    are suggested first, ranked by their local counts, and then the other ones in the vocabulary alphabetically.
+    Both are sorted arrays searched with :mod:`bisect`, so each completion takes only a few binary searches.
+    """
+
+    def __init__(self, vocabulary: TagVocabulary, tag_counts: Dict[str, int]):
+        aliases = vocabulary.aliases
+        local_names = pa.array(list(tag_counts), type=pa.string())
+        local_aliases = aliases.filter(pc.is_in(aliases.column('name'), value_set=local_names))
+        pairs = dict(zip(local_aliases.column('alias').to_pylist(), local_aliases.column('name').to_pylist()))
+        for tag in tag_counts:
+            # the tags unknown to the vocabulary can still be completed by their own names
+            pairs.setdefault(tag, tag)
+
+        self._local_keys = sorted(pairs)
+        self._local_names = [pairs[key] for key in self._local_keys]
+        # ranked by the count, then the names before their aliases, then alphabetically
+        counts = np.array([tag_counts[name] for name in self._local_names], dtype=np.int64)
+        is_alias = np.array([key != name for key, name in zip(self._local_keys, self._local_names)], dtype=bool)
+        self._local_counts = counts
+        self._local_rank = np.empty((len(counts),), dtype=np.int64)
+        self._local_rank[np.lexsort((np.arange(len(counts)), is_alias, -counts))] = np.arange(len(counts))
+
+        if aliases.num_rows > 0:
+            self._vocab_keys = _SortedStrings(aliases.column('alias').chunk(0))
+            self._vocab_names = aliases.column('name').chunk(0)
+        else:
+            self._vocab_keys, self._vocab_names = [], None
+
+    def __len__(self):
+        return len(self._local_keys) + len(self._vocab_keys)
+
+    def complete(self, prefix: str, limit: int = 10) -> List[dict]:
+        """
+        Up to ``limit`` completions of ``prefix``, with the completed ``tag`` (name or alias), the ``name`` it
+        resolves to and the local ``count``. Each name is suggested only once.
+        """
+        if not prefix or limit <= 0:
+            return []
+
+        results, names = [], set()
+        lo = bisect.bisect_left(self._local_keys, prefix)
+        hi = bisect.bisect_left(self._local_keys, prefix + _MAX_CHAR, lo)
+        for index in (lo + np.argsort(self._local_rank[lo:hi], kind='stable')).tolist():
+            name = self._local_names[index]
+            if name not in names:
+                names.add(name)
+                results.append({'tag': self._local_keys[index], 'name': name,
+                                'count': int(self._local_counts[index])})
+                if len(results) >= limit:
+                    return results
+
+        lo = bisect.bisect_left(self._vocab_keys, prefix)
+        hi = bisect.bisect_left(self._vocab_keys, prefix + _MAX_CHAR, lo)
+        for index in range(lo, hi):
+            name = self._vocab_names[index].as_py()
+            if name not in names:
+                names.add(name)
+                results.append({'tag': self._vocab_keys[index], 'name': name, 'count': 0})
+                if len(results) >= limit:
+                    break
+        return results
@@ -1,28 +1,60 @@
 import os
 from functools import lru_cache
+from typing import TYPE_CHECKING
 
 from .base import BaseImageStorage
+from .codec import ImageCodec
 from .local import LocalImageStorage
-from .record import ImageRecorder
+from .._env import env_flag
+
+if TYPE_CHECKING:
+    from .record import BaseImageRecorder
+
+
+def _load_codec_from_env() -> ImageCodec:
+    return ImageCodec(
+        format=os.environ.get('IMG_STORAGE_FORMAT') or 'png',
+        compress_level=int(os.environ.get('IMG_STORAGE_PNG_LEVEL') or '6'),
+        optimize=env_flag('IMG_STORAGE_PNG_OPTIMIZE'),
+    )
 
 
 @lru_cache()
 def load_storage_from_env() -> BaseImageStorage:
-    if os.environ.get('LOCAL_IMG_STORAGE_DIR'):
-        return LocalImageStorage(os.environ.get('LOCAL_IMG_STORAGE_DIR'))
+    content_addressed = env_flag('IMG_STORAGE_DEDUP')
+    codec = _load_codec_from_env()
+    if os.environ.get('S3_IMG_STORAGE_BUCKET'):
+        from .s3 import S3ImageStorage
+        # credentials are read by boto3 itself, e.g. from AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY
+        return S3ImageStorage(
+            bucket=os.environ.get('S3_IMG_STORAGE_BUCKET'),
+            prefix=os.environ.get('S3_IMG_STORAGE_PREFIX') or '',
+            endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None,
+            region_name=os.environ.get('S3_REGION') or None,
+            cache_dir=os.environ.get('S3_IMG_CACHE_DIR') or None,
+            cache_max_bytes=int(os.environ.get('S3_IMG_CACHE_MAX_BYTES') or str(2 * 1024 ** 3)),
+            content_addressed=content_addressed,
+            codec=codec,
+        )
+    elif os.environ.get('LOCAL_IMG_STORAGE_DIR'):
+        return LocalImageStorage(os.environ.get('LOCAL_IMG_STORAGE_DIR'),
+                                 content_addressed=content_addressed, codec=codec)
     else:
-        return LocalImageStorage(os.path.abspath('images'))
+        return LocalImageStorage(os.path.abspath('images'), content_addressed=content_addressed, codec=codec)
 
 
 @lru_cache()
-def load_recorder_from_env() -> ImageRecorder:
-    if os.environ.get('LOCAL_IMG_STORAGE_DIR'):
-        return ImageRecorder(
+def load_recorder_from_env() -> 'BaseImageRecorder':
+    root_dir = os.environ.get('LOCAL_IMG_STORAGE_DIR') or os.path.abspath('images')
+    if (os.environ.get('IMG_RECORDER') or 'parquet').lower() == 'sqlite':
+        from .sqlite import SQLiteImageRecorder
+        return SQLiteImageRecorder(
             storage=load_storage_from_env(),
-            root_dir=os.environ.get('LOCAL_IMG_STORAGE_DIR'),
+            db_file=os.path.join(root_dir, 'records.sqlite3'),
         )
     else:
+        from .record import ImageRecorder
         return ImageRecorder(
             storage=load_storage_from_env(),
-            root_dir=os.path.abspath('images'),
+            root_dir=root_dir,
         )
@@ -0,0 +1,145 @@
+from array import array
+from typing import Optional, List, Iterable, Dict
+
+import numpy as np
+import pyarrow as pa
+
+
+class RecordFilters:
+    """
+    Filters on the facets of records, the unset ones are not checked.
+    Sizes are inclusive ranges in pixels, and ``since``/``until`` are unix timestamps of ``created_at``.
+    """
+
+    def __init__(self, ratings: Optional[List[str]] = None, models: Optional[List[str]] = None,
+                 samplers: Optional[List[str]] = None, min_width: Optional[int] = None, max_width: Optional[int] = None,
+                 min_height: Optional[int] = None, max_height: Optional[int] = None,
+                 since: Optional[float] = None, until: Optional[float] = None):
+        self.ratings = list(ratings) if ratings else None
+        self.models = list(models) if models else None
+        self.samplers = list(samplers) if samplers else None
+        self.min_width = min_width
+        self.max_width = max_width
+        self.min_height = min_height
+        self.max_height = max_height
+        self.since = since
+        self.until = until
+
+    def __bool__(self):
+        return any(value is not None for value in vars(self).values())
+
+    def __repr__(self):
+        items = ', '.join(f'{key}: {value!r}' for key, value in vars(self).items() if value is not None)
+        return f'<{self.__class__.__name__} {items}>'
+
+
+class CategoryColumn:
+    """
+    Dictionary-encoded column of strings, ``None`` is kept as code ``-1``.
+    """
+
+    def __init__(self):
+        self._codes = array('i')
+        self._values: List[str] = []
+        self._value_codes: Dict[str, int] = {}
+
+    def _code(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        value = str(value)
+        if value not in self._value_codes:
+            self._value_codes[value] = len(self._values)
+            self._values.append(value)
+        return self._value_codes[value]
+
+    def append(self, value: Optional[str]):
+        self._codes.append(self._code(value))
+
+    def extend(self, values: Iterable[Optional[str]]):
+        self._codes.extend(self._code(value) for value in values)
+
+    def codes(self) -> np.ndarray:
+        return np.frombuffer(self._codes, dtype=np.int32)
+
+    def isin(self, rows: np.ndarray, values: List[str]) -> np.ndarray:
+        codes = [self._value_codes[value] for value in values if value in self._value_codes]
+        return np.isin(self.codes()[rows], codes)
+
+    def counts(self) -> Dict[str, int]:
+        codes = self.codes()
+        counts = np.bincount(codes[codes >= 0], minlength=len(self._values))
+        return {value: int(count) for value, count in zip(self._values, counts) if count > 0}
+
+
+class FacetColumns:
+    """
+    Columns of the records which can be filtered, aligned with the row ids, so that the filters are
+    vectorized masks over the rows.
+    """
+
+    def __init__(self):
+        self.rating = CategoryColumn()
+        self.model = CategoryColumn()
+        self.sampler = CategoryColumn()
+        self.width = array('i')
+        self.height = array('i')
+        self.created_at = array('d')
+
+    def __len__(self):
+        return len(self.created_at)
+
+    def append(self, record: dict):
+        self.rating.append(record.get('rating'))
+        self.model.append(record.get('Model'))
+        self.sampler.append(record.get('Sampler'))
+        self.width.append(int(record.get('width') or 0))
+        self.height.append(int(record.get('height') or 0))
+        self.created_at.append(record['created_at'])
+
+    def extend(self, records: List[dict]):
+        for record in records:
+            self.append(record)
+
+    def extend_table(self, table: pa.Table):
+        def _values(name: str) -> list:
+            return table.column(name).to_pylist() if name in table.column_names else [None] * table.num_rows
+
+        self.rating.extend(_values('rating'))
+        self.model.extend(_values('Model'))
+        self.sampler.extend(_values('Sampler'))
+        self.width.extend(int(value or 0) for value in _values('width'))
+        self.height.extend(int(value or 0) for value in _values('height'))
+        self.created_at.extend(_values('created_at'))
+
+    def get_created_at(self, rows: np.ndarray) -> np.ndarray:
+        return np.frombuffer(self.created_at, dtype=np.float64)[rows]
+
+    def filter(self, rows: np.ndarray, filters: Optional[RecordFilters]) -> np.ndarray:
+        """
+        The given rows which match all the ``filters``.
+        """
+        if not filters or len(rows) == 0:
+            return rows
+
+        mask = np.ones((len(rows),), dtype=bool)
+        for column, values in [(self.rating, filters.ratings), (self.model, filters.models),
+                               (self.sampler, filters.samplers)]:
+            if values:
+                mask &= column.isin(rows, values)
+        for column, min_value, max_value in [(self.width, filters.min_width, filters.max_width),
+                                             (self.height, filters.min_height, filters.max_height),
+                                             (self.created_at, filters.since, filters.until)]:
+            if min_value is not None or max_value is not None:
+                values = np.frombuffer(column, dtype=np.float64 if column.typecode == 'd' else np.int32)[rows]
+                if min_value is not None:
+                    mask &= values >= min_value
+                if max_value is not None:
+                    mask &= values <= max_value
+        return rows[mask]
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        return {
+            'rating': self.rating.counts(),
+            'model': self.model.counts(),
+            'sampler': self.sampler.counts(),
+        }
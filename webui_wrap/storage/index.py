@@ -0,0 +1,104 @@
+from array import array
+from typing import Dict, Iterable, List, Union, Optional
+
+import numpy as np
+import pyarrow as pa
+
+TagGroup = Union[str, List[str]]
+
+_META_ROWS = b'webui_wrap.rows'
+
+
+class TagIndex:
+    """
+    Inverted index from tags to the sorted row ids of records containing them.
+    Rows are only appended with increasing ids, so each posting list stays sorted without re-sorting.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, array] = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, row_id: int, tags: Iterable[str]):
+        for tag in tags:
+            if tag not in self._postings:
+                self._postings[tag] = array('q')
+            self._postings[tag].append(row_id)
+        self._size = max(self._size, row_id + 1)
+
+    def add_tags_column(self, tags_column: Iterable[Optional[str]], offset: int = 0):
+        row_id = offset
+        for tags_text in tags_column:
+            self.add(row_id, (tags_text or '').split())
+            row_id += 1
+        self._size = max(self._size, row_id)
+
+    def get(self, tag: str) -> np.ndarray:
+        if tag in self._postings:
+            return np.frombuffer(self._postings[tag], dtype=np.int64).copy()
+        else:
+            return np.array([], dtype=np.int64)
+
+    def count(self, tag: str) -> int:
+        return len(self._postings.get(tag, ()))
+
+    def counts(self) -> Dict[str, int]:
+        return {tag: len(rows) for tag, rows in self._postings.items()}
+
+    def _get_group(self, group: TagGroup) -> np.ndarray:
+        if isinstance(group, str):
+            return self.get(group)
+        else:
+            rows = np.array([], dtype=np.int64)
+            for tag in group:
+                rows = np.union1d(rows, self.get(tag))
+            return rows
+
+    def query(self, groups: List[TagGroup], neg_groups: List[TagGroup]) -> np.ndarray:
+        """
+        Row ids matching all of ``groups`` and none of ``neg_groups``, in ascending order.
+        A group is either a single tag, or a list of tags meaning any one of them.
+        """
+        if groups:
+            # intersect from the smallest posting list, so the intermediate results stay small
+            postings = sorted((self._get_group(group) for group in groups), key=len)
+            rows = postings[0]
+            for item in postings[1:]:
+                if len(rows) == 0:
+                    break
+                rows = np.intersect1d(rows, item, assume_unique=True)
+        else:
+            rows = np.arange(self._size, dtype=np.int64)
+
+        for group in neg_groups:
+            if len(rows) == 0:
+                break
+            rows = np.setdiff1d(rows, self._get_group(group), assume_unique=True)
+        return rows
+
+    def to_table(self, metadata: Optional[Dict[bytes, bytes]] = None) -> pa.Table:
+        tags = list(self._postings.keys())
+        offsets = np.cumsum([0, *(len(self._postings[tag]) for tag in tags)], dtype=np.int32)
+        values = np.concatenate([self.get(tag) for tag in tags]) if tags else np.array([], dtype=np.int64)
+        table = pa.Table.from_arrays(
+            [pa.array(tags, type=pa.string()), pa.ListArray.from_arrays(pa.array(offsets), pa.array(values))],
+            names=['tag', 'rows'],
+        )
+        return table.replace_schema_metadata({
+            **(metadata or {}),
+            _META_ROWS: str(self._size).encode(),
+        })
+
+    @classmethod
+    def from_table(cls, table: pa.Table) -> 'TagIndex':
+        index = cls()
+        rows_column = table.column('rows').combine_chunks()
+        offsets = rows_column.offsets.to_numpy()
+        values = rows_column.values.to_numpy()
+        for i, tag in enumerate(table.column('tag').to_pylist()):
+            index._postings[tag] = array('q', values[offsets[i]:offsets[i + 1]].tobytes())
+        index._size = int((table.schema.metadata or {}).get(_META_ROWS, b'0'))
+        return index
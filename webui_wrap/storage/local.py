@@ -1,12 +1,17 @@
 import os
 import shutil
 from contextlib import contextmanager
+from typing import BinaryIO, Optional
 
 from .base import BaseImageStorage
+from .codec import ImageCodec
 
 
 class LocalImageStorage(BaseImageStorage):
-    def __init__(self, storage_root: str):
+    def __init__(self, storage_root: str, content_addressed: bool = False, codec: Optional[ImageCodec] = None,
+                 encode_workers: int = 4):
+        BaseImageStorage.__init__(self, content_addressed=content_addressed, codec=codec,
+                                  encode_workers=encode_workers)
         self.storage_root = storage_root
         os.makedirs(self.storage_root, exist_ok=True)
 
@@ -16,7 +21,37 @@ class LocalImageStorage(BaseImageStorage):
             os.makedirs(os.path.dirname(dst_filepath), exist_ok=True)
         shutil.copyfile(src_filepath, dst_filepath)
 
+    def _save_bytes(self, data: bytes, path_in_storage: str):
+        dst_filepath = os.path.join(self.storage_root, path_in_storage)
+        if os.path.dirname(dst_filepath):
+            os.makedirs(os.path.dirname(dst_filepath), exist_ok=True)
+        # written to a temporary file in the destination directory, readers never see a partial file
+        tmp_filepath = f'{dst_filepath}.{os.urandom(4).hex()}.tmp'
+        with open(tmp_filepath, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filepath, dst_filepath)
+
+    def _save_stream(self, stream: BinaryIO, path_in_storage: str):
+        dst_filepath = os.path.join(self.storage_root, path_in_storage)
+        if os.path.dirname(dst_filepath):
+            os.makedirs(os.path.dirname(dst_filepath), exist_ok=True)
+        tmp_filepath = f'{dst_filepath}.{os.urandom(4).hex()}.tmp'
+        with open(tmp_filepath, 'wb') as f:
+            shutil.copyfileobj(stream, f)
+        os.replace(tmp_filepath, dst_filepath)
+
+    def _exists(self, path_in_storage: str) -> bool:
+        return os.path.exists(os.path.join(self.storage_root, path_in_storage))
+
+    def _remove_file(self, path_in_storage: str):
+        os.remove(os.path.join(self.storage_root, path_in_storage))
+
     @contextmanager
     def _load_file(self, path_in_storage: str):
         dst_filepath = os.path.join(self.storage_root, path_in_storage)
         yield dst_filepath
+
+    @contextmanager
+    def _open_stream(self, path_in_storage: str) -> BinaryIO:
+        with open(os.path.join(self.storage_root, path_in_storage), 'rb') as f:
+            yield f
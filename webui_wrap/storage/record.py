@@ -1,136 +1,100 @@
+import atexit
 import io
 import json
 import logging
 import os.path
 import time
-from functools import lru_cache
-from threading import Lock
-from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, Event, Thread, Condition
+from typing import Optional, List, Tuple, Union, Dict
 from urllib.parse import quote_plus
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from PIL import Image
+from filelock import FileLock
 from hbutils.string import plural_word
-from huggingface_hub import hf_hub_download
-from imgutils.sd import parse_sdmeta_from_text
-from imgutils.tagging import get_wd14_tags
-from imgutils.tagging.wd14 import MODEL_NAMES
 
 from .base import BaseImageStorage
+from .complete import TagCompleter
+from .facet import FacetColumns, RecordFilters
+from .index import TagIndex, TagGroup
+from .schema import type_parameters, records_to_table, normalize_table
+from .table import RecordTable
+from .tagging import get_wd14_tags_batch, _TAGGER_MODEL
+from .vector import EmbeddingStore, normalize_embedding
+from .vocab import get_tag_vocabulary
 
-_TAGGER_MODEL = 'SwinV2_v3'
+PageCursor = Tuple[float, Union[int, str]]
 
+_META_LAST_SEGMENT = b'webui_wrap.last_segment'
+_META_SEGMENTS = b'webui_wrap.segments'
+_META_EMBEDDINGS = b'webui_wrap.embeddings'
+_MAX_BASE_SEGMENTS = 4096
+_COMPLETER_TTL = 30.0
 
-def _value_safe(x):
-    if isinstance(x, (type(None), int, float, str)):
-        return x
-    else:
-        return json.dumps(x)
 
+def _write_parquet_atomic(table: pa.Table, dst_file: str):
+    tmp_file = f'{dst_file}.{os.urandom(4).hex()}.tmp'
+    pq.write_table(table, tmp_file)
+    os.replace(tmp_file, dst_file)
 
-@lru_cache()
-def _load_tags_database():
-    df_tags = pd.read_csv(hf_hub_download(
-        repo_id='deepghs/wd14_tagger_with_embeddings',
-        repo_type='model',
-        filename=f'{MODEL_NAMES[_TAGGER_MODEL]}/tags_info.csv',
-    ))
-    df_tags = df_tags.replace(np.NaN, None)
-    df_tags = df_tags[df_tags['category'].isin({0, 4})]
 
-    retval = {}
-    for item in df_tags.to_dict('records'):
-        for name in json.loads(item['aliases']):
-            retval[name] = item
+def _read_parquet(src_file: str) -> pa.Table:
+    # read through one file handle, as the shared files may be replaced between the opens of pyarrow
+    with pa.OSFile(src_file) as f:
+        return pq.read_table(f)
 
-    return retval
 
+def _write_npy_atomic(array_: np.ndarray, dst_file: str):
+    tmp_file = f'{dst_file}.{os.urandom(4).hex()}.tmp.npy'
+    np.save(tmp_file, array_)
+    os.replace(tmp_file, dst_file)
 
-@lru_cache()
-def _load_general_tags_info():
-    df_general_tags = pd.read_csv(hf_hub_download(
-        repo_id='deepghs/tags_meta',
-        repo_type='dataset',
-        filename='general_tags.csv',
-    ))
-    df_general_tags = df_general_tags.replace(np.NaN, None)
-    return {item['name']: item for item in df_general_tags.to_dict('records')}
 
+def _segment_seq(name: str) -> int:
+    # segments are named by their zero-padded sequence numbers
+    return int(name)
 
-@lru_cache()
-def _load_character_tags_info():
-    df_character_tags = pd.read_csv(hf_hub_download(
-        repo_id='deepghs/tags_meta',
-        repo_type='dataset',
-        filename='character_tags.csv',
-    ))
-    df_character_tags = df_character_tags.replace(np.NaN, None)
-    return {item['name']: item for item in df_character_tags.to_dict('records')}
 
+class BaseImageRecorder:
+    """
+    Records of the stored images, with their tags, generation parameters and embeddings.
+    Tagging and the background recordings are shared here, while the subclasses decide how records are kept.
+    """
 
-class ImageRecorder:
-    def __init__(self, storage: BaseImageStorage, root_dir: str):
+    def __init__(self, storage: BaseImageStorage, record_workers: int = 4):
         self.image_storage = storage
-        self._root_dir = root_dir
-        os.makedirs(self._root_dir, exist_ok=True)
-
-        self._records_file = os.path.join(self._root_dir, 'records.parquet')
-        self._records = []
-        self._df_records = pd.DataFrame(self._records)
-
-        self._tags_file = os.path.join(self._root_dir, 'tags.parquet')
-        self._d_tags = {}
-        self._df_tags = pd.DataFrame(list(self._d_tags.values()))
-
-        self._has_untransed_data = False
-        self._lock = Lock()
-        self._sync_from_local()
-
-    def _sync_from_local(self):
-        if os.path.exists(self._records_file):
-            self._df_records = pd.read_parquet(self._records_file)
-            self._df_records = self._df_records.replace(np.NaN, None)
-        else:
-            self._df_records = pd.DataFrame([])
-        self._records = self._df_records.to_dict('records')
-
-        if os.path.exists(self._tags_file):
-            self._df_tags = pd.read_parquet(self._tags_file)
-            self._df_tags = self._df_tags.replace(np.NaN, None)
-        else:
-            self._df_tags = pd.DataFrame([])
-        self._d_tags = {item['tag']: item for item in self._df_tags.to_dict('records')}
-        self._has_untransed_data = False
-
-    def _sync_dataframes(self):
-        if self._has_untransed_data:
-            self._df_records = pd.DataFrame(self._records)
-            self._df_records = self._df_records.sort_values(by=['created_at'], ascending=[False])
-            self._df_tags = pd.DataFrame(list(self._d_tags.values()))
-            self._df_tags = self._df_tags.sort_values(by=['count', 'tag', 'type'], ascending=[False, True, True])
-            self._has_untransed_data = False
-
-    def _save_to_local(self):
-        self._sync_dataframes()
-        self._df_records.to_parquet(self._records_file, engine='pyarrow', index=False)
-        self._df_tags.to_parquet(self._tags_file, engine='pyarrow', index=False)
-
-    def put_image(self, image: Image.Image, meta_text: Optional[str] = None):
-        with self._lock:
-            ratings, general, character, embedding = get_wd14_tags(
-                image,
-                fmt=('rating', 'general', 'character', 'embedding'),
-                model_name=_TAGGER_MODEL,
-            )
+        self._backlog = 0
+        self._backlog_cond = Condition()
+        self._record_pool = ThreadPoolExecutor(max_workers=record_workers, thread_name_prefix='recorder')
+        self._completer: Optional[TagCompleter] = None
+        self._completer_built_at = 0.0
+        self._completer_building = False
+        self._completer_lock = Lock()
+        atexit.register(self.close)
+
+    def _tag_images(self, filenames: List[str], images: List[Image.Image], meta_texts: List[Optional[str]]) \
+            -> List[Tuple[dict, List[Tuple[str, str]], np.ndarray]]:
+        """
+        Tag the images and parse their parameters, returns the records (without ``created_at``),
+        the ``(tag, type)`` pairs and the embedding of each image.
+        """
+        from imgutils.sd import parse_sdmeta_from_text
+
+        tagging_results = get_wd14_tags_batch(images, model_name=_TAGGER_MODEL)
+        items = []
+        for filename, image, meta_text, (ratings, general, character, embedding) \
+                in zip(filenames, images, meta_texts, tagging_results):
             rs = np.array(list(ratings.keys()))
             vs = np.array([ratings.get(r, 0.0) for r in rs])
             rating = str(rs[np.argmax(vs)].item())
 
             metainfo = parse_sdmeta_from_text(meta_text or image.info.get('parameters'))
-            filename = self.image_storage.put_image(image, meta_text)
-
-            self._records.append({
+            record = {
                 'filename': filename,
                 'rating': rating,
                 'tags': ' '.join(['', *general.keys(), *character.keys(), '']),
@@ -138,56 +102,188 @@ class ImageRecorder:
                 'height': image.height,
                 'prompt': metainfo.prompt,
                 'neg_prompt': metainfo.neg_prompt,
-                'created_at': time.time(),
-                **{key: _value_safe(value) for key, value in metainfo.parameters.items()},
-            })
+                **type_parameters(metainfo.parameters),
+            }
             tags_pairs = [
                 *[(tag, 'general') for tag in general.keys()],
                 *[(tag, 'character') for tag in character.keys()],
             ]
-            for tag, tag_type in tags_pairs:
-                if tag not in self._d_tags:
-                    self._d_tags[tag] = {'tag': tag, 'type': tag_type, 'count': 0}
-                self._d_tags[tag]['count'] += 1
-            self._has_untransed_data = True
-            return filename
+            items.append((record, tags_pairs, embedding))
+        return items
 
-    def save(self):
-        with self._lock:
-            self._save_to_local()
+    def _append_records(self, items: List[Tuple[dict, List[Tuple[str, str]], np.ndarray]]):
+        raise NotImplementedError
 
-    def query_with_tags(self, tags: List[str], neg_tags: List[str]) -> List[Image.Image]:
-        _db_tags = _load_tags_database()
-        query_tags, query_neg_tags = [], []
-        for tag in tags:
-            if tag not in _db_tags:
-                logging.warning(f'Tag {tag!r} unrecognizable, it will be ignored.')
-            else:
-                query_tags.append(_db_tags[tag]['name'])
-        for tag in neg_tags:
-            if tag not in _db_tags:
-                logging.warning(f'Negative tag {tag!r} recognizable, it will be ignored.')
-            else:
-                query_neg_tags.append(_db_tags[tag]['name'])
+    def _add_records(self, filenames: List[str], images: List[Image.Image], meta_texts: List[Optional[str]]):
+        # tagging and metadata parsing are done outside the lock, so concurrent recordings do not wait for each other
+        self._append_records(self._tag_images(filenames, images, meta_texts))
 
+    def put_image(self, image: Image.Image, meta_text: Optional[str] = None):
+        return self.put_images([image], [meta_text])[0]
+
+    def put_images(self, images: List[Image.Image], meta_texts: Optional[List[Optional[str]]] = None) -> List[str]:
+        """
+        Store and record a batch of images, the tagger runs once for the whole batch.
+        """
+        meta_texts = meta_texts or [None] * len(images)
+        filenames = self.image_storage.put_images(images, meta_texts)
+        self._add_records(filenames, images, meta_texts)
+        return filenames
+
+    def put_image_async(self, image: Image.Image, meta_text: Optional[str] = None):
+        return self.put_images_async([image], [meta_text])[0]
+
+    def put_images_async(self, images: List[Image.Image],
+                         meta_texts: Optional[List[Optional[str]]] = None) -> List[str]:
+        """
+        Store the images and return their filenames right away, while the tagging and recording are done
+        by the background workers. The records are saved after each batch is recorded.
+        """
+        meta_texts = meta_texts or [None] * len(images)
+        filenames = self.image_storage.put_images(images, meta_texts)
+        with self._backlog_cond:
+            self._backlog += len(images)
+        self._record_pool.submit(self._record_in_background, filenames, images, meta_texts)
+        return filenames
+
+    def _record_in_background(self, filenames: List[str], images: List[Image.Image],
+                              meta_texts: List[Optional[str]]):
+        try:
+            self._add_records(filenames, images, meta_texts)
+            # the backlog may never drain under load, so each batch is saved (as one small segment) at once
+            self.save()
+        except Exception as err:
+            logging.exception(f'Recording of images {filenames!r} failed: {err!r}')
+        finally:
+            with self._backlog_cond:
+                self._backlog -= len(images)
+                if self._backlog == 0:
+                    self._backlog_cond.notify_all()
+
+    @property
+    def backlog(self) -> int:
+        """
+        Number of images waiting to be recorded in background.
+        """
+        with self._backlog_cond:
+            return self._backlog
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for all the background recordings, and save the records.
+        Returns ``False`` if the backlog is not drained in ``timeout`` seconds.
+        """
+        with self._backlog_cond:
+            if not self._backlog_cond.wait_for(lambda: self._backlog == 0, timeout=timeout):
+                return False
+        self.save()
+        return True
+
+    def close(self):
+        self.flush()
+        self._record_pool.shutdown(wait=True)
+
+    def save(self):
+        raise NotImplementedError
+
+    def _resolve_query(self, tags: List[TagGroup], neg_tags: List[TagGroup]) \
+            -> Tuple[List[TagGroup], List[TagGroup]]:
+        vocabulary = get_tag_vocabulary()
+
+        def _resolve(group: TagGroup, desc: str) -> Optional[TagGroup]:
+            names = []
+            for tag in ([group] if isinstance(group, str) else group):
+                item = vocabulary.resolve(tag)
+                if item is None:
+                    logging.warning(f'{desc} {tag!r} unrecognizable, it will be ignored.')
+                else:
+                    names.append(item['name'])
+            if not names:
+                return None
+            return names[0] if isinstance(group, str) else names
+
+        query_tags = [g for g in (_resolve(group, 'Tag') for group in tags) if g is not None]
+        query_neg_tags = [g for g in (_resolve(group, 'Negative tag') for group in neg_tags) if g is not None]
         logging.info(f'Querying with tags: {query_tags!r} and negative tags: {query_neg_tags!r} ...')
-        df_query = self._df_records
-        for tag in query_tags:
-            df_query = df_query[df_query['tags'].str.contains(f' {tag} ', regex=False)]
-        for tag in query_neg_tags:
-            df_query = df_query[~df_query['tags'].str.contains(f' {tag} ', regex=False)]
+        return query_tags, query_neg_tags
+
+    def query_with_tags(self, tags: List[TagGroup], neg_tags: List[TagGroup],
+                        filters: Optional[RecordFilters] = None) -> List[Image.Image]:
+        raise NotImplementedError
+
+    def query_page(self, tags: List[TagGroup], neg_tags: List[TagGroup],
+                   cursor: Optional[PageCursor] = None, limit: int = 40, backward: bool = False,
+                   filters: Optional[RecordFilters] = None) -> List[dict]:
+        raise NotImplementedError
 
-        return [self.image_storage.get_image(filename) for filename in df_query['filename']]
+    def page_cursor(self, record: dict) -> PageCursor:
+        """
+        Cursor of the ``record`` returned by :meth:`query_page`, for the page after (or before) it.
+        """
+        return record['created_at'], record['row']
+
+    def query_similar(self, image: Union[Image.Image, str], k: int = 40) -> List[dict]:
+        raise NotImplementedError
 
     def list_tags(self):
-        return self._df_tags.to_dict('records')
+        raise NotImplementedError
+
+    def _build_completer(self) -> TagCompleter:
+        tag_counts = {}
+        for item in self.list_tags():
+            tag_counts[item['tag']] = tag_counts.get(item['tag'], 0) + item['count']
+        return TagCompleter(get_tag_vocabulary(), tag_counts)
+
+    def _rebuild_completer(self):
+        try:
+            self._completer, self._completer_built_at = self._build_completer(), time.time()
+        finally:
+            self._completer_building = False
+
+    def suggest_tags(self, prefix: str, limit: int = 10) -> List[dict]:
+        """
+        Completions of the tag ``prefix``, see :meth:`TagCompleter.complete`. The index is only built once,
+        and rebuilt in the background for the new records when it is older than ``_COMPLETER_TTL`` seconds.
+        """
+        with self._completer_lock:
+            if self._completer is None:
+                self._completer, self._completer_built_at = self._build_completer(), time.time()
+            elif not self._completer_building and time.time() - self._completer_built_at > _COMPLETER_TTL:
+                self._completer_building = True
+                Thread(target=self._rebuild_completer, name='tag_completer', daemon=True).start()
+            completer = self._completer
+        return completer.complete(prefix, limit)
+
+    def list_facets(self) -> Dict[str, Dict[str, int]]:
+        """
+        Counts of the values of ``rating``, ``model`` and ``sampler`` facets.
+        """
+        raise NotImplementedError
+
+    def _get_tag_count(self, tag: str) -> int:
+        raise NotImplementedError
+
+    def count_refs(self, filename: str) -> int:
+        """
+        Number of the records referencing the image ``filename``.
+        """
+        raise NotImplementedError
+
+    def release_image(self, filename: str) -> bool:
+        """
+        Remove the stored image ``filename`` when no records reference it, the reference count is derived
+        from the records, so it is consistent across the processes sharing them.
+        Return whether it is removed.
+        """
+        if self.count_refs(filename) > 0:
+            return False
+        self.image_storage.release_image(filename)
+        return True
 
     def get_tag_info(self, tag: str):
-        if tag in self._d_tags:
-            count = self._d_tags[tag]['count']
-        else:
-            count = 0
-        tag_category = _load_tags_database()[tag]['category']
+        count = self._get_tag_count(tag)
+        vocabulary = get_tag_vocabulary()
+        tag_category = vocabulary.resolve(tag)['category']
 
         with io.StringIO() as sf:
             print(f'# Tag: {tag}', file=sf)
@@ -201,10 +297,7 @@ class ImageRecorder:
             print(f'Danbooru wiki: [{tag} - wiki]({danbooru_wiki_url})', file=sf)
             print(f'', file=sf)
 
-            if tag_category == 0:
-                tag_info = _load_general_tags_info()[tag]
-            else:
-                tag_info = _load_character_tags_info()[tag]
+            tag_info = vocabulary.get_info(tag, tag_category)
 
             alias_names = json.loads(tag_info['aliases'])
             other_names = json.loads(tag_info['other_names'])
@@ -240,3 +333,606 @@ class ImageRecorder:
                 print(f'', file=sf)
 
             return sf.getvalue()
+
+
+class ImageRecorder(BaseImageRecorder):
+    """
+    Recorder on parquet files, which can be shared by several processes on the same ``root_dir``.
+    Each process appends its own delta segments, and picks up the segments of the others when querying.
+    """
+
+    def __init__(self, storage: BaseImageStorage, root_dir: str, compact_threshold: int = 32,
+                 record_workers: int = 4, refresh_interval: float = 2.0):
+        BaseImageRecorder.__init__(self, storage, record_workers=record_workers)
+        self._root_dir = root_dir
+        os.makedirs(self._root_dir, exist_ok=True)
+
+        # records are stored as a compacted base file plus append-only delta segments,
+        # so that each save only writes the newly added rows
+        self._records_file = os.path.join(self._root_dir, 'records.parquet')
+        self._segments_dir = os.path.join(self._root_dir, 'segments')
+        os.makedirs(self._segments_dir, exist_ok=True)
+        self._records = RecordTable()
+        self._facets = FacetColumns()
+        self._filename_rows = {}
+        self._pending_records = []
+        self._pending_embeddings = []
+        # all the segments not after `_base_seq`, and the ones in `_loaded_seqs` are in memory,
+        # both are only changed inside the save lock
+        self._base_seq = -1
+        self._loaded_seqs = set()
+
+        self._tags_file = os.path.join(self._root_dir, 'tags.parquet')
+        self._tag_types = {}
+        self._tags_index_file = os.path.join(self._root_dir, 'tags_index.parquet')
+        self._tag_index = TagIndex()
+        self._embeddings = EmbeddingStore()
+
+        # the shared files are guarded across processes by the file locks, and across the threads of this process
+        # by the thread locks. The records lock is only held for the short updates (claiming the segment numbers,
+        # replacing the base file and the tags file), while the compaction lock is held by the whole compaction
+        self._file_lock = FileLock(os.path.join(self._root_dir, 'records.lock'))
+        self._file_thread_lock = Lock()
+        self._compact_file_lock = FileLock(os.path.join(self._root_dir, 'compact.lock'))
+        self._compact_lock = Lock()
+        # the saving and refreshing of this process, so its own segments are never loaded again,
+        # the records in memory (`_lock`) are never held while waiting for the files
+        self._save_lock = Lock()
+        self._has_unsaved_tags = False
+        self._lock = Lock()
+        self._sync_from_local()
+        self._refresh_interval = refresh_interval
+        self._last_refresh = time.time()
+
+        self._compact_threshold = compact_threshold
+        self._compact_event = Event()
+        self._closed = False
+        self._compact_thread = Thread(target=self._compact_loop, daemon=True)
+        self._compact_thread.start()
+
+    @contextmanager
+    def _locked_files(self):
+        with self._file_thread_lock, self._file_lock:
+            yield
+
+    @contextmanager
+    def _locked_compaction(self):
+        with self._compact_lock, self._compact_file_lock:
+            yield
+
+    def _read_base_meta(self) -> Tuple[str, Optional[int], List[Tuple[int, int]]]:
+        """
+        Last folded segment of the base file, and the row count of the base file before the listed segments
+        (``None`` when unknown) with the ``(seq, n_rows)`` of the latest segments folded into it.
+        """
+        if os.path.exists(self._records_file):
+            metadata = pq.read_schema(self._records_file).metadata or {}
+            last_segment = metadata.get(_META_LAST_SEGMENT, b'').decode()
+            if _META_SEGMENTS in metadata:
+                meta_segments = json.loads(metadata[_META_SEGMENTS])
+                return last_segment, meta_segments['offset'], [tuple(item) for item in meta_segments['segments']]
+            else:
+                return last_segment, None, []
+        else:
+            return '', 0, []
+
+    def _read_base(self) -> Tuple[pa.Table, str]:
+        if os.path.exists(self._records_file):
+            table = normalize_table(_read_parquet(self._records_file))
+            last_segment = (table.schema.metadata or {}).get(_META_LAST_SEGMENT, b'').decode()
+            return table, last_segment
+        else:
+            return pa.table({}), ''
+
+    def _read_base_snapshot(self) -> Tuple[pa.Table, str, Optional[np.ndarray]]:
+        """
+        The base file with its embeddings, read as one snapshot without any lock. The base file may be replaced
+        by a compaction meanwhile (with the embeddings of the old one removed), then they are read again.
+        """
+
+        def _read():
+            table, last_segment = self._read_base()
+            embeddings = self._load_embeddings(self._base_embeddings_file(last_segment), table.num_rows, mmap=True) \
+                if last_segment else None
+            return table, last_segment, embeddings
+
+        for _ in range(3):
+            base_table, base_segment, base_embeddings = _read()
+            # the base file is replaced before the embeddings of the old one are removed
+            if self._read_base_meta()[0] == base_segment:
+                return base_table, base_segment, base_embeddings
+        with self._locked_compaction():
+            return _read()
+
+    def _list_segments(self, after: int = -1) -> List[str]:
+        names = [
+            os.path.splitext(filename)[0] for filename in os.listdir(self._segments_dir)
+            if filename.endswith('.parquet')
+        ]
+        return sorted((name for name in names if _segment_seq(name) > after), key=_segment_seq)
+
+    def _segment_file(self, name: str) -> str:
+        return os.path.join(self._segments_dir, f'{name}.parquet')
+
+    def _segment_embeddings_file(self, name: str, table: Optional[pa.Table] = None) -> str:
+        metadata = (table.schema.metadata if table is not None else pq.read_schema(self._segment_file(name)).metadata)
+        if metadata and _META_EMBEDDINGS in metadata:
+            return os.path.join(self._segments_dir, metadata[_META_EMBEDDINGS].decode())
+        else:
+            return os.path.join(self._segments_dir, f'{name}.npy')
+
+    def _base_embeddings_file(self, last_segment: str) -> str:
+        return os.path.join(self._root_dir, f'embeddings_{last_segment}.npy')
+
+    def _load_embeddings(self, embeddings_file: str, n_rows: int, mmap: bool = False) -> Optional[np.ndarray]:
+        if os.path.exists(embeddings_file):
+            embeddings = np.load(embeddings_file, mmap_mode='r' if mmap else None)
+            if len(embeddings) == n_rows:
+                return embeddings
+            logging.warning(f'Embeddings file {embeddings_file!r} not aligned with records, it will be ignored.')
+        return None
+
+    def _read_segment(self, name: str) -> Tuple[pa.Table, Optional[np.ndarray]]:
+        table = normalize_table(_read_parquet(self._segment_file(name)))
+        embeddings = self._load_embeddings(self._segment_embeddings_file(name, table), table.num_rows)
+        if embeddings is None and not os.path.exists(self._segment_file(name)):
+            # compacted after the records are read, its embeddings are removed with it
+            raise FileNotFoundError(f'Segment {name!r} compacted while reading.')
+        return table, embeddings
+
+    def _load_base_index(self, base_table: pa.Table, last_segment: str) -> TagIndex:
+        if os.path.exists(self._tags_index_file):
+            table = _read_parquet(self._tags_index_file)
+            if (table.schema.metadata or {}).get(_META_LAST_SEGMENT, b'').decode() == last_segment:
+                index = TagIndex.from_table(table)
+                if len(index) == base_table.num_rows:
+                    return index
+
+        logging.info(f'Tag index {self._tags_index_file!r} is outdated, rebuilding ...')
+        index = TagIndex()
+        if base_table.num_rows > 0:
+            index.add_tags_column(base_table.column('tags').to_pylist())
+        return index
+
+    def _append_loaded(self, table: pa.Table, embeddings: Optional[np.ndarray]):
+        if table.num_rows == 0:
+            return
+        offset = len(self._records)
+        self._tag_index.add_tags_column(table.column('tags').to_pylist(), offset=offset)
+        self._embeddings.seal()
+        self._embeddings.add_chunk(embeddings, table.num_rows)
+        for row, filename in enumerate(table.column('filename').to_pylist(), start=offset):
+            self._filename_rows[filename] = row
+        self._facets.extend_table(table)
+        self._records.extend_table(table)
+
+    def _append_row(self, record: dict, embedding: np.ndarray, tags: List[str]):
+        row = len(self._records)
+        self._records.append(record)
+        self._facets.append(record)
+        self._embeddings.append(embedding)
+        self._filename_rows[record['filename']] = row
+        self._tag_index.add(row, tags)
+
+    def _sync_from_local(self):
+        # nothing is compacted during the full loading, while the others can still save their segments
+        with self._locked_compaction():
+            base_table, last_segment = self._read_base()
+            base_index = self._load_base_index(base_table, last_segment)
+            base_embeddings = self._load_embeddings(self._base_embeddings_file(last_segment), base_table.num_rows,
+                                                    mmap=True) if last_segment else None
+            base_seq = _segment_seq(last_segment) if last_segment else -1
+            segments = [(_segment_seq(name), *self._read_segment(name)) for name in self._list_segments(base_seq)]
+            tag_types = self._read_tag_types()
+
+        with self._lock:
+            self._records = RecordTable()
+            self._facets = FacetColumns()
+            self._filename_rows = {}
+            self._tag_index = base_index
+            self._embeddings = EmbeddingStore()
+            self._embeddings.add_chunk(base_embeddings, base_table.num_rows)
+            if base_table.num_rows > 0:
+                self._filename_rows = {filename: row for row, filename
+                                       in enumerate(base_table.column('filename').to_pylist())}
+                self._facets.extend_table(base_table)
+                self._records.extend_table(base_table)
+            del base_table
+            for _, table, embeddings in segments:
+                self._append_loaded(table, embeddings)
+            # the records added after the last saving are not in any segment yet
+            for record, embedding in zip(self._pending_records, self._pending_embeddings):
+                self._append_row(record, embedding, record['tags'].split())
+            self._tag_types = {**tag_types, **self._tag_types}
+        self._base_seq = base_seq
+        self._loaded_seqs = {seq for seq, _, _ in segments}
+
+    def _read_tag_types(self) -> dict:
+        if os.path.exists(self._tags_file):
+            return {item['tag']: item['type'] for item in _read_parquet(self._tags_file).to_pylist()}
+        else:
+            return {}
+
+    def _read_new_segments(self) -> Optional[Tuple[List[Tuple[int, pa.Table, Optional[np.ndarray]]], int]]:
+        """
+        Read the segments saved by the other processes, returns them with their sequence numbers and the last
+        segment of the base file, or ``None`` when they can not be located, and everything should be reloaded.
+        A :class:`FileNotFoundError` is raised when they are compacted while reading.
+        """
+        segment_names = self._list_segments(self._base_seq)
+        last_segment, offset, base_segments = self._read_base_meta()
+        last_seq = _segment_seq(last_segment) if last_segment else -1
+        loaded = []
+        if last_seq > self._base_seq:
+            # some segments have been folded into the base file, their rows are located by the segment sizes
+            if offset is None or not (offset == 0 or (base_segments and base_segments[0][0] <= self._base_seq)):
+                return None
+            ranges, start = [], offset
+            for seq, n_rows in base_segments:
+                if seq > self._base_seq and seq not in self._loaded_seqs:
+                    ranges.append((seq, start, n_rows))
+                start += n_rows
+            if ranges:
+                table, base_segment, embeddings = self._read_base_snapshot()
+                if base_segment != last_segment:
+                    raise FileNotFoundError(f'Base file {self._records_file!r} replaced while reading.')
+                for seq, start, n_rows in ranges:
+                    loaded.append((
+                        seq, table.slice(start, n_rows),
+                        np.array(embeddings[start:start + n_rows]) if embeddings is not None else None,
+                    ))
+
+        for name in segment_names:
+            seq = _segment_seq(name)
+            if seq > last_seq and seq not in self._loaded_seqs:
+                loaded.append((seq, *self._read_segment(name)))
+        return loaded, last_seq
+
+    def refresh(self, force: bool = True):
+        """
+        Pick up the records saved by the other processes. When ``force`` is not set,
+        it is done at most once in ``refresh_interval`` seconds, and skipped while this process is saving.
+        """
+        if not force and time.time() - self._last_refresh < self._refresh_interval:
+            return
+        if not self._save_lock.acquire(blocking=force):
+            return
+        try:
+            self._last_refresh = time.time()
+            for _ in range(3):
+                try:
+                    new_segments = self._read_new_segments()
+                except FileNotFoundError:
+                    # compacted while reading, the segments will be found in the base file
+                    continue
+                if new_segments is None:
+                    break
+
+                # only the new rows are added inside the lock, the files are read without it
+                loaded, last_seq = new_segments
+                tag_types = self._read_tag_types()
+                with self._lock:
+                    for _, table, embeddings in loaded:
+                        self._append_loaded(table, embeddings)
+                    self._tag_types = {**tag_types, **self._tag_types}
+                self._loaded_seqs.update(seq for seq, _, _ in loaded)
+                if last_seq > self._base_seq:
+                    self._base_seq = last_seq
+                    self._loaded_seqs = {seq for seq in self._loaded_seqs if seq > last_seq}
+                return
+
+            logging.info(f'Records in {self._root_dir!r} can not be refreshed incrementally, reloading ...')
+            self._save_to_local()
+            self._sync_from_local()
+        finally:
+            self._save_lock.release()
+
+    def _next_seq(self) -> int:
+        # called inside the file lock, so no compaction can fold a later segment before this one is linked
+        segment_names = self._list_segments()
+        last_segment, _, _ = self._read_base_meta()
+        seqs = [_segment_seq(name) for name in segment_names]
+        if last_segment:
+            seqs.append(_segment_seq(last_segment))
+        return max(seqs, default=0) + 1
+
+    def _publish_segment(self, table: pa.Table) -> str:
+        """
+        Publish the segment with the next sequence number, which is claimed inside the file lock. Otherwise
+        a compaction may fold the later segments in between, and this one is skipped by all the readers.
+        """
+        tmp_file = os.path.join(self._segments_dir, f'{os.urandom(8).hex()}.tmp')
+        pq.write_table(table, tmp_file)
+        try:
+            with self._locked_files():
+                name = f'{self._next_seq():020d}'
+                os.link(tmp_file, self._segment_file(name))
+                return name
+        finally:
+            os.remove(tmp_file)
+
+    def _save_to_local(self):
+        # called inside the save lock, the records are taken out of the lock, and written without it
+        with self._lock:
+            records, embeddings = self._pending_records, self._pending_embeddings
+            self._pending_records, self._pending_embeddings = [], []
+            self._embeddings.seal()
+            tag_types = dict(self._tag_types) if self._has_unsaved_tags else None
+            self._has_unsaved_tags = False
+
+        try:
+            if records:
+                # embeddings are written before the records, so every visible segment has its embeddings
+                embeddings_filename = f'embeddings_{os.urandom(8).hex()}.npy'
+                _write_npy_atomic(np.stack(embeddings), os.path.join(self._segments_dir, embeddings_filename))
+                table = records_to_table(records)
+                table = table.replace_schema_metadata({_META_EMBEDDINGS: embeddings_filename.encode()})
+                self._loaded_seqs.add(_segment_seq(self._publish_segment(table)))
+                records, embeddings = [], []
+            if tag_types is not None:
+                # tags table is bounded by the tagger's vocabulary, and only keeps the types of tags,
+                # the counts are taken from the tag index
+                with self._locked_files():
+                    tag_types = {**self._read_tag_types(), **tag_types}
+                    df_tags = pd.DataFrame([{'tag': tag, 'type': tag_type} for tag, tag_type in tag_types.items()],
+                                           columns=['tag', 'type'])
+                    _write_parquet_atomic(pa.Table.from_pandas(df_tags, preserve_index=False), self._tags_file)
+                with self._lock:
+                    self._tag_types = {**tag_types, **self._tag_types}
+                tag_types = None
+        finally:
+            if records or tag_types is not None:
+                # saved again the next time
+                with self._lock:
+                    self._pending_records = [*records, *self._pending_records]
+                    self._pending_embeddings = [*embeddings, *self._pending_embeddings]
+                    self._has_unsaved_tags = self._has_unsaved_tags or tag_types is not None
+        self._compact_event.set()
+
+    def _compact_loop(self):
+        while not self._closed:
+            self._compact_event.wait()
+            self._compact_event.clear()
+            if self._closed:
+                break
+            try:
+                self.compact(force=False)
+            except Exception as err:  # pragma: no cover
+                logging.exception(f'Compaction of records failed: {err!r}')
+
+    def compact(self, force: bool = True):
+        """
+        Fold the delta segments into the base records file.
+        When ``force`` is not set, it only happens after ``compact_threshold`` segments piled up.
+        Only one process compacts at a time, the new base file is built without blocking the savings and
+        the queries, and only replaced inside the file lock. The segments saved meanwhile are left for the next one.
+        """
+        with self._locked_compaction():
+            # the base file and the folded segments are only changed by the compactions
+            last_segment, offset, base_segments = self._read_base_meta()
+            segments = self._list_segments(_segment_seq(last_segment) if last_segment else -1)
+            if not segments or (not force and len(segments) < self._compact_threshold):
+                return
+            base_table, _ = self._read_base()
+
+            logging.info(f'Compacting {plural_word(len(segments), "segment")} into {self._records_file!r} ...')
+            segment_tables = [pq.read_table(self._segment_file(name)) for name in segments]
+            segment_embeddings_files = [self._segment_embeddings_file(name, table)
+                                        for name, table in zip(segments, segment_tables)]
+            # the segments (and the base file) in the older layouts are converted here,
+            # so the base file is always written in the typed schema
+            table = pa.concat_tables([
+                normalize_table(item).replace_schema_metadata(None)
+                for item in [base_table, *segment_tables] if item.num_rows > 0
+            ] or [records_to_table([])])
+
+            # the sizes of latest folded segments are kept, so the other processes can find their rows
+            base_segments = [
+                *(base_segments if offset is not None else []),
+                *((_segment_seq(name), segment_table.num_rows)
+                  for name, segment_table in zip(segments, segment_tables)),
+            ]
+            offset = table.num_rows - sum(n_rows for _, n_rows in base_segments[-_MAX_BASE_SEGMENTS:])
+            table = table.replace_schema_metadata({
+                _META_LAST_SEGMENT: segments[-1].encode(),
+                _META_SEGMENTS: json.dumps({
+                    'offset': offset,
+                    'segments': base_segments[-_MAX_BASE_SEGMENTS:],
+                }).encode(),
+            })
+
+            # written under the temporary names (the embeddings under the name of the new base file),
+            # no one reads them before the base file is replaced
+            index = TagIndex()
+            index.add_tags_column(table.column('tags').to_pylist())
+            tmp_index_file = f'{self._tags_index_file}.{os.urandom(4).hex()}.tmp'
+            tmp_records_file = f'{self._records_file}.{os.urandom(4).hex()}.tmp'
+            embeddings_file = self._base_embeddings_file(segments[-1])
+            try:
+                pq.write_table(index.to_table({_META_LAST_SEGMENT: segments[-1].encode()}), tmp_index_file)
+                self._compact_embeddings(base_table.num_rows, last_segment, segments,
+                                         [segment_table.num_rows for segment_table in segment_tables],
+                                         segment_embeddings_files)
+                del base_table, segment_tables, index
+                pq.write_table(table, tmp_records_file)
+                del table
+
+                with self._locked_files():
+                    if self._read_base_meta()[0] != last_segment:  # pragma: no cover
+                        logging.warning(f'Records file {self._records_file!r} changed while compacting, skipped.')
+                        return
+                    os.replace(tmp_index_file, self._tags_index_file)
+                    os.replace(tmp_records_file, self._records_file)
+                    # segments already included in the base file are skipped by readers, so removing them is safe
+                    for name, segment_embeddings_file in zip(segments, segment_embeddings_files):
+                        os.remove(self._segment_file(name))
+                        if os.path.exists(segment_embeddings_file):
+                            os.remove(segment_embeddings_file)
+                    if last_segment and os.path.exists(self._base_embeddings_file(last_segment)):
+                        os.remove(self._base_embeddings_file(last_segment))
+                    embeddings_file = None
+            finally:
+                for file in [tmp_index_file, tmp_records_file, embeddings_file]:
+                    if file and os.path.exists(file):
+                        os.remove(file)
+
+    def close(self):
+        BaseImageRecorder.close(self)
+        # the compaction in progress is finished before exiting, or pyarrow may hang on the interpreter shutdown
+        self._closed = True
+        self._compact_event.set()
+        self._compact_thread.join()
+
+    def _compact_embeddings(self, base_rows: int, last_segment: str, segments: List[str],
+                            segment_rows: List[int], segment_embeddings_files: List[str]):
+        chunks = [(
+            base_rows,
+            self._load_embeddings(self._base_embeddings_file(last_segment), base_rows, mmap=True)
+            if last_segment else None,
+        )]
+        for n_rows, embeddings_file in zip(segment_rows, segment_embeddings_files):
+            chunks.append((n_rows, self._load_embeddings(embeddings_file, n_rows)))
+        dims = [embeddings.shape[1] for _, embeddings in chunks if embeddings is not None]
+        if not dims:
+            return
+
+        # written chunk by chunk into a memory-mapped file, the whole matrix is never loaded into memory
+        embeddings_file = self._base_embeddings_file(segments[-1])
+        tmp_file = f'{embeddings_file}.{os.urandom(4).hex()}.tmp.npy'
+        output = np.lib.format.open_memmap(
+            tmp_file, mode='w+', dtype=np.float16,
+            shape=(sum(n_rows for n_rows, _ in chunks), dims[0]),
+        )
+        offset = 0
+        for n_rows, embeddings in chunks:
+            if embeddings is not None:
+                output[offset:offset + n_rows] = embeddings
+            offset += n_rows
+        output.flush()
+        del output
+        os.replace(tmp_file, embeddings_file)
+
+    def _append_records(self, items: List[Tuple[dict, List[Tuple[str, str]], np.ndarray]]):
+        with self._lock:
+            for record, tags_pairs, embedding in items:
+                record = {**record, 'created_at': time.time()}
+                embedding = normalize_embedding(embedding)
+                self._append_row(record, embedding, [tag for tag, _ in tags_pairs])
+                self._pending_records.append(record)
+                self._pending_embeddings.append(embedding)
+                for tag, tag_type in tags_pairs:
+                    if tag not in self._tag_types:
+                        self._tag_types[tag] = tag_type
+                        self._has_unsaved_tags = True
+
+    def save(self):
+        with self._save_lock:
+            self._save_to_local()
+
+    def query_with_tags(self, tags: List[TagGroup], neg_tags: List[TagGroup],
+                        filters: Optional[RecordFilters] = None) -> List[Image.Image]:
+        """
+        Query images containing all the ``tags`` and none of the ``neg_tags``, latest first.
+        Each item can also be a list of tags, which matches the images with any of them.
+        """
+        query_tags, query_neg_tags = self._resolve_query(tags, neg_tags)
+        self.refresh(force=False)
+        with self._lock:
+            rows = self._facets.filter(self._tag_index.query(query_tags, query_neg_tags), filters)
+            rows = rows[np.lexsort((-rows, -self._facets.get_created_at(rows)))]
+            filenames = self._records.column('filename', rows)
+
+        return [self.image_storage.get_image(filename) for filename in filenames]
+
+    def query_page(self, tags: List[TagGroup], neg_tags: List[TagGroup],
+                   cursor: Optional[PageCursor] = None, limit: int = 40, backward: bool = False,
+                   filters: Optional[RecordFilters] = None) -> List[dict]:
+        """
+        Keyset-paginated version of :meth:`query_with_tags`, only the records are returned, latest first.
+        Records are ordered by ``(created_at, filename)``, and ``cursor`` is that key of the last record of the
+        previous page (or of the first record when ``backward`` is set to page towards the newer ones), see
+        :meth:`page_cursor`. The rows are renumbered when the records are reloaded, so they are not in the key.
+        """
+        query_tags, query_neg_tags = self._resolve_query(tags, neg_tags)
+        self.refresh(force=False)
+        with self._lock:
+            rows = self._facets.filter(self._tag_index.query(query_tags, query_neg_tags), filters)
+            created_at = self._facets.get_created_at(rows)
+            if cursor is not None:
+                c_created_at, c_filename = cursor
+                mask = created_at > c_created_at if backward else created_at < c_created_at
+                # the filenames are only compared on the ties
+                ties = np.flatnonzero(created_at == c_created_at)
+                if len(ties) > 0:
+                    tie_filenames = np.array(self._records.column('filename', rows[ties]), dtype=object)
+                    mask[ties] = tie_filenames > c_filename if backward else tie_filenames < c_filename
+                rows, created_at = rows[mask], created_at[mask]
+
+            if len(rows) > limit:
+                # only the records around the cursor are needed, no need to sort all the matches
+                if not backward:
+                    threshold = np.partition(created_at, len(rows) - limit)[len(rows) - limit]
+                    mask = created_at >= threshold
+                else:
+                    threshold = np.partition(created_at, limit - 1)[limit - 1]
+                    mask = created_at <= threshold
+                rows, created_at = rows[mask], created_at[mask]
+
+            keys = sorted(zip(created_at.tolist(), self._records.column('filename', rows), rows.tolist()),
+                          reverse=not backward)[:limit]
+            rows = np.array([row for _, _, row in (keys if not backward else keys[::-1])], dtype=rows.dtype)
+            return [{**record, 'row': int(row)} for row, record in zip(rows, self._records.take(rows))]
+
+    def page_cursor(self, record: dict) -> PageCursor:
+        return record['created_at'], record['filename']
+
+    def query_similar(self, image: Union[Image.Image, str], k: int = 40) -> List[dict]:
+        """
+        Records most similar to the given image (or filename of a recorded image) by the cosine similarity
+        of WD14 embeddings, with their ``score``. Stored embeddings are used when available.
+        """
+        self.refresh(force=False)
+        with self._lock:
+            # the store and the records are replaced together when reloaded, the rows of the search
+            # are only looked up in the records of the same snapshot
+            store, records = self._embeddings, self._records
+            row = self._filename_rows.get(image) if isinstance(image, str) else None
+        embedding = None
+        if isinstance(image, str):
+            if row is not None:
+                embedding = store.get(row)
+            if embedding is None:
+                image = self.image_storage.get_image(image)
+        if embedding is None:
+            _, _, _, embedding = get_wd14_tags_batch([image], model_name=_TAGGER_MODEL)[0]
+
+        rows, scores = store.search(embedding, k=k)
+        with self._lock:
+            return [
+                {**record, 'row': int(row), 'score': float(score)}
+                for row, score, record in zip(rows, scores, records.take(rows))
+            ]
+
+    def list_tags(self):
+        self.refresh(force=False)
+        with self._lock:
+            tags = [
+                {'tag': tag, 'type': self._tag_types.get(tag, 'general'), 'count': count}
+                for tag, count in self._tag_index.counts().items() if count > 0
+            ]
+        return sorted(tags, key=lambda x: (-x['count'], x['tag'], x['type']))
+
+    def list_facets(self) -> Dict[str, Dict[str, int]]:
+        self.refresh(force=False)
+        with self._lock:
+            return self._facets.counts()
+
+    def _get_tag_count(self, tag: str) -> int:
+        self.refresh(force=False)
+        with self._lock:
+            return self._tag_index.count(tag)
+
+    def count_refs(self, filename: str) -> int:
+        self.refresh(force=False)
+        with self._lock:
+            return self._records.column('filename', range(len(self._records))).count(filename)
@@ -0,0 +1,228 @@
+import io
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock
+from typing import BinaryIO, Optional
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from hbutils.scale import size_to_bytes_str
+from hbutils.system import TemporaryDirectory
+
+from .base import BaseImageStorage
+from .codec import ImageCodec
+
+_NOT_FOUND_CODES = {'404', 'NoSuchKey', 'NotFound'}
+
+
+def _is_not_found(err: ClientError) -> bool:
+    return err.response.get('Error', {}).get('Code') in _NOT_FOUND_CODES
+
+
+class _DiskCache:
+    """
+    Local read-through cache of the storage files, the least recently used files are evicted
+    when the total size exceeds ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()
+        self._total = 0
+        self._lock = Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                filepath = os.path.join(root, filename)
+                if filename.endswith('.tmp'):
+                    os.remove(filepath)
+                else:
+                    stat = os.stat(filepath)
+                    files.append((stat.st_mtime, os.path.relpath(filepath, self.cache_dir), stat.st_size))
+        for _, path, size in sorted(files):
+            self._entries[path] = size
+            self._total += size
+        logging.info(f'Disk cache {self.cache_dir!r} loaded, {size_to_bytes_str(self._total)} in use.')
+
+    def get(self, path: str) -> Optional[str]:
+        with self._lock:
+            if path not in self._entries:
+                return None
+            self._entries.move_to_end(path)
+        filepath = os.path.join(self.cache_dir, path)
+        try:
+            # mtime keeps the access order across restarts
+            os.utime(filepath)
+        except FileNotFoundError:
+            self.discard(path)
+            return None
+        return filepath
+
+    def put(self, path: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        filepath = os.path.join(self.cache_dir, path)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmp_filepath = f'{filepath}.{os.urandom(4).hex()}.tmp'
+        with open(tmp_filepath, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filepath, filepath)
+
+        evicted = []
+        with self._lock:
+            self._total += len(data) - self._entries.pop(path, 0)
+            self._entries[path] = len(data)
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old_path, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(os.path.join(self.cache_dir, old_path))
+            except FileNotFoundError:
+                pass
+
+    def discard(self, path: str):
+        with self._lock:
+            if path not in self._entries:
+                return
+            self._total -= self._entries.pop(path)
+        try:
+            os.remove(os.path.join(self.cache_dir, path))
+        except FileNotFoundError:
+            pass
+
+
+class S3ImageStorage(BaseImageStorage):
+    """
+    Image storage on a S3-compatible bucket. One pooled client is shared by all the threads,
+    uploads of a batch run concurrently on the encoding pool, and large objects are downloaded in parallel ranges.
+    """
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: Optional[str] = None,
+                 region_name: Optional[str] = None, cache_dir: Optional[str] = None,
+                 cache_max_bytes: int = 2 * 1024 ** 3, content_addressed: bool = False,
+                 codec: Optional[ImageCodec] = None, upload_workers: int = 16,
+                 range_size: int = 8 * 1024 ** 2, range_workers: int = 8):
+        BaseImageStorage.__init__(self, content_addressed=content_addressed, codec=codec,
+                                  encode_workers=upload_workers)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.range_size = range_size
+        self._client = boto3.session.Session().client(
+            's3', endpoint_url=endpoint_url, region_name=region_name,
+            config=Config(
+                max_pool_connections=upload_workers + range_workers,
+                retries={'max_attempts': 5, 'mode': 'adaptive'},
+            ),
+        )
+        self._range_pool = ThreadPoolExecutor(max_workers=range_workers, thread_name_prefix='s3_range')
+        self._cache = _DiskCache(cache_dir, cache_max_bytes) if cache_dir else None
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} s3://{self.bucket}/{self.prefix}>'
+
+    def _key(self, path_in_storage: str) -> str:
+        path = path_in_storage.replace(os.sep, '/')
+        return f'{self.prefix}/{path}' if self.prefix else path
+
+    def _cacheable(self, path_in_storage: str) -> bool:
+        return self._cache is not None
+
+    def _save_file(self, src_filepath: str, path_in_storage: str):
+        self._client.upload_file(src_filepath, self.bucket, self._key(path_in_storage))
+        if self._cache is not None:
+            self._cache.discard(path_in_storage)
+
+    def _save_bytes(self, data: bytes, path_in_storage: str):
+        self._client.put_object(Bucket=self.bucket, Key=self._key(path_in_storage), Body=data)
+        if self._cache is not None:
+            self._cache.discard(path_in_storage)
+
+    def _save_stream(self, stream: BinaryIO, path_in_storage: str):
+        self._client.upload_fileobj(stream, self.bucket, self._key(path_in_storage))
+        if self._cache is not None:
+            self._cache.discard(path_in_storage)
+
+    def _exists(self, path_in_storage: str) -> bool:
+        if self._cacheable(path_in_storage) and self._cache.get(path_in_storage):
+            return True
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self._key(path_in_storage))
+            return True
+        except ClientError as err:
+            if _is_not_found(err):
+                return False
+            raise
+
+    def _remove_file(self, path_in_storage: str):
+        self._client.delete_object(Bucket=self.bucket, Key=self._key(path_in_storage))
+        if self._cache is not None:
+            self._cache.discard(path_in_storage)
+
+    def _get_range(self, key: str, start: int, end: int) -> bytes:
+        resp = self._client.get_object(Bucket=self.bucket, Key=key, Range=f'bytes={start}-{end}')
+        return resp['Body'].read()
+
+    def _download(self, path_in_storage: str) -> bytes:
+        key = self._key(path_in_storage)
+        try:
+            # the first range tells the object size, small objects are done in one request
+            resp = self._client.get_object(Bucket=self.bucket, Key=key, Range=f'bytes=0-{self.range_size - 1}')
+        except ClientError as err:
+            if _is_not_found(err):
+                raise FileNotFoundError(f'File {path_in_storage!r} not found in {self!r}.') from err
+            elif err.response.get('Error', {}).get('Code') == 'InvalidRange':  # empty object
+                return b''
+            raise
+
+        with io.BytesIO() as bf:
+            for chunk in resp['Body'].iter_chunks():
+                bf.write(chunk)
+            content_range = resp.get('ContentRange')
+            total_size = int(content_range.split('/')[-1]) if content_range else bf.tell()
+            if total_size > bf.tell():
+                ranges = [(start, min(start + self.range_size, total_size) - 1)
+                          for start in range(bf.tell(), total_size, self.range_size)]
+                for data in self._range_pool.map(lambda r: self._get_range(key, *r), ranges):
+                    bf.write(data)
+            return bf.getvalue()
+
+    @contextmanager
+    def _load_file(self, path_in_storage: str):
+        if self._cacheable(path_in_storage):
+            cached_filepath = self._cache.get(path_in_storage)
+            if not cached_filepath:
+                self._cache.put(path_in_storage, self._download(path_in_storage))
+                cached_filepath = self._cache.get(path_in_storage)
+            if cached_filepath:
+                yield cached_filepath
+                return
+
+        with TemporaryDirectory() as td:
+            dst_filepath = os.path.join(td, os.path.basename(path_in_storage))
+            with open(dst_filepath, 'wb') as f:
+                f.write(self._download(path_in_storage))
+            yield dst_filepath
+
+    @contextmanager
+    def _open_stream(self, path_in_storage: str) -> BinaryIO:
+        if self._cacheable(path_in_storage):
+            cached_filepath = self._cache.get(path_in_storage)
+            if cached_filepath:
+                with open(cached_filepath, 'rb') as f:
+                    yield f
+                return
+
+        data = self._download(path_in_storage)
+        if self._cacheable(path_in_storage):
+            self._cache.put(path_in_storage, data)
+        with io.BytesIO(data) as f:
+            yield f
@@ -0,0 +1,178 @@
+import json
+from typing import List
+
+import pyarrow as pa
+
+# the common generation parameters of webui, the other ones (e.g. of the extensions) are kept in `extra`
+_PARAMETER_FIELDS = [
+    pa.field('Steps', pa.int32()),
+    pa.field('Sampler', pa.string()),
+    pa.field('Schedule type', pa.string()),
+    pa.field('CFG scale', pa.float64()),
+    pa.field('Seed', pa.int64()),
+    pa.field('Size', pa.string()),
+    pa.field('Model hash', pa.string()),
+    pa.field('Model', pa.string()),
+    pa.field('VAE hash', pa.string()),
+    pa.field('VAE', pa.string()),
+    pa.field('Clip skip', pa.int32()),
+    pa.field('Denoising strength', pa.float64()),
+    pa.field('Hires upscale', pa.float64()),
+    pa.field('Hires steps', pa.int32()),
+    pa.field('Hires upscaler', pa.string()),
+    pa.field('Version', pa.string()),
+]
+
+RECORD_SCHEMA = pa.schema([
+    pa.field('filename', pa.string()),
+    pa.field('rating', pa.string()),
+    pa.field('tags', pa.string()),
+    pa.field('width', pa.int32()),
+    pa.field('height', pa.int32()),
+    pa.field('prompt', pa.string()),
+    pa.field('neg_prompt', pa.string()),
+    pa.field('created_at', pa.float64()),
+    *_PARAMETER_FIELDS,
+    # json object of the other parameters
+    pa.field('extra', pa.string()),
+])
+_FIELD_TYPES = {field.name: field.type for field in RECORD_SCHEMA if field.name != 'extra'}
+
+
+def _coerce(value, type_: pa.DataType):
+    if pa.types.is_integer(type_):
+        if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+            raise ValueError(f'Not an integer - {value!r}.')
+        return int(value)
+    elif pa.types.is_floating(type_):
+        if isinstance(value, bool):
+            raise ValueError(f'Not a number - {value!r}.')
+        return float(value)
+    elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+        return str(value)
+    elif isinstance(value, (tuple, list)) and value and all(isinstance(item, int) for item in value):
+        # sizes are parsed as tuples, e.g. ``(512, 768)`` is saved as ``512x768``
+        return 'x'.join(map(str, value))
+    else:
+        raise ValueError(f'Not a text - {value!r}.')
+
+
+def _normalize_size(value):
+    # the older records keep the sizes as json lists, e.g. ``'[512, 768]'``
+    if isinstance(value, str) and value.startswith('['):
+        try:
+            items = json.loads(value)
+        except ValueError:
+            return value
+        if isinstance(items, list) and items and all(isinstance(item, int) for item in items):
+            return 'x'.join(map(str, items))
+    return value
+
+
+def type_parameters(parameters: dict) -> dict:
+    """
+    Generation parameters with the common ones converted to the types of :data:`RECORD_SCHEMA`,
+    the ones can not be converted are kept as they are.
+    """
+    typed = {}
+    for key, value in parameters.items():
+        if key in _FIELD_TYPES and value is not None:
+            try:
+                value = _coerce(value, _FIELD_TYPES[key])
+            except (TypeError, ValueError):
+                pass
+        typed[key] = value
+    return typed
+
+
+def normalize_record(record: dict) -> dict:
+    """
+    Row of :data:`RECORD_SCHEMA` for the record, the values not in its columns (or not of their types)
+    are moved into the ``extra`` json.
+    """
+    row, extra = {}, json.loads(record['extra']) if record.get('extra') else {}
+    for key, value in record.items():
+        if key == 'extra' or value is None:
+            continue
+        if key in _FIELD_TYPES:
+            try:
+                row[key] = _coerce(value, _FIELD_TYPES[key])
+                continue
+            except (TypeError, ValueError):
+                pass
+        extra[key] = value
+    row['extra'] = json.dumps(extra, ensure_ascii=False, sort_keys=True) if extra else None
+    return row
+
+
+def records_to_table(records: List[dict]) -> pa.Table:
+    return pa.Table.from_pylist([normalize_record(record) for record in records], schema=RECORD_SCHEMA)
+
+
+def expand_record(row: dict) -> dict:
+    """
+    Record of the row, with the ``extra`` parameters spread into it.
+    """
+    extra = row.pop('extra', None)
+    if extra:
+        row.update(json.loads(extra))
+    return row
+
+
+def normalize_table(table: pa.Table) -> pa.Table:
+    """
+    Convert the records saved in the older layouts, which have one column for each parameter (with the sizes
+    as json lists), into :data:`RECORD_SCHEMA`. Tables already in it are returned as they are.
+    """
+    if table.schema.remove_metadata().equals(RECORD_SCHEMA):
+        return table
+
+    # the extra parameters of each row, only built when there are any
+    extras: List[dict] = []
+
+    def _extras() -> List[dict]:
+        if not extras:
+            extras.extend({} for _ in range(table.num_rows))
+        return extras
+
+    if 'extra' in table.column_names:
+        for extra, value in zip(_extras(), table.column('extra').to_pylist()):
+            if value:
+                extra.update(json.loads(value))
+
+    columns = []
+    for field in RECORD_SCHEMA:
+        if field.name == 'extra':
+            continue
+        elif field.name not in table.column_names:
+            columns.append(pa.nulls(table.num_rows, type=field.type))
+            continue
+        try:
+            columns.append(table.column(field.name).cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # e.g. a parameter being a number in some images and a text in the others
+            values = []
+            for extra, value in zip(_extras(), table.column(field.name).to_pylist()):
+                try:
+                    values.append(None if value is None else _coerce(value, field.type))
+                except (TypeError, ValueError):
+                    values.append(None)
+                    extra[field.name] = value
+            columns.append(pa.array(values, type=field.type))
+        if field.name == 'Size':
+            columns[-1] = pa.array([_normalize_size(value) for value in columns[-1].to_pylist()], type=field.type)
+
+    for name in table.column_names:
+        if name not in _FIELD_TYPES and name != 'extra':
+            for extra, value in zip(_extras(), table.column(name).to_pylist()):
+                if value is not None:
+                    extra[name] = value
+    if extras:
+        columns.append(pa.array([json.dumps(extra, ensure_ascii=False, sort_keys=True) if extra else None
+                                 for extra in extras], type=pa.string()))
+    else:
+        columns.append(pa.nulls(table.num_rows, type=pa.string()))
+
+    # the pandas metadata of the older layouts describes the columns no longer there
+    metadata = {key: value for key, value in (table.schema.metadata or {}).items() if key != b'pandas'}
+    return pa.Table.from_arrays(columns, schema=RECORD_SCHEMA).replace_schema_metadata(metadata or None)
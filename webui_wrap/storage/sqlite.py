@@ -0,0 +1,361 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from threading import Lock, local
+from typing import List, Optional, Tuple, Union, Dict
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PIL import Image
+from hbutils.string import plural_word
+
+from .base import BaseImageStorage
+from .facet import RecordFilters
+from .index import TagGroup
+from .record import BaseImageRecorder, PageCursor, _META_LAST_SEGMENT, _META_EMBEDDINGS, _TAGGER_MODEL, _segment_seq
+from .schema import normalize_table, expand_record
+from .tagging import get_wd14_tags_batch
+from .vector import normalize_embedding, _top_k
+
+_COLUMNS = ['filename', 'rating', 'tags', 'width', 'height', 'prompt', 'neg_prompt', 'created_at']
+# generation parameters with their own indexed columns, the others are kept in the `extra` json
+_INDEXED_PARAMETERS = {'Model': 'model', 'Sampler': 'sampler', 'Seed': 'seed'}
+
+# not unique, the identical images share one filename in the content-addressed storages
+_RECORDS_TABLE = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL,
+    rating TEXT,
+    tags TEXT,
+    width INTEGER,
+    height INTEGER,
+    prompt TEXT,
+    neg_prompt TEXT,
+    created_at REAL NOT NULL,
+    model TEXT,
+    sampler TEXT,
+    seed INTEGER,
+    extra TEXT
+);
+"""
+_SCHEMA = _RECORDS_TABLE + """
+CREATE INDEX IF NOT EXISTS idx_records_filename ON records (filename);
+CREATE INDEX IF NOT EXISTS idx_records_created_at ON records (created_at);
+CREATE INDEX IF NOT EXISTS idx_records_rating ON records (rating, created_at);
+CREATE INDEX IF NOT EXISTS idx_records_model ON records (model, created_at);
+CREATE INDEX IF NOT EXISTS idx_records_sampler ON records (sampler, created_at);
+CREATE INDEX IF NOT EXISTS idx_records_seed ON records (seed);
+CREATE INDEX IF NOT EXISTS idx_records_size ON records (width, height);
+
+CREATE TABLE IF NOT EXISTS tag_names (
+    id INTEGER PRIMARY KEY,
+    tag TEXT NOT NULL UNIQUE,
+    type TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS record_tags (
+    tag_id INTEGER NOT NULL,
+    record_id INTEGER NOT NULL,
+    PRIMARY KEY (tag_id, record_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS embeddings (
+    record_id INTEGER PRIMARY KEY,
+    embedding BLOB NOT NULL
+);
+"""
+
+
+def _drop_filename_unique(conn: sqlite3.Connection):
+    # the databases created before have the filenames unique, the table is rebuilt without that
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'records'").fetchone()
+    if row is not None and 'filename TEXT NOT NULL UNIQUE' in row[0]:
+        logging.info('Rebuilding records table without the unique filenames ...')
+        try:
+            conn.executescript(f"""
+            BEGIN;
+            ALTER TABLE records RENAME TO records_unique;
+            {_RECORDS_TABLE}
+            INSERT INTO records SELECT * FROM records_unique;
+            DROP TABLE records_unique;
+            COMMIT;
+            """)
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+
+def _record_to_row(record: dict) -> tuple:
+    extra = {key: value for key, value in record.items()
+             if key not in _COLUMNS and key not in _INDEXED_PARAMETERS and value is not None}
+    seed = record.get('Seed')
+    return (
+        *(record.get(column) for column in _COLUMNS),
+        record.get('Model'), record.get('Sampler'),
+        int(seed) if isinstance(seed, (int, float)) and seed == seed else None,
+        json.dumps(extra) if extra else None,
+    )
+
+
+def _row_to_record(row: sqlite3.Row) -> dict:
+    record = {column: row[column] for column in _COLUMNS}
+    for key, column in _INDEXED_PARAMETERS.items():
+        if row[column] is not None:
+            record[key] = row[column]
+    if row['extra']:
+        record.update(json.loads(row['extra']))
+    record['row'] = row['id']
+    return record
+
+
+def _insert_records(conn: sqlite3.Connection, items: List[Tuple[dict, List[Tuple[str, str]], Optional[np.ndarray]]]):
+    for record, tags_pairs, embedding in items:
+        record_id = conn.execute(
+            f'INSERT INTO records ({", ".join(_COLUMNS)}, model, sampler, seed, extra) '
+            f'VALUES ({", ".join("?" * (len(_COLUMNS) + 4))})',
+            _record_to_row(record),
+        ).lastrowid
+        if embedding is not None:
+            conn.execute('INSERT INTO embeddings (record_id, embedding) VALUES (?, ?)',
+                         (record_id, normalize_embedding(embedding).tobytes()))
+        for tag, tag_type in tags_pairs:
+            conn.execute('INSERT OR IGNORE INTO tag_names (tag, type) VALUES (?, ?)', (tag, tag_type))
+            conn.execute('UPDATE tag_names SET count = count + 1 WHERE tag = ?', (tag,))
+            conn.execute('INSERT OR IGNORE INTO record_tags (tag_id, record_id) '
+                         'SELECT id, ? FROM tag_names WHERE tag = ?', (record_id, tag))
+
+
+def _tags_condition(groups: List[TagGroup], neg_groups: List[TagGroup]) -> Tuple[str, list]:
+    conditions, params = [], []
+    for group, op in [*((g, 'IN') for g in groups), *((g, 'NOT IN') for g in neg_groups)]:
+        tags = [group] if isinstance(group, str) else list(group)
+        conditions.append(
+            f'id {op} (SELECT record_id FROM record_tags JOIN tag_names ON tag_names.id = record_tags.tag_id '
+            f'WHERE tag_names.tag IN ({", ".join("?" * len(tags))}))'
+        )
+        params.extend(tags)
+    return ' AND '.join(conditions) or '1', params
+
+
+def _filters_condition(filters: Optional[RecordFilters]) -> Tuple[str, list]:
+    conditions, params = [], []
+    if filters:
+        for column, values in [('rating', filters.ratings), ('model', filters.models), ('sampler', filters.samplers)]:
+            if values:
+                conditions.append(f'{column} IN ({", ".join("?" * len(values))})')
+                params.extend(values)
+        for column, min_value, max_value in [('width', filters.min_width, filters.max_width),
+                                             ('height', filters.min_height, filters.max_height),
+                                             ('created_at', filters.since, filters.until)]:
+            if min_value is not None:
+                conditions.append(f'{column} >= ?')
+                params.append(min_value)
+            if max_value is not None:
+                conditions.append(f'{column} <= ?')
+                params.append(max_value)
+    return ' AND '.join(conditions) or '1', params
+
+
+class SQLiteImageRecorder(BaseImageRecorder):
+    """
+    Recorder on a SQLite database in WAL mode, the records are never loaded into memory as a whole.
+    Each recorded batch is committed in one transaction, while the readers keep reading the last committed state.
+    """
+
+    def __init__(self, storage: BaseImageStorage, db_file: str, record_workers: int = 4,
+                 similar_block_size: int = 65536):
+        BaseImageRecorder.__init__(self, storage, record_workers=record_workers)
+        self.db_file = db_file
+        if os.path.dirname(self.db_file):
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+        self._similar_block_size = similar_block_size
+        self._local = local()
+        self._lock = Lock()
+        _drop_filename_unique(self._conn())
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite connections are not shared between threads, each thread has its own one
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30.0)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _append_records(self, items: List[Tuple[dict, List[Tuple[str, str]], np.ndarray]]):
+        with self._lock:
+            conn = self._conn()
+            with conn:
+                # taken inside the lock, so created_at keeps increasing with the row ids
+                _insert_records(conn, [({**record, 'created_at': time.time()}, tags_pairs, embedding)
+                                       for record, tags_pairs, embedding in items])
+
+    def save(self):
+        # records are committed as soon as they are added, only the wal file is checkpointed here
+        self._conn().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def _condition(self, tags: List[TagGroup], neg_tags: List[TagGroup], filters: Optional[RecordFilters]) \
+            -> Tuple[str, list]:
+        query_tags, query_neg_tags = self._resolve_query(tags, neg_tags)
+        tags_condition, tags_params = _tags_condition(query_tags, query_neg_tags)
+        filters_condition, filters_params = _filters_condition(filters)
+        return f'{tags_condition} AND {filters_condition}', [*tags_params, *filters_params]
+
+    def query_with_tags(self, tags: List[TagGroup], neg_tags: List[TagGroup],
+                        filters: Optional[RecordFilters] = None) -> List[Image.Image]:
+        """
+        Query images containing all the ``tags`` and none of the ``neg_tags``, latest first.
+        Each item can also be a list of tags, which matches the images with any of them.
+        """
+        condition, params = self._condition(tags, neg_tags, filters)
+        filenames = [row['filename'] for row in self._conn().execute(
+            f'SELECT filename FROM records WHERE {condition} ORDER BY created_at DESC, id DESC', params)]
+        return [self.image_storage.get_image(filename) for filename in filenames]
+
+    def query_page(self, tags: List[TagGroup], neg_tags: List[TagGroup],
+                   cursor: Optional[PageCursor] = None, limit: int = 40, backward: bool = False,
+                   filters: Optional[RecordFilters] = None) -> List[dict]:
+        """
+        Keyset-paginated version of :meth:`query_with_tags`, see :meth:`ImageRecorder.query_page`.
+        """
+        condition, params = self._condition(tags, neg_tags, filters)
+        if cursor is not None:
+            condition = f'{condition} AND (created_at, id) {">" if backward else "<"} (?, ?)'
+            params = [*params, float(cursor[0]), int(cursor[1])]
+        order = 'ASC' if backward else 'DESC'
+        rows = self._conn().execute(
+            f'SELECT * FROM records WHERE {condition} ORDER BY created_at {order}, id {order} LIMIT ?',
+            [*params, limit],
+        ).fetchall()
+        records = [_row_to_record(row) for row in rows]
+        return records[::-1] if backward else records
+
+    def query_similar(self, image: Union[Image.Image, str], k: int = 40) -> List[dict]:
+        """
+        Records most similar to the given image (or filename of a recorded image) by the cosine similarity
+        of WD14 embeddings, with their ``score``. The embeddings are scanned block by block from the database.
+        """
+        conn = self._conn()
+        embedding = None
+        if isinstance(image, str):
+            row = conn.execute('SELECT embedding FROM embeddings JOIN records ON records.id = embeddings.record_id '
+                               'WHERE records.filename = ?', (image,)).fetchone()
+            if row is not None:
+                embedding = np.frombuffer(row['embedding'], dtype=np.float16)
+            else:
+                image = self.image_storage.get_image(image)
+        if embedding is None:
+            _, _, _, embedding = get_wd14_tags_batch([image], model_name=_TAGGER_MODEL)[0]
+        query = normalize_embedding(embedding).astype(np.float32)
+
+        all_rows, all_scores, last_id = [], [], 0
+        while True:
+            block = conn.execute('SELECT record_id, embedding FROM embeddings WHERE record_id > ? '
+                                 'ORDER BY record_id LIMIT ?', (last_id, self._similar_block_size)).fetchall()
+            if not block:
+                break
+            ids = np.array([row['record_id'] for row in block], dtype=np.int64)
+            matrix = np.frombuffer(b''.join(row['embedding'] for row in block), dtype=np.float16) \
+                .reshape(len(block), -1).astype(np.float32)
+            rows, scores = _top_k(ids, matrix @ query, k)
+            all_rows.append(rows)
+            all_scores.append(scores)
+            last_id = int(ids[-1])
+        if not all_rows:
+            return []
+
+        rows, scores = _top_k(np.concatenate(all_rows), np.concatenate(all_scores), k)
+        records = {row['id']: _row_to_record(row) for row in conn.execute(
+            f'SELECT * FROM records WHERE id IN ({", ".join("?" * len(rows))})', [int(r) for r in rows])}
+        return [{**records[row], 'score': float(score)} for row, score in zip(rows, scores) if row in records]
+
+    def list_tags(self):
+        return [dict(row) for row in self._conn().execute(
+            'SELECT tag, type, count FROM tag_names WHERE count > 0 ORDER BY count DESC, tag ASC, type ASC')]
+
+    def list_facets(self) -> Dict[str, Dict[str, int]]:
+        conn = self._conn()
+        return {
+            column: {row['value']: row['count'] for row in conn.execute(
+                f'SELECT {column} AS value, COUNT(*) AS count FROM records '
+                f'WHERE {column} IS NOT NULL GROUP BY {column} ORDER BY count DESC')}
+            for column in ['rating', 'model', 'sampler']
+        }
+
+    def _get_tag_count(self, tag: str) -> int:
+        row = self._conn().execute('SELECT count FROM tag_names WHERE tag = ?', (tag,)).fetchone()
+        return row['count'] if row else 0
+
+    def count_refs(self, filename: str) -> int:
+        return self._conn().execute('SELECT COUNT(*) FROM records WHERE filename = ?', (filename,)).fetchone()[0]
+
+
+def migrate_parquet_to_sqlite(root_dir: str, db_file: str, batch_size: int = 10000) -> int:
+    """
+    Copy the records of :class:`ImageRecorder` in ``root_dir`` (the base file, the delta segments
+    and their embeddings) into a new SQLite database of :class:`SQLiteImageRecorder`.
+    Returns the number of migrated records.
+    """
+    if os.path.exists(db_file):
+        raise FileExistsError(f'Database {db_file!r} already exists.')
+    tags_file = os.path.join(root_dir, 'tags.parquet')
+    tag_types = {}
+    if os.path.exists(tags_file):
+        tag_types = {item['tag']: item['type'] for item in pq.read_table(tags_file).to_pylist()}
+
+    files = []
+    records_file = os.path.join(root_dir, 'records.parquet')
+    last_segment = ''
+    if os.path.exists(records_file):
+        last_segment = (pq.read_schema(records_file).metadata or {}).get(_META_LAST_SEGMENT, b'').decode()
+        files.append((records_file, os.path.join(root_dir, f'embeddings_{last_segment}.npy')))
+    segments_dir = os.path.join(root_dir, 'segments')
+    if os.path.exists(segments_dir):
+        last_seq = _segment_seq(last_segment) if last_segment else -1
+        for name in sorted((os.path.splitext(filename)[0] for filename in os.listdir(segments_dir)
+                            if filename.endswith('.parquet')), key=_segment_seq):
+            if _segment_seq(name) > last_seq:
+                segment_file = os.path.join(segments_dir, f'{name}.parquet')
+                metadata = pq.read_schema(segment_file).metadata or {}
+                embeddings_filename = metadata[_META_EMBEDDINGS].decode() \
+                    if _META_EMBEDDINGS in metadata else f'{name}.npy'
+                files.append((segment_file, os.path.join(segments_dir, embeddings_filename)))
+
+    conn = sqlite3.connect(db_file)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.executescript(_SCHEMA)
+    total = 0
+    for parquet_file, embeddings_file in files:
+        parquet = pq.ParquetFile(parquet_file)
+        embeddings = np.load(embeddings_file, mmap_mode='r') if os.path.exists(embeddings_file) else None
+        if embeddings is not None and len(embeddings) != parquet.metadata.num_rows:
+            logging.warning(f'Embeddings file {embeddings_file!r} not aligned with records, it will be ignored.')
+            embeddings = None
+
+        offset = 0
+        for batch in parquet.iter_batches(batch_size=batch_size):
+            items = []
+            # the files in the older layouts have one column for each parameter
+            for i, record in enumerate(normalize_table(pa.Table.from_batches([batch])).to_pylist()):
+                record = {key: value for key, value in expand_record(record).items()
+                          if value is not None and not (isinstance(value, float) and value != value)}
+                tags = (record.get('tags') or '').split()
+                embedding = embeddings[offset + i] if embeddings is not None else None
+                if embedding is not None and not np.any(embedding):
+                    embedding = None
+                items.append((record, [(tag, tag_types.get(tag, 'general')) for tag in tags], embedding))
+            with conn:
+                _insert_records(conn, items)
+            offset += batch.num_rows
+            total += batch.num_rows
+        logging.info(f'{plural_word(offset, "record")} migrated from {parquet_file!r}.')
+
+    conn.close()
+    return total
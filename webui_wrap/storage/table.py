@@ -0,0 +1,144 @@
+import bisect
+from typing import Dict, List, Optional, Iterable
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .schema import records_to_table, expand_record
+
+# unique for each record, nothing to share by the dictionary encoding
+_PLAIN_COLUMNS = {'filename'}
+
+
+class RecordTable:
+    """
+    Columnar in-memory records. The rows are appended to a small tail of dicts, which is sealed into an Arrow
+    chunk every ``seal_rows`` rows, so the records are never rebuilt as a whole. In the chunks, the repeated
+    strings (ratings, prompts, models, samplers, etc.) are dictionary-encoded, and the tags are lists of tag ids.
+    """
+
+    def __init__(self, seal_rows: int = 4096):
+        self._seal_rows = seal_rows
+        self._chunks: List[pa.Table] = []
+        self._chunk_offsets: List[int] = []
+        self._tail: List[dict] = []
+        self._tail_offset = 0
+        self._tag_ids: Dict[str, int] = {}
+        self._tag_names: List[str] = []
+
+    def __len__(self):
+        return self._tail_offset + len(self._tail)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(chunk.nbytes for chunk in self._chunks)
+
+    def _encode_tags(self, tags: pa.ChunkedArray) -> pa.Array:
+        tags = pc.utf8_trim_whitespace(tags.cast(pa.string()).fill_null('')).combine_chunks()
+        lists = pc.split_pattern(tags, ' ')
+        offsets = lists.offsets.to_numpy()
+        values = lists.flatten()
+        kept = pc.not_equal(values, '').to_numpy(zero_copy_only=False)
+        values = values.filter(pa.array(kept))
+        for tag in pc.unique(values).to_pylist():
+            if tag not in self._tag_ids:
+                self._tag_ids[tag] = len(self._tag_names)
+                self._tag_names.append(tag)
+        ids = pc.index_in(values, value_set=pa.array(self._tag_names, type=pa.string())).cast(pa.int32())
+        kept_offsets = np.concatenate([[0], np.cumsum(kept, dtype=np.int32)])
+        return pa.ListArray.from_arrays(pa.array(kept_offsets[offsets - offsets[0]]), ids)
+
+    def _decode_tags(self, tags: pa.ListArray) -> List[str]:
+        offsets, tag_ids = tags.offsets.to_numpy().tolist(), tags.values.to_numpy().tolist()
+        tag_names = self._tag_names
+        return [
+            ' '.join(['', *(tag_names[tag_id] for tag_id in tag_ids[start:end]), ''])
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+    def _to_records(self, table: pa.Table) -> List[dict]:
+        names, columns = table.column_names, []
+        for name, column in zip(names, table.columns):
+            column = column.combine_chunks()
+            if name == 'tags':
+                columns.append(self._decode_tags(column))
+            elif pa.types.is_dictionary(column.type):
+                # much faster than converting the dictionary scalars one by one
+                columns.append(column.dictionary_decode().to_pylist())
+            else:
+                columns.append(column.to_pylist())
+        if 'extra' in names:
+            return [expand_record(dict(zip(names, values))) for values in zip(*columns)]
+        else:
+            return [dict(zip(names, values)) for values in zip(*columns)]
+
+    def _encode(self, table: pa.Table) -> pa.Table:
+        columns = []
+        for name, column in zip(table.column_names, table.columns):
+            if name == 'tags':
+                column = self._encode_tags(column)
+            elif name not in _PLAIN_COLUMNS and (pa.types.is_string(column.type) or
+                                                 pa.types.is_large_string(column.type)):
+                column = column.combine_chunks().dictionary_encode()
+            else:
+                column = column.combine_chunks()
+            columns.append(column)
+        return pa.Table.from_arrays(columns, names=table.column_names)
+
+    def _add_chunk(self, table: pa.Table):
+        self._chunks.append(self._encode(table))
+        self._chunk_offsets.append(self._tail_offset)
+        self._tail_offset += table.num_rows
+
+    def _seal(self):
+        if self._tail:
+            tail, self._tail = self._tail, []
+            self._add_chunk(records_to_table(tail))
+
+    def append(self, record: dict):
+        self._tail.append(record)
+        if len(self._tail) >= self._seal_rows:
+            self._seal()
+
+    def extend_table(self, table: pa.Table):
+        if table.num_rows < self._seal_rows:
+            # small ones (e.g. the segments of the other processes) are merged into the tail
+            for record in table.to_pylist():
+                self.append(expand_record(record))
+        else:
+            self._seal()
+            self._add_chunk(table)
+
+    def take(self, rows: Iterable[int], columns: Optional[List[str]] = None) -> List[dict]:
+        """
+        The records of the given ``rows``, in the given order. Only the ``columns`` are included when given.
+        """
+        rows = [int(row) for row in rows]
+        results: List[Optional[dict]] = [None] * len(rows)
+        chunk_items: Dict[int, List[int]] = {}
+        for i, row in enumerate(rows):
+            if row >= self._tail_offset:
+                record = self._tail[row - self._tail_offset]
+                results[i] = {name: record.get(name) for name in columns} if columns else dict(record)
+            else:
+                chunk_items.setdefault(bisect.bisect_right(self._chunk_offsets, row) - 1, []).append(i)
+
+        for chunk_id, items in chunk_items.items():
+            chunk, offset = self._chunks[chunk_id], self._chunk_offsets[chunk_id]
+            if columns:
+                names = [name for name in columns if name in chunk.column_names]
+                if len(names) < len(columns) and 'extra' in chunk.column_names:
+                    # the other parameters are in the extra column
+                    names.append('extra')
+            else:
+                names = chunk.column_names
+            records = self._to_records(chunk.select(names).take(pa.array([rows[i] - offset for i in items])))
+            for i, record in zip(items, records):
+                if columns:
+                    record = {name: record.get(name) for name in columns}
+                results[i] = record
+        return results
+
+    def column(self, name: str, rows: Iterable[int]) -> list:
+        return [record[name] for record in self.take(rows, columns=[name])]
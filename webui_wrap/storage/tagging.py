@@ -0,0 +1,53 @@
+from typing import List, Tuple, Dict
+
+import numpy as np
+from PIL import Image
+
+_TAGGER_MODEL = 'SwinV2_v3'
+
+_FORMAT = ('rating', 'general', 'character', 'embedding')
+
+TaggingResult = Tuple[Dict[str, float], Dict[str, float], Dict[str, float], np.ndarray]
+
+
+def get_wd14_tags_batch(images: List[Image.Image], model_name: str = _TAGGER_MODEL,
+                        batch_size: int = 16) -> List[TaggingResult]:
+    """
+    Batched version of ``get_wd14_tags``, the images are tagged with one model run for each chunk.
+    Ratings, general tags, character tags and embedding are returned for each image.
+    """
+    # onnxruntime is only loaded when the first images are tagged
+    try:
+        # private helpers of imgutils, checked with 0.19
+        from imgutils.tagging.wd14 import _get_wd14_model, _prepare_image_for_tagging, _postprocess_embedding
+    except ImportError:
+        from imgutils.tagging import get_wd14_tags
+        return [get_wd14_tags(image, model_name=model_name, fmt=_FORMAT) for image in images]
+
+    model = _get_wd14_model(model_name)
+    model_batch, target_size, _, _ = model.get_inputs()[0].shape
+    if isinstance(model_batch, int):
+        # model exported with fixed batch dimension
+        batch_size = model_batch
+
+    input_name = model.get_inputs()[0].name
+    assert len(model.get_outputs()) == 2
+    label_name = model.get_outputs()[0].name
+    emb_name = model.get_outputs()[1].name
+
+    results = []
+    for i in range(0, len(images), batch_size):
+        input_ = np.concatenate([
+            _prepare_image_for_tagging(image, target_size)
+            for image in images[i:i + batch_size]
+        ])
+        preds, embeddings = model.run([label_name, emb_name], {input_name: input_})
+        for pred, embedding in zip(preds, embeddings):
+            results.append(_postprocess_embedding(
+                pred=pred,
+                embedding=embedding,
+                model_name=model_name,
+                fmt=_FORMAT,
+            ))
+
+    return results
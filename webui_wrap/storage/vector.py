@@ -0,0 +1,207 @@
+import logging
+from threading import Lock, Thread
+from typing import List, Optional, Tuple
+
+import numpy as np
+from hbutils.string import plural_word
+
+_Chunk = Tuple[int, Optional[np.ndarray]]
+
+
+def normalize_embedding(embedding: np.ndarray) -> np.ndarray:
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    if norm > 0:
+        embedding = embedding / norm
+    return embedding.astype(np.float16)
+
+
+def _iter_blocks(chunks: List[_Chunk], block_size: int, start: int = 0):
+    offset = 0
+    for n_rows, embeddings in chunks:
+        if embeddings is not None and offset + n_rows > start:
+            for i in range(max(start - offset, 0), n_rows, block_size):
+                yield offset + i, np.asarray(embeddings[i:i + block_size], dtype=np.float32)
+        offset += n_rows
+
+
+def _gather(chunks: List[_Chunk], rows: np.ndarray, dim: int) -> np.ndarray:
+    offsets = np.cumsum([0, *(n_rows for n_rows, _ in chunks)])
+    chunk_ids = np.searchsorted(offsets, rows, side='right') - 1
+    retval = np.zeros((len(rows), dim), dtype=np.float32)
+    for chunk_id in np.unique(chunk_ids):
+        _, embeddings = chunks[chunk_id]
+        if embeddings is not None:
+            mask = chunk_ids == chunk_id
+            retval[mask] = embeddings[rows[mask] - offsets[chunk_id]]
+    return retval
+
+
+def _score(rows: np.ndarray, embeddings: np.ndarray, query: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # zero-filled rows are the ones without embeddings
+    matched = np.any(embeddings != 0, axis=1)
+    return rows[matched], embeddings[matched] @ query
+
+
+def _top_k(rows: np.ndarray, scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if len(scores) > k:
+        selected = np.argpartition(-scores, k - 1)[:k]
+        rows, scores = rows[selected], scores[selected]
+    order = np.argsort(-scores, kind='stable')
+    return rows[order], scores[order]
+
+
+class _IVFIndex:
+    """
+    Inverted file index over the first ``size`` rows, only the rows of the ``nprobe`` nearest lists are scanned.
+    """
+
+    def __init__(self, centroids: np.ndarray, lists: List[np.ndarray], size: int):
+        self.centroids = centroids
+        self.lists = lists
+        self.size = size
+
+    @classmethod
+    def build(cls, chunks: List[_Chunk], size: int, dim: int, block_size: int,
+              n_lists: Optional[int] = None, n_iters: int = 10, n_samples: int = 65536) -> '_IVFIndex':
+        n_lists = n_lists or int(np.sqrt(size))
+        random = np.random.default_rng(0)
+        samples = _gather(chunks, np.sort(random.choice(size, min(size, n_samples), replace=False)), dim)
+        centroids = samples[random.choice(len(samples), n_lists, replace=False)]
+        for _ in range(n_iters):
+            assignments = np.argmax(samples @ centroids.T, axis=1)
+            for i in range(n_lists):
+                members = samples[assignments == i]
+                if len(members) > 0:
+                    centroid = members.mean(axis=0)
+                    centroids[i] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        assignments = np.zeros((size,), dtype=np.int32)
+        for offset, block in _iter_blocks(chunks, block_size):
+            if offset >= size:
+                break
+            block = block[:size - offset]
+            assignments[offset:offset + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+        lists = [order[bounds[i]:bounds[i + 1]] for i in range(n_lists)]
+        return cls(centroids, lists, size)
+
+    def search(self, chunks: List[_Chunk], query: np.ndarray, k: int, nprobe: int) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        probes = np.argsort(-(self.centroids @ query))[:nprobe]
+        rows = np.sort(np.concatenate([self.lists[i] for i in probes]))
+        return _top_k(*_score(rows, _gather(chunks, rows, len(query)), query), k)
+
+
+class EmbeddingStore:
+    """
+    Row-aligned store of L2-normalized float16 embeddings, kept as a list of chunks (which can be memory-mapped),
+    so that cosine similarity search is a blockwise matrix product over the whole history.
+    Chunks can be ``None`` for the rows without embeddings, these rows are never matched.
+    """
+
+    def __init__(self, block_size: int = 65536, ivf_threshold: int = 262144, nprobe: int = 32):
+        self._chunks: List[_Chunk] = []
+        self._tail: List[np.ndarray] = []
+        self._size = 0
+        self._dim: Optional[int] = None
+        self._block_size = block_size
+        self._ivf_threshold = ivf_threshold
+        self._nprobe = nprobe
+        self._ivf: Optional[_IVFIndex] = None
+        self._ivf_building = False
+        self._lock = Lock()
+
+    def __len__(self):
+        return self._size
+
+    def add_chunk(self, embeddings: Optional[np.ndarray], n_rows: int):
+        with self._lock:
+            assert not self._tail, 'Tail embeddings should be sealed before adding chunks.'
+            if embeddings is not None:
+                assert len(embeddings) == n_rows, \
+                    f'Embedding rows not match, {plural_word(n_rows, "row")} expected but {len(embeddings)} found.'
+                self._dim = embeddings.shape[1]
+            if n_rows > 0:
+                self._chunks.append((n_rows, embeddings))
+            self._size += n_rows
+
+    def append(self, embedding: np.ndarray):
+        embedding = normalize_embedding(embedding)
+        with self._lock:
+            self._dim = embedding.shape[0]
+            self._tail.append(embedding)
+            self._size += 1
+
+    def seal(self) -> Optional[np.ndarray]:
+        """
+        Turn the appended embeddings into a chunk, and return it for persisting.
+        """
+        with self._lock:
+            if self._tail:
+                embeddings = np.stack(self._tail)
+                self._chunks.append((len(embeddings), embeddings))
+                self._tail = []
+                return embeddings
+            else:
+                return None
+
+    def _snapshot(self) -> Tuple[List[_Chunk], int]:
+        with self._lock:
+            chunks = list(self._chunks)
+            if self._tail:
+                chunks.append((len(self._tail), np.stack(self._tail)))
+            return chunks, self._size
+
+    def get(self, row: int) -> Optional[np.ndarray]:
+        if self._dim is None:
+            return None
+        chunks, _ = self._snapshot()
+        embedding = _gather(chunks, np.array([row]), self._dim)[0]
+        return embedding if np.any(embedding) else None
+
+    def _build_ivf(self, chunks: List[_Chunk], size: int, dim: int):
+        try:
+            logging.info(f'Building IVF index for {plural_word(size, "embedding")} ...')
+            ivf = _IVFIndex.build(chunks, size, dim, self._block_size)
+            with self._lock:
+                self._ivf = ivf
+        except Exception as err:  # pragma: no cover
+            logging.exception(f'Building IVF index failed: {err!r}')
+        finally:
+            with self._lock:
+                self._ivf_building = False
+
+    def _get_ivf(self, chunks: List[_Chunk], size: int) -> Optional[_IVFIndex]:
+        # built in the background, the queries are brute-forced on the rows not indexed until it is ready
+        with self._lock:
+            ivf = self._ivf
+            if size >= self._ivf_threshold and (ivf is None or size - ivf.size > ivf.size * 0.1) \
+                    and not self._ivf_building:
+                self._ivf_building = True
+                Thread(target=self._build_ivf, args=(chunks, size, self._dim), daemon=True).start()
+            return ivf
+
+    def search(self, query: np.ndarray, k: int = 40) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k rows by cosine similarity to ``query``, with their scores in descending order.
+        Once the store is larger than ``ivf_threshold``, an approximate IVF index is used for the indexed rows.
+        """
+        if self._dim is None or self._size == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        query = normalize_embedding(query).astype(np.float32)
+        chunks, size = self._snapshot()
+        ivf = self._get_ivf(chunks, size)
+
+        all_rows, all_scores = [], []
+        if ivf is not None:
+            rows, scores = ivf.search(chunks, query, k, self._nprobe)
+            all_rows.append(rows)
+            all_scores.append(scores)
+        for offset, block in _iter_blocks(chunks, self._block_size, start=ivf.size if ivf else 0):
+            rows, scores = _top_k(*_score(np.arange(offset, offset + len(block)), block, query), k)
+            all_rows.append(rows)
+            all_scores.append(scores)
+
+        return _top_k(np.concatenate(all_rows), np.concatenate(all_scores), k)
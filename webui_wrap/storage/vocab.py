@@ -0,0 +1,194 @@
+import bisect
+import json
+import logging
+import os
+from functools import lru_cache
+from typing import Optional, TYPE_CHECKING
+
+import pyarrow as pa
+from hbutils.string import plural_word
+from huggingface_hub import hf_hub_download
+
+from .tagging import _TAGGER_MODEL
+from .._env import env_flag
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+_VOCAB_VERSION = 1
+_CATEGORY_GENERAL = 0
+_CATEGORY_CHARACTER = 4
+
+
+def _default_vocab_dir() -> str:
+    return os.environ.get('TAGS_VOCAB_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'webui_wrap', 'vocab')
+
+
+def _is_offline() -> bool:
+    return env_flag('WEBUI_WRAP_OFFLINE') or env_flag('HF_HUB_OFFLINE')
+
+
+def _aliases_file(vocab_dir: str, model_name: str) -> str:
+    return os.path.join(vocab_dir, f'aliases_{model_name}_v{_VOCAB_VERSION}.arrow')
+
+
+def _tags_info_file(vocab_dir: str) -> str:
+    return os.path.join(vocab_dir, f'tags_info_v{_VOCAB_VERSION}.arrow')
+
+
+def _read_csv(repo_id: str, repo_type: str, filename: str, local_files_only: bool) -> 'pd.DataFrame':
+    import numpy as np
+    import pandas as pd
+
+    df = pd.read_csv(hf_hub_download(
+        repo_id=repo_id,
+        repo_type=repo_type,
+        filename=filename,
+        local_files_only=local_files_only,
+    ))
+    return df.replace(np.NaN, None)
+
+
+def _write_ipc_atomic(table: pa.Table, dst_file: str):
+    tmp_file = f'{dst_file}.{os.urandom(4).hex()}.tmp'
+    # written as one uncompressed record batch, so that it can be memory-mapped without any copying
+    with pa.OSFile(tmp_file, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table.combine_chunks())
+    os.replace(tmp_file, dst_file)
+
+
+def compile_vocabulary(vocab_dir: Optional[str] = None, model_name: str = _TAGGER_MODEL,
+                       local_files_only: bool = False) -> str:
+    """
+    Compile the tag aliases of the tagger and the tag information into Arrow IPC files in ``vocab_dir``,
+    which are sorted by the strings to look up. Returns the directory.
+    When ``local_files_only`` is set, only the CSV files already in the huggingface cache are used.
+    """
+    # only needed for compiling, loading the compiled files is done with pyarrow only
+    import numpy as np
+    import pandas as pd
+    from imgutils.tagging.wd14 import MODEL_NAMES
+
+    vocab_dir = vocab_dir or _default_vocab_dir()
+    os.makedirs(vocab_dir, exist_ok=True)
+
+    df_tags = _read_csv(
+        repo_id='deepghs/wd14_tagger_with_embeddings', repo_type='model',
+        filename=f'{MODEL_NAMES[model_name]}/tags_info.csv', local_files_only=local_files_only,
+    )
+    df_tags = df_tags[df_tags['category'].isin({_CATEGORY_GENERAL, _CATEGORY_CHARACTER})]
+    rows = [
+        (alias, item['name'], int(item['category']))
+        for item in df_tags[['name', 'category', 'aliases']].to_dict('records')
+        for alias in json.loads(item['aliases'])
+    ]
+    # the later ones win for the duplicated aliases, the same as the dict built before
+    df_aliases = pd.DataFrame(rows, columns=['alias', 'name', 'category']).drop_duplicates('alias', keep='last')
+    table = pa.Table.from_pandas(df_aliases, preserve_index=False).sort_by('alias')
+    _write_ipc_atomic(table, _aliases_file(vocab_dir, model_name))
+    logging.info(f'{plural_word(len(table), "tag alias")} compiled into {vocab_dir!r}.')
+
+    df_infos = []
+    for filename, category in [('general_tags.csv', _CATEGORY_GENERAL), ('character_tags.csv', _CATEGORY_CHARACTER)]:
+        df_info = _read_csv(repo_id='deepghs/tags_meta', repo_type='dataset',
+                            filename=filename, local_files_only=local_files_only)
+        df_info['tag_category'] = category
+        df_infos.append(df_info)
+    df_info = pd.concat(df_infos, ignore_index=True).replace(np.NaN, None)
+    table = pa.Table.from_pandas(df_info, preserve_index=False).sort_by([('name', 'ascending'),
+                                                                         ('tag_category', 'ascending')])
+    _write_ipc_atomic(table, _tags_info_file(vocab_dir))
+    logging.info(f'{plural_word(len(table), "tag information")} compiled into {vocab_dir!r}.')
+    return vocab_dir
+
+
+def _load_ipc(file: str) -> pa.Table:
+    return pa.ipc.open_file(pa.memory_map(file, 'r')).read_all()
+
+
+class _SortedStrings:
+    """
+    Sequence view of a sorted string column, so that it can be searched with :mod:`bisect`
+    without converting the whole column into python objects.
+    """
+
+    def __init__(self, array: pa.Array):
+        self._array = array
+
+    def __len__(self):
+        return len(self._array)
+
+    def __getitem__(self, index: int) -> str:
+        return self._array[index].as_py()
+
+
+class TagVocabulary:
+    """
+    Memory-mapped tag aliases and tag information. Loading is almost free, and each lookup is a binary search
+    on the sorted strings.
+    """
+
+    def __init__(self, vocab_dir: str, model_name: str = _TAGGER_MODEL):
+        self._aliases_file = _aliases_file(vocab_dir, model_name)
+        self._tags_info_file = _tags_info_file(vocab_dir)
+        self._aliases: Optional[pa.Table] = None
+        self._tags_info: Optional[pa.Table] = None
+
+    @property
+    def aliases(self) -> pa.Table:
+        if self._aliases is None:
+            self._aliases = _load_ipc(self._aliases_file)
+        return self._aliases
+
+    @property
+    def tags_info(self) -> pa.Table:
+        if self._tags_info is None:
+            self._tags_info = _load_ipc(self._tags_info_file)
+        return self._tags_info
+
+    def _search(self, table: pa.Table, column: str, value: str) -> int:
+        if table.num_rows == 0:
+            return -1
+        keys = _SortedStrings(table.column(column).chunk(0))
+        index = bisect.bisect_left(keys, value)
+        return index if index < len(keys) and keys[index] == value else -1
+
+    def resolve(self, alias: str) -> Optional[dict]:
+        """
+        The ``name`` and ``category`` of the tag with the given name or alias, ``None`` when not found.
+        """
+        index = self._search(self.aliases, 'alias', alias)
+        if index < 0:
+            return None
+        return {
+            'name': self.aliases.column('name')[index].as_py(),
+            'category': self.aliases.column('category')[index].as_py(),
+        }
+
+    def __contains__(self, alias: str):
+        return self._search(self.aliases, 'alias', alias) >= 0
+
+    def get_info(self, name: str, category: int) -> Optional[dict]:
+        index = self._search(self.tags_info, 'name', name)
+        if index < 0:
+            return None
+        names, categories = self.tags_info.column('name'), self.tags_info.column('tag_category')
+        while index < len(names) and names[index].as_py() == name:
+            if categories[index].as_py() == category:
+                return {column: self.tags_info.column(column)[index].as_py() for column in self.tags_info.column_names}
+            index += 1
+        return None
+
+
+@lru_cache()
+def get_tag_vocabulary(model_name: str = _TAGGER_MODEL) -> TagVocabulary:
+    """
+    The compiled tag vocabulary, which is compiled at the first time.
+    In offline mode (``WEBUI_WRAP_OFFLINE`` or ``HF_HUB_OFFLINE`` is set), the network is never touched.
+    """
+    vocab_dir = _default_vocab_dir()
+    if not os.path.exists(_aliases_file(vocab_dir, model_name)) or not os.path.exists(_tags_info_file(vocab_dir)):
+        logging.info(f'Compiling tag vocabulary into {vocab_dir!r} ...')
+        compile_vocabulary(vocab_dir, model_name, local_files_only=_is_offline())
+    return TagVocabulary(vocab_dir, model_name)
@@ -1,4 +1,28 @@
-from .i2i import create_i2i_ui
-from .model import create_base_model_ui
-from .t2i import create_t2i_ui
-from .history import create_history_ui
\ No newline at end of file
+from typing import TYPE_CHECKING
+
+from .._lazy import lazy_attrs
+
+# the subsystems (and their heavy dependencies) are only imported at the first access, see PEP 562
+_LAZY_IMPORTS = {
+    'create_i2i_ui': '.i2i',
+    'create_base_model_ui': '.model',
+    'create_t2i_ui': '.t2i',
+    'create_history_ui': '.history',
+    'GENERATION_CONCURRENCY_ID': '.job',
+    'INTERACTIVE_THREADS': '.job',
+    'get_generation_concurrency': '.job',
+    'get_progress_interval': '.job',
+    'stream_webui_job': '.job',
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+if TYPE_CHECKING:
+    from .i2i import create_i2i_ui
+    from .model import create_base_model_ui
+    from .t2i import create_t2i_ui
+    from .history import create_history_ui
+    from .job import GENERATION_CONCURRENCY_ID, INTERACTIVE_THREADS, get_generation_concurrency, \
+        get_progress_interval, stream_webui_job
+
+__getattr__, __dir__ = lazy_attrs(__name__, globals(), _LAZY_IMPORTS)
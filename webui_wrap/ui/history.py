@@ -1,58 +1,320 @@
 import json
 import re
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from typing import List, Optional, Tuple, Union
 
 import gradio as gr
+from PIL import Image
 
 from ..base import auto_init_webui
-from ..storage import load_recorder_from_env
+from ..storage import load_recorder_from_env, BaseImageRecorder, RecordFilters
+
+
+_PAGE_SIZE = 40
+_SUGGESTION_LIMIT = 10
+_RATINGS = ['general', 'sensitive', 'questionable', 'explicit']
+
+
+def _parse_date(text: str, end_of_day: bool = False) -> Optional[float]:
+    text = (text or '').strip()
+    if not text:
+        return None
+    dt = datetime.fromisoformat(text)
+    if end_of_day and len(text) <= 10:
+        # a date without time covers the whole day
+        dt = dt + timedelta(days=1) - timedelta(microseconds=1)
+    return dt.timestamp()
+
+
+def _facet_choices(counts: dict) -> List[tuple]:
+    return [(f'{value} ({count})', value) for value, count in counts.items()]
+
+
+def _split_typing_tag(query_text: str) -> Tuple[str, str]:
+    # the tag being typed is the last one, after the `-` of negative tags and the `|` of alternatives
+    match = re.search(r'[^\s|]*$', query_text)
+    head, prefix = query_text[:match.start()], match.group(0)
+    if prefix.startswith('-') and (not head or head[-1].isspace()):
+        head, prefix = head + '-', prefix[1:]
+    return head, prefix
+
+
+def _suggestion_choices(suggestions: List[dict]) -> List[tuple]:
+    return [
+        (f'{item["tag"]} → {item["name"]} ({item["count"]})' if item['tag'] != item['name']
+         else f'{item["name"]} ({item["count"]})', item['name'])
+        for item in suggestions
+    ]
+
+
+class _PagePrefetcher:
+    def __init__(self, recorder: BaseImageRecorder, max_workers: int = 8, max_cached: int = _PAGE_SIZE * 4):
+        self._recorder = recorder
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._max_cached = max_cached
+        self._futures = OrderedDict()
+        self._lock = Lock()
+
+    def _get_future(self, filename: str) -> Future:
+        with self._lock:
+            if filename in self._futures:
+                self._futures.move_to_end(filename)
+            else:
+                self._futures[filename] = self._pool.submit(self._recorder.image_storage.get_thumbnail, filename)
+                while len(self._futures) > self._max_cached:
+                    self._futures.popitem(last=False)
+            return self._futures[filename]
+
+    def get_thumbnails(self, filenames: List[str]) -> List[Image.Image]:
+        futures = [self._get_future(filename) for filename in filenames]
+        return [future.result() for future in futures]
+
+    def _prefetch_page(self, query: dict, backward: bool):
+        records = self._recorder.query_page(
+            query['tags'], query['neg_tags'],
+            cursor=query['first'] if backward else query['last'],
+            limit=_PAGE_SIZE, backward=backward, filters=RecordFilters(**query['filters']),
+        )
+        for record in records:
+            self._get_future(record['filename'])
+
+    def prefetch_page(self, query: dict, backward: bool = False):
+        self._pool.submit(self._prefetch_page, query, backward)
 
 
 def create_history_ui():
     auto_init_webui()
     recorder = load_recorder_from_env()
+    prefetcher = _PagePrefetcher(recorder)
 
     with gr.Tabs():
         with gr.Tab('Query By Tags'):
-            def _query_from_recorder(query_text: str):
+            def _query_from_recorder(query_text: str, ratings: List[str], models: List[str], samplers: List[str],
+                                     min_width, max_width, min_height, max_height, since: str, until: str):
+                # `a|b` matches any of the tags, `-a|b` excludes all of them
                 segs = list(filter(bool, re.split(r'\s+', query_text)))
                 tags, neg_tags = [], []
-                for tag in segs:
-                    if tag.startswith('-'):
-                        neg_tags.append(tag[1:])
+                for seg in segs:
+                    is_neg = seg.startswith('-')
+                    group = list(filter(bool, (seg[1:] if is_neg else seg).split('|')))
+                    if not group:
+                        continue
+                    tag = group[0] if len(group) == 1 else group
+                    if is_neg:
+                        neg_tags.append(tag)
                     else:
                         tags.append(tag)
 
-                images = recorder.query_with_tags(tags, neg_tags)
-                meta_infos = [image.info.get('parameters') for image in images]
-                return images, json.dumps(meta_infos)
+                try:
+                    date_range = _parse_date(since), _parse_date(until, end_of_day=True)
+                except ValueError as err:
+                    return [], json.dumps([]), None, f'Invalid date - {err}'
+                filters = {
+                    'ratings': ratings, 'models': models, 'samplers': samplers,
+                    'min_width': int(min_width) if min_width else None,
+                    'max_width': int(max_width) if max_width else None,
+                    'min_height': int(min_height) if min_height else None,
+                    'max_height': int(max_height) if max_height else None,
+                    'since': date_range[0], 'until': date_range[1],
+                }
+                query = {'tags': tags, 'neg_tags': neg_tags, 'filters': filters,
+                         'page': 0, 'first': None, 'last': None}
+                return _query_page(query, None, backward=False)
+
+            def _query_page(query: dict, cursor, backward: bool):
+                records = recorder.query_page(
+                    query['tags'], query['neg_tags'],
+                    cursor=cursor, limit=_PAGE_SIZE, backward=backward, filters=RecordFilters(**query['filters']),
+                )
+                if not records:
+                    if query['page'] == 0:
+                        return [], json.dumps([]), query, 'No images found.'
+                    else:
+                        return gr.update(), gr.update(), query, gr.update()
+
+                filenames = [record['filename'] for record in records]
+                thumbnails = prefetcher.get_thumbnails(filenames)
+                query = {
+                    **query,
+                    'page': query['page'] + (-1 if backward else 1),
+                    'first': recorder.page_cursor(records[0]),
+                    'last': recorder.page_cursor(records[-1]),
+                }
+                prefetcher.prefetch_page(query, backward=backward)
+                return thumbnails, json.dumps(filenames), query, f'Page {query["page"]}'
+
+            def _query_similar(image: Union[Image.Image, str]):
+                records = recorder.query_similar(image, k=_PAGE_SIZE)
+                filenames = [record['filename'] for record in records]
+                thumbnails = prefetcher.get_thumbnails(filenames)
+                gallery = [(thumbnail, f'{record["score"]:.3f}') for thumbnail, record in zip(thumbnails, records)]
+                return gallery, json.dumps(filenames)
+
+            def _query_prev(query: Optional[dict]):
+                if not query or query['page'] <= 1:
+                    return gr.update(), gr.update(), query, gr.update()
+                return _query_page(query, query['first'], backward=True)
+
+            def _query_next(query: Optional[dict]):
+                if not query:
+                    return gr.update(), gr.update(), query, gr.update()
+                return _query_page(query, query['last'], backward=False)
 
             with gr.Row():
                 with gr.Column():
-                    gr_tags_query = gr.Textbox(value='', placeholder='Enter Tags Here', label='Query Tags')
+                    gr_tags_query = gr.Textbox(value='', placeholder='Enter Tags Here, e.g. 1girl -boy smile|grin',
+                                               label='Query Tags')
+                    gr_suggestions = gr.Radio(choices=[], value=None, label='Suggestions', visible=False)
+
+                    def _suggest_tags(query_text: str):
+                        _, prefix = _split_typing_tag(query_text)
+                        choices = _suggestion_choices(recorder.suggest_tags(prefix, limit=_SUGGESTION_LIMIT)) \
+                            if prefix else []
+                        return gr.update(choices=choices, value=None, visible=bool(choices))
+
+                    def _apply_suggestion(query_text: str, name: Optional[str]):
+                        if not name:
+                            return gr.update(), gr.update()
+                        head, _ = _split_typing_tag(query_text)
+                        return f'{head}{name} ', gr.update(choices=[], value=None, visible=False)
+
+                    gr_tags_query.input(
+                        fn=_suggest_tags,
+                        inputs=[gr_tags_query],
+                        outputs=[gr_suggestions],
+                        api_name='suggest_tags',
+                        trigger_mode='always_last',
+                        show_progress='hidden',
+                    )
+                    gr_suggestions.input(
+                        fn=_apply_suggestion,
+                        inputs=[gr_tags_query, gr_suggestions],
+                        outputs=[gr_tags_query, gr_suggestions],
+                        show_progress='hidden',
+                    )
+                    with gr.Accordion('Filters', open=False):
+                        facets = recorder.list_facets()
+                        gr_ratings = gr.CheckboxGroup(choices=_RATINGS, value=[], label='Rating')
+                        with gr.Row():
+                            gr_models = gr.Dropdown(choices=_facet_choices(facets['model']), value=[],
+                                                    multiselect=True, label='Model')
+                            gr_samplers = gr.Dropdown(choices=_facet_choices(facets['sampler']), value=[],
+                                                      multiselect=True, label='Sampler')
+                        with gr.Row():
+                            gr_min_width = gr.Number(value=None, label='Min Width', precision=0)
+                            gr_max_width = gr.Number(value=None, label='Max Width', precision=0)
+                            gr_min_height = gr.Number(value=None, label='Min Height', precision=0)
+                            gr_max_height = gr.Number(value=None, label='Max Height', precision=0)
+                        with gr.Row():
+                            gr_since = gr.Textbox(value='', placeholder='e.g. 2024-03-01', label='Since')
+                            gr_until = gr.Textbox(value='', placeholder='e.g. 2024-03-31 18:00', label='Until')
+                        gr_facets_refresh = gr.Button(value='Refresh Filters')
+
+                        def _refresh_facets():
+                            facets_ = recorder.list_facets()
+                            return gr.update(choices=_facet_choices(facets_['model'])), \
+                                gr.update(choices=_facet_choices(facets_['sampler']))
+
+                        gr_facets_refresh.click(
+                            fn=_refresh_facets,
+                            outputs=[gr_models, gr_samplers],
+                        )
+
                     gr_submit = gr.Button(value='Query', variant='primary')
                     gr_gallery = gr.Gallery(label='Gallery')
+                    with gr.Row():
+                        gr_prev = gr.Button(value='Previous')
+                        gr_page_info = gr.Markdown(value='')
+                        gr_next = gr.Button(value='Next')
 
                 with gr.Column():
-                    gr_hidden_metas = gr.TextArea(visible=False, interactive=False)
+                    gr_query_state = gr.State(value=None)
+                    gr_hidden_files = gr.TextArea(visible=False, interactive=False)
+                    gr_selected_file = gr.State(value=None)
+                    gr_image = gr.Image(label='Selected Image', type='pil', interactive=False)
+                    gr_similar = gr.Button(value='Find Similar Images')
                     gr_meta_info = gr.Text(label='Meta Information', value='', lines=20, show_copy_button=True,
                                            interactive=False)
 
                 gr_submit.click(
                     fn=_query_from_recorder,
-                    inputs=[gr_tags_query],
-                    outputs=[gr_gallery, gr_hidden_metas],
+                    inputs=[gr_tags_query, gr_ratings, gr_models, gr_samplers,
+                            gr_min_width, gr_max_width, gr_min_height, gr_max_height, gr_since, gr_until],
+                    outputs=[gr_gallery, gr_hidden_files, gr_query_state, gr_page_info],
+                )
+                gr_prev.click(
+                    fn=_query_prev,
+                    inputs=[gr_query_state],
+                    outputs=[gr_gallery, gr_hidden_files, gr_query_state, gr_page_info],
+                )
+                gr_next.click(
+                    fn=_query_next,
+                    inputs=[gr_query_state],
+                    outputs=[gr_gallery, gr_hidden_files, gr_query_state, gr_page_info],
                 )
 
-                def _gallery_select(hidden_meta: str, evt: gr.SelectData):
+                def _gallery_select(hidden_files: str, evt: gr.SelectData):
                     if evt.selected:
-                        return json.loads(hidden_meta)[evt.index] or '<empty>'
+                        # only the thumbnails are shipped to the gallery, the original is loaded when selected
+                        filename = json.loads(hidden_files)[evt.index]
+                        image = recorder.image_storage.get_image(filename)
+                        return image, image.info.get('parameters') or '<empty>', filename
                     else:
-                        return 'N/A'
+                        return None, 'N/A', None
 
                 gr_gallery.select(
                     _gallery_select,
-                    inputs=[gr_hidden_metas],
-                    outputs=[gr_meta_info],
+                    inputs=[gr_hidden_files],
+                    outputs=[gr_image, gr_meta_info, gr_selected_file],
+                )
+
+                def _query_similar_to_selected(filename: Optional[str]):
+                    if not filename:
+                        return gr.update(), gr.update(), None, gr.update()
+                    gallery, hidden_files = _query_similar(filename)
+                    return gallery, hidden_files, None, 'Similar images'
+
+                gr_similar.click(
+                    fn=_query_similar_to_selected,
+                    inputs=[gr_selected_file],
+                    outputs=[gr_gallery, gr_hidden_files, gr_query_state, gr_page_info],
+                )
+
+        with gr.Tab('Query By Image'):
+            with gr.Row():
+                with gr.Column():
+                    gr_sim_input = gr.Image(label='Image', type='pil')
+                    gr_sim_submit = gr.Button(value='Find Similar Images', variant='primary')
+                    gr_sim_gallery = gr.Gallery(label='Gallery')
+
+                with gr.Column():
+                    gr_sim_hidden_files = gr.TextArea(visible=False, interactive=False)
+                    gr_sim_image = gr.Image(label='Selected Image', type='pil', interactive=False)
+                    gr_sim_meta_info = gr.Text(label='Meta Information', value='', lines=20, show_copy_button=True,
+                                               interactive=False)
+
+                def _query_similar_to_image(image: Optional[Image.Image]):
+                    if image is None:
+                        return gr.update(), gr.update()
+                    return _query_similar(image)
+
+                gr_sim_submit.click(
+                    fn=_query_similar_to_image,
+                    inputs=[gr_sim_input],
+                    outputs=[gr_sim_gallery, gr_sim_hidden_files],
+                )
+
+                def _sim_gallery_select(hidden_files: str, evt: gr.SelectData):
+                    image, meta_info, _ = _gallery_select(hidden_files, evt)
+                    return image, meta_info
+
+                gr_sim_gallery.select(
+                    _sim_gallery_select,
+                    inputs=[gr_sim_hidden_files],
+                    outputs=[gr_sim_image, gr_sim_meta_info],
                 )
 
         with gr.Tab('About Tags'):
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 
@@ -5,52 +6,64 @@ import gradio as gr
 import numpy as np
 from hbutils.string import plural_word
 
-from ..base import auto_init_webui, get_webui_client, WEBUI_SAMPLERS
+from ..base import auto_init_webui, WEBUI_SAMPLERS, get_capability
 from ..storage import load_recorder_from_env
+from .job import stream_webui_job, record_images, get_generation_concurrency, GENERATION_CONCURRENCY_ID
 
 
-def i2i_infer(init_image, inpaint_blur, prompt, neg_prompt: str, seed: int = -1,
-              sampler_name='DPM++ 2M Karras', cfg_scale=7, img_cfg_scale=1.5, steps=30,
-              firstphase_width=512, firstphase_height=768, denoising_strength=0.75,
-              batch_size=1,
-              clip_skip: int = 2, base_model: str = 'meinamix_v11'):
-    auto_init_webui()
-    client = get_webui_client()
-    client.util_set_model(base_model)
+async def i2i_infer(init_image, inpaint_blur, prompt, neg_prompt: str, seed: int = -1,
+                    sampler_name='DPM++ 2M Karras', cfg_scale=7, img_cfg_scale=1.5, steps=30,
+                    firstphase_width=512, firstphase_height=768, denoising_strength=0.75,
+                    batch_size=1,
+                    clip_skip: int = 2, base_model: str = 'meinamix_v11',
+                    request: gr.Request = None):
+    # the clients and capabilities may be fetched from webui
+    model_known = await asyncio.to_thread(_is_known_model, base_model)
 
     origin_image = init_image['background']
     mask_image = init_image['layers'][-1]
     mask_alpha = np.isclose(np.array(mask_image)[..., 3].astype(np.float32) / 255.0, 1.0)
     mask_used = np.any(mask_alpha)
 
-    result = client.img2img(
-        images=[origin_image],
-        mask_image=mask_image if mask_used else None,
-        mask_blur=inpaint_blur,
-        prompt=prompt,
-        negative_prompt=neg_prompt,
-        sampler_name=sampler_name,
-        cfg_scale=cfg_scale,
-        image_cfg_scale=img_cfg_scale,
-        seed=seed,
-        steps=steps,
-        width=firstphase_width,
-        height=firstphase_height,
-        denoising_strength=denoising_strength,
-        batch_size=batch_size,
-        override_settings={
-            'CLIP_stop_at_last_layers': clip_skip,
-        },
-    )
+    async def _img2img(client):
+        return await client.async_img2img(
+            images=[origin_image],
+            mask_image=mask_image if mask_used else None,
+            mask_blur=inpaint_blur,
+            prompt=prompt,
+            negative_prompt=neg_prompt,
+            sampler_name=sampler_name,
+            cfg_scale=cfg_scale,
+            image_cfg_scale=img_cfg_scale,
+            seed=seed,
+            steps=steps,
+            width=firstphase_width,
+            height=firstphase_height,
+            denoising_strength=denoising_strength,
+            batch_size=batch_size,
+            override_settings={
+                'CLIP_stop_at_last_layers': clip_skip,
+            },
+        )
+
+    # the model is switched by the job scheduler, only when not loaded yet
+    # the other names are matched to the closest model by webui
+    requirements = {'sd_models': [base_model] if model_known else []}
+    async for status, preview, result in stream_webui_job(_img2img, model=base_model, requirements=requirements,
+                                                          request=request):
+        if result is None:
+            # the status and the preview are streamed into the gallery, until the images are generated
+            yield gr.Gallery(value=[(preview, status)] if preview else None, label=status), '[]', '[]'
 
     logging.info(f'T2I complete, {plural_word(len(result.images), "image")} get.')
-    meta_infos = [image.info.get('parameters') for image in result.images]
-    recorder = load_recorder_from_env()
-    logging.info(f'Recording {plural_word(len(result.images), "image")} to system.')
-    for image, meta_info in zip(result.images, meta_infos):
-        recorder.put_image(image, meta_info)
-    recorder.save()
-    return result.images, json.dumps(meta_infos)
+    # the images are saved in a worker thread, not blocking the event loop
+    thumbnails, meta_infos, filenames = await asyncio.to_thread(record_images, result.images)
+    yield gr.Gallery(value=thumbnails, label='Gallery'), meta_infos, filenames
+
+
+def _is_known_model(base_model: str) -> bool:
+    auto_init_webui()
+    return base_model in get_capability('sd_models')
 
 
 _DEFAULT_PROMPT = """
@@ -102,25 +115,31 @@ def create_i2i_ui(gr_base_model: gr.Dropdown, gr_clip_skip: gr.Slider):
                 gr_batch_size = gr.Slider(value=1, minimum=1, maximum=16, step=1, label='Batch Size')
 
         with gr.Column():
-            gr_generate = gr.Button(value='Generate', variant='primary')
+            with gr.Row():
+                gr_generate = gr.Button(value='Generate', variant='primary')
+                gr_stop = gr.Button(value='Stop')
             gr_gallery = gr.Gallery(label='Gallery')
             gr_hidden_metas = gr.TextArea(visible=False, interactive=False)
+            gr_hidden_files = gr.TextArea(visible=False, interactive=False)
+            gr_image = gr.Image(label='Selected Image', type='pil', interactive=False)
             gr_meta_info = gr.Text(label='Meta Information', value='', lines=10, show_copy_button=True,
                                    interactive=False)
 
-            def _gallery_select(hidden_meta: str, evt: gr.SelectData):
-                if evt.selected:
-                    return json.loads(hidden_meta)[evt.index] or '<empty>'
+            def _gallery_select(hidden_meta: str, hidden_files: str, evt: gr.SelectData):
+                # nothing recorded for the previews
+                if evt.selected and evt.index < len(json.loads(hidden_files or '[]')):
+                    image = load_recorder_from_env().image_storage.get_image(json.loads(hidden_files)[evt.index])
+                    return image, json.loads(hidden_meta)[evt.index] or '<empty>'
                 else:
-                    return 'N/A'
+                    return None, 'N/A'
 
             gr_gallery.select(
                 _gallery_select,
-                inputs=[gr_hidden_metas],
-                outputs=[gr_meta_info],
+                inputs=[gr_hidden_metas, gr_hidden_files],
+                outputs=[gr_image, gr_meta_info],
             )
 
-        gr_generate.click(
+        gr_generate_event = gr_generate.click(
             i2i_infer,
             inputs=[
                 gr_init_image, gr_inpaint_blur, gr_prompt, gr_neg_prompt, gr_seed,
@@ -129,5 +148,11 @@ def create_i2i_ui(gr_base_model: gr.Dropdown, gr_clip_skip: gr.Slider):
                 gr_batch_size,
                 gr_clip_skip, gr_base_model,
             ],
-            outputs=[gr_gallery, gr_hidden_metas],
+            outputs=[gr_gallery, gr_hidden_metas, gr_hidden_files],
+            concurrency_id=GENERATION_CONCURRENCY_ID,
+            concurrency_limit=get_generation_concurrency(),
+            # not to cover the previews
+            show_progress='minimal',
         )
+        # the webui job is interrupted when the streaming is cancelled
+        gr_stop.click(fn=None, cancels=[gr_generate_event])
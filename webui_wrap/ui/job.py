@@ -0,0 +1,135 @@
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple
+
+import gradio as gr
+from hbutils.string import plural_word
+from PIL import Image
+
+from ..base import get_job_scheduler, JobQueueFullError, NoBackendError, WebUIBackend
+from ..storage import load_recorder_from_env
+
+# the events sending jobs to webui share this concurrency group, they are async and never take the worker threads
+# of the cheap events (e.g. of History), which keep their own concurrency groups
+GENERATION_CONCURRENCY_ID = 'webui_generation'
+# worker threads of gradio (its default limit) for the cheap events, the generations do not take them
+INTERACTIVE_THREADS = 40
+
+
+def get_generation_concurrency() -> int:
+    """
+    Number of the generation requests waiting in the job scheduler at the same time (``WEBUI_JOB_MAX_WAITING``,
+    ``64`` by default), they wait in the event loop without holding any threads. The others wait in the queue
+    of gradio.
+    """
+    return int(os.environ.get('WEBUI_JOB_MAX_WAITING') or 64)
+
+
+def _request_user(request: Optional[gr.Request]) -> str:
+    if request is None:
+        return 'anonymous'
+    # logged-in users are counted as themselves, the others by their sessions
+    return request.username or request.session_hash or (request.client.host if request.client else 'anonymous')
+
+
+def get_progress_interval() -> float:
+    """
+    Seconds between the polls of the progress of the running generations (``WEBUI_PROGRESS_INTERVAL``,
+    ``1`` by default).
+    """
+    return float(os.environ.get('WEBUI_PROGRESS_INTERVAL') or 1.0)
+
+
+def _runs_alone(backend: WebUIBackend) -> bool:
+    # the progress of webui is of its current task, which may also be sent from other places (e.g. its own ui)
+    return backend.n_running == 1 and backend.queue_depth <= 1
+
+
+def _progress_status(progress: dict) -> str:
+    state = progress.get('state') or {}
+    return f'Step {state.get("sampling_step") or 0}/{state.get("sampling_steps") or 0}, ' \
+           f'ETA {progress.get("eta_relative") or 0.0:.1f}s'
+
+
+def _progress_preview(progress: dict) -> Optional[Image.Image]:
+    # only sent when the live previews are enabled in the settings of webui
+    if progress.get('current_image'):
+        image = Image.open(io.BytesIO(base64.b64decode(progress['current_image'])))
+        image.load()
+        return image
+    else:
+        return None
+
+
+async def stream_webui_job(fn: Callable, *args, request: Optional[gr.Request] = None,
+                           interval: Optional[float] = None, **kwargs) \
+        -> AsyncIterator[Tuple[str, Optional[Image.Image], Any]]:
+    """
+    Run the coroutine function ``fn`` in the job scheduler as the job of the requesting user, and yield
+    ``(status, preview, result)`` every ``interval`` seconds, with the position in the queue while waiting,
+    the steps, ETA and preview of webui while running, and the result at last. ``fn`` is called with the client
+    of the webui backend it is routed to.
+
+    The progress of webui is of its current task, so it is only shown when the job is the only one running on
+    its backend with no other work seen there (``queue_depth``), and so is the job interrupted when the streaming
+    is stopped (e.g. by the user).
+    """
+    interval = get_progress_interval() if interval is None else interval
+    try:
+        # the scheduler checks the backends when created
+        scheduler = await asyncio.to_thread(get_job_scheduler)
+        job = await scheduler.submit_async(_request_user(request), fn, *args, **kwargs)
+    except (JobQueueFullError, NoBackendError) as err:
+        raise gr.Error(str(err))
+
+    future = asyncio.wrap_future(job.future)
+    try:
+        while not future.done():
+            position, backend = job.position, job.backend
+            if position:
+                yield f'Waiting in queue, position {position}', None, None
+            elif backend is not None and _runs_alone(backend):
+                try:
+                    progress = await backend.client.async_get_progress()
+                except Exception as err:
+                    logging.warning(f'Unable to get the progress of webui backend {backend.name!r} - {err!r}')
+                else:
+                    # fresher than the one of the last health check
+                    backend.queue_depth = max(int((progress.get('state') or {}).get('job_count') or 0), 0)
+                    if not future.done() and _runs_alone(backend):
+                        preview = await asyncio.to_thread(_progress_preview, progress)
+                        yield _progress_status(progress), preview, None
+            await asyncio.wait([future], timeout=interval)
+        yield 'Done', None, future.result()
+    except (asyncio.CancelledError, GeneratorExit):
+        backend = job.backend
+        if backend is not None and not future.done() and _runs_alone(backend):
+            # the rest of the steps are not needed, the gpu is released sooner
+            logging.info(f'Interrupting job {job!r} on webui backend {backend.name!r} ...')
+            try:
+                await backend.client.async_interrupt()
+            except Exception as err:
+                logging.warning(f'Unable to interrupt webui backend {backend.name!r} - {err!r}')
+        raise
+    finally:
+        # e.g. the waiting is stopped
+        job.cancel()
+
+
+def record_images(images: List[Image.Image]) -> Tuple[List[Image.Image], str, str]:
+    """
+    Record the generated images, return their thumbnails, and the meta infos and filenames in json.
+    """
+    meta_infos = [image.info.get('parameters') for image in images]
+    recorder = load_recorder_from_env()
+    # tagging and saving of the records are done in background, only the images are stored here
+    filenames = recorder.put_images_async(images, meta_infos)
+    logging.info(f'Recording {plural_word(len(images), "image")} to system, '
+                 f'{plural_word(recorder.backlog, "image")} in backlog.')
+    # the thumbnails are stored with the images, not made again
+    thumbnails = [recorder.image_storage.get_thumbnail(filename) for filename in filenames]
+    return thumbnails, json.dumps(meta_infos), json.dumps(filenames)
@@ -1,33 +1,30 @@
 import gradio as gr
 
-from webui_wrap.base import get_webui_client
+from webui_wrap.base import get_webui_client, get_capability, refresh_capabilities
 
 
 def create_base_model_ui():
     client = get_webui_client()
 
-    def base_model_refresh():
+    def base_model_refresh(model_name=None):
         return gr.Dropdown(
-            value=client.util_get_current_model(),
-            choices=client.util_get_model_names(),
+            value=model_name or client.util_get_current_model(),
+            choices=get_capability('sd_models'),
             label='Base Model',
         )
 
-    def _base_model_select(model_name):
-        client.util_set_model(model_name)
-        return base_model_refresh()
+    def _base_model_reload(model_name):
+        refresh_capabilities()
+        return base_model_refresh(model_name)
 
+    # the selected model is not loaded here, it is loaded by the job scheduler when the jobs using it run
     with gr.Row():
         gr_base_model = base_model_refresh()
         gr_base_model_refresh = gr.Button(value='Refresh')
         gr_clip_skip = gr.Slider(value=2, minimum=1, maximum=3, label='Clip Skip')
 
         gr_base_model_refresh.click(
-            fn=base_model_refresh,
-            outputs=[gr_base_model],
-        )
-        gr_base_model.select(
-            fn=_base_model_select,
+            fn=_base_model_reload,
             inputs=[gr_base_model],
             outputs=[gr_base_model],
         )
@@ -1,6 +1,6 @@
+import asyncio
 import json
 import logging
-from functools import lru_cache
 
 import gradio as gr
 from hbutils.string import plural_word
@@ -8,12 +8,13 @@ from webuiapi import ControlNetUnit, ADetailer
 
 from .adetailer import create_adetailer_ui
 from .controlnet import create_controlnet_ui
-from ..base import auto_init_webui, get_webui_client, WEBUI_SAMPLERS, has_dynamic_prompts, dynamic_prompt_params, \
-    has_controlnet, has_adetailer
+from .job import stream_webui_job, record_images, get_generation_concurrency, GENERATION_CONCURRENCY_ID
+from ..base import auto_init_webui, WEBUI_SAMPLERS, has_dynamic_prompts, dynamic_prompt_params, \
+    has_controlnet, has_adetailer, get_capability
 from ..storage import load_recorder_from_env
 
 
-def t2i_infer(
+async def t2i_infer(
         prompt, neg_prompt: str, seed: int = -1,
         sampler_name='DPM++ 2M Karras', cfg_scale=7, steps=30,
         firstphase_width=512, firstphase_height=768,
@@ -31,13 +32,19 @@ def t2i_infer(
 
         ad_enabled: bool = False, ad_model: str = 'None',
         ad_prompt: str = '', ad_neg_prompt: str = '',
+
+        request: gr.Request = None,
 ):
-    auto_init_webui()
-    client = get_webui_client()
-    client.util_set_model(base_model)
+    alwayson_scripts, model_known = await asyncio.to_thread(
+        _lookup_capabilities, dynamic_prompts_enabled, dp_fixed_seed, base_model)
+    # the job is only routed to the webui backends with all these installed
+    requirements = {'scripts': [], 'cn_models': [], 'adetailer_models': [], 'upscalers': [], 'sd_models': []}
 
     controlnet_units = []
     if cn_enabled:
+        requirements['scripts'].append('controlnet')
+        if cn_model and cn_model != 'None':
+            requirements['cn_models'].append(cn_model)
         controlnet_units.append(ControlNetUnit(
             input_image=cn_input_image,
             module=cn_preprocessor,
@@ -51,6 +58,9 @@ def t2i_infer(
 
     adetailer_units = []
     if ad_enabled:
+        requirements['scripts'].append('adetailer')
+        if ad_model and ad_model != 'None':
+            requirements['adetailer_models'].append(ad_model)
         adetailer_units.append(ADetailer(
             ad_model=ad_model,
             ad_prompt=ad_prompt,
@@ -58,52 +68,65 @@ def t2i_infer(
             ad_clip_skip=clip_skip,
         ))
 
-    logging.info('Inferring ...')
-    result = client.txt2img(
-        prompt=prompt,
-        negative_prompt=neg_prompt,
-        batch_size=batch_size,
-        sampler_name=sampler_name,
-        cfg_scale=cfg_scale,
-        steps=steps,
-        firstphase_width=firstphase_width,
-        firstphase_height=firstphase_height,
-        hr_resize_x=hr_resize_x,
-        hr_resize_y=hr_resize_y,
-        denoising_strength=denoising_strength,
-        hr_second_pass_steps=hr_second_pass_steps,
-        hr_upscaler=hr_upscaler,
-        seed=seed,
-        enable_hr=enable_hr,
-        override_settings={
-            'CLIP_stop_at_last_layers': clip_skip,
-        },
-        controlnet_units=controlnet_units,
-        adetailer=adetailer_units,
-        alwayson_scripts={
-            **dynamic_prompt_params(
-                is_enabled=dynamic_prompts_enabled,
-                is_combinatorial=dynamic_prompts_enabled,
-                use_fixed_seed=dp_fixed_seed,
-            )
-        },
-    )
+    requirements['scripts'].extend(alwayson_scripts)
+    if enable_hr:
+        requirements['upscalers'].append(hr_upscaler)
+    if model_known:
+        # the other names are matched to the closest model by webui
+        requirements['sd_models'].append(base_model)
+
+    async def _txt2img(client):
+        logging.info('Inferring ...')
+        return await client.async_txt2img(
+            prompt=prompt,
+            negative_prompt=neg_prompt,
+            batch_size=batch_size,
+            sampler_name=sampler_name,
+            cfg_scale=cfg_scale,
+            steps=steps,
+            firstphase_width=firstphase_width,
+            firstphase_height=firstphase_height,
+            hr_resize_x=hr_resize_x,
+            hr_resize_y=hr_resize_y,
+            denoising_strength=denoising_strength,
+            hr_second_pass_steps=hr_second_pass_steps,
+            hr_upscaler=hr_upscaler,
+            seed=seed,
+            enable_hr=enable_hr,
+            override_settings={
+                'CLIP_stop_at_last_layers': clip_skip,
+            },
+            controlnet_units=controlnet_units,
+            adetailer=adetailer_units,
+            alwayson_scripts=alwayson_scripts,
+        )
+
+    # the model is switched by the job scheduler, only when not loaded yet
+    async for status, preview, result in stream_webui_job(_txt2img, model=base_model, requirements=requirements,
+                                                          request=request):
+        if result is None:
+            # the status and the preview are streamed into the gallery, until the images are generated
+            yield gr.Gallery(value=[(preview, status)] if preview else None, label=status), '[]', '[]'
 
     logging.info(f'T2I complete, {plural_word(len(result.images), "image")} get.')
-    meta_infos = [image.info.get('parameters') for image in result.images]
-    recorder = load_recorder_from_env()
-    logging.info(f'Recording {plural_word(len(result.images), "image")} to system.')
-    for image, meta_info in zip(result.images, meta_infos):
-        recorder.put_image(image, meta_info)
-    recorder.save()
+    # the images are saved in a worker thread, not blocking the event loop
+    thumbnails, meta_infos, filenames = await asyncio.to_thread(record_images, result.images)
+    yield gr.Gallery(value=thumbnails, label='Gallery'), meta_infos, filenames
 
-    return result.images, json.dumps(meta_infos)
+
+def _lookup_capabilities(dynamic_prompts_enabled: bool, dp_fixed_seed: bool, base_model: str):
+    # run in a worker thread, the clients and capabilities may be fetched from webui
+    auto_init_webui()
+    alwayson_scripts = dynamic_prompt_params(
+        is_enabled=dynamic_prompts_enabled,
+        is_combinatorial=dynamic_prompts_enabled,
+        use_fixed_seed=dp_fixed_seed,
+    )
+    return alwayson_scripts, base_model in get_capability('sd_models')
 
 
-@lru_cache()
 def _get_hires_upscalers():
-    client = get_webui_client()
-    return [item['name'] for item in client.get_upscalers()]
+    return get_capability('upscalers')
 
 
 _DEFAULT_PROMPT = """
@@ -176,25 +199,31 @@ def create_t2i_ui(gr_base_model: gr.Dropdown, gr_clip_skip: gr.Slider):
                     gr_adetailer_components = create_adetailer_ui()
 
         with gr.Column():
-            gr_generate = gr.Button(value='Generate', variant='primary')
+            with gr.Row():
+                gr_generate = gr.Button(value='Generate', variant='primary')
+                gr_stop = gr.Button(value='Stop')
             gr_gallery = gr.Gallery(label='Gallery')
             gr_hidden_metas = gr.TextArea(visible=False, interactive=False)
+            gr_hidden_files = gr.TextArea(visible=False, interactive=False)
+            gr_image = gr.Image(label='Selected Image', type='pil', interactive=False)
             gr_meta_info = gr.Text(label='Meta Information', value='', lines=10, show_copy_button=True,
                                    interactive=False)
 
-            def _gallery_select(hidden_meta: str, evt: gr.SelectData):
-                if evt.selected:
-                    return json.loads(hidden_meta)[evt.index] or '<empty>'
+            def _gallery_select(hidden_meta: str, hidden_files: str, evt: gr.SelectData):
+                # nothing recorded for the previews
+                if evt.selected and evt.index < len(json.loads(hidden_files or '[]')):
+                    image = load_recorder_from_env().image_storage.get_image(json.loads(hidden_files)[evt.index])
+                    return image, json.loads(hidden_meta)[evt.index] or '<empty>'
                 else:
-                    return 'N/A'
+                    return None, 'N/A'
 
             gr_gallery.select(
                 _gallery_select,
-                inputs=[gr_hidden_metas],
-                outputs=[gr_meta_info],
+                inputs=[gr_hidden_metas, gr_hidden_files],
+                outputs=[gr_image, gr_meta_info],
             )
 
-        gr_generate.click(
+        gr_generate_event = gr_generate.click(
             t2i_infer,
             inputs=[
                 gr_prompt, gr_neg_prompt, gr_seed,
@@ -207,5 +236,11 @@ def create_t2i_ui(gr_base_model: gr.Dropdown, gr_clip_skip: gr.Slider):
                 *gr_controlnet_components,
                 *gr_adetailer_components,
             ],
-            outputs=[gr_gallery, gr_hidden_metas],
+            outputs=[gr_gallery, gr_hidden_metas, gr_hidden_files],
+            concurrency_id=GENERATION_CONCURRENCY_ID,
+            concurrency_limit=get_generation_concurrency(),
+            # not to cover the previews
+            show_progress='minimal',
         )
+        # the webui job is interrupted when the streaming is cancelled
+        gr_stop.click(fn=None, cancels=[gr_generate_event])